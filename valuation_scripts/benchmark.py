@@ -0,0 +1,237 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from dcf import dcf_inputs
+from dcf_batch import average_margin, dcf_batch, linear_forecasts, smoothing_forecast
+from erm import erm_inputs
+from erm_batch import erm_batch
+from main import company_stage
+from stage import classify
+from valuation import DCF_GROWTH_RATE, ERM_HIGH_GROWTH, ERM_PERIODS, NUMBER_OF_YEARS, STABLE_GROWTH_RATE, value_dcf, value_erm
+
+### DEFINITIONS & ASSUMPTIONS ###
+BENCHMARK_SIZES = [100, 1000, 10000, 100000]                                       # Universe sizes timed by default
+BENCHMARK_BASELINE = os.environ.get('BENCHMARK_BASELINE', 'benchmark_baseline.json')
+BENCHMARK_SAMPLE = int(os.environ.get('BENCHMARK_SAMPLE', 500))                    # Tickers timed one by one per size
+REGRESSION_TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 1.25))          # Slower than baseline by this factor fails
+BENCHMARK_SEED = 7
+COST_OF_EQUITY = 0.09
+STABLE_ROE = 0.12
+
+YEARS = pd.to_datetime(['2023-12-31', '2022-12-31', '2021-12-31', '2020-12-31', '2019-12-31'])
+
+
+### Synthetic statements ###
+def synthetic_universe(n, seed=BENCHMARK_SEED):
+    # Statement lines for n tickers as arrays, monetary values in millions and series oldest first.
+    # About 5% of tickers have collapsing revenues so the exponential smoothing fallback is exercised too.
+    rng = np.random.default_rng(seed)
+    T = len(YEARS)
+    growth = rng.normal(0.06, 0.12, (n, T))
+    growth[rng.random(n) < 0.05] = -0.35
+    revenues = rng.lognormal(6, 1.5, n)[:, None] * np.cumprod(1 + growth, axis=1)
+    equity = revenues[:, -1] * rng.uniform(0.3, 1.5, n)
+    assets = equity * rng.uniform(1.5, 10, n)
+    debt = revenues[:, -1] * rng.uniform(0.1, 1.0, n)
+    current_assets = revenues[:, -2:] * rng.uniform(0.2, 0.6, (n, 1))
+    return {
+        'revenues': revenues,
+        'ocf': revenues * rng.uniform(0.05, 0.3, (n, 1)) * rng.normal(1, 0.05, (n, T)),
+        'capex': -revenues * rng.uniform(0.02, 0.12, (n, 1)),
+        'ebit': revenues[:, -1] * rng.uniform(0.05, 0.25, n),
+        'debt': debt,
+        'interest': debt * rng.uniform(0.02, 0.08, n),
+        'tax_rate': rng.uniform(0.1, 0.3, n),
+        'cash': revenues[:, -1] * rng.uniform(0.05, 0.3, n),
+        'shares': rng.lognormal(4, 1, n),
+        'price': rng.lognormal(3.5, 0.8, n),
+        'equity': equity,
+        'assets': assets,
+        'liabilities': assets - equity,
+        'net_income': equity * rng.normal(0.1, 0.05, n),
+        'retained_earnings': (equity * rng.uniform(0.3, 0.7, n))[:, None] * np.cumprod(1 + rng.normal(0.05, 0.05, (n, T)), axis=1),
+        'current_assets': current_assets,
+        'current_liabilities': current_assets * rng.uniform(0.5, 1.2, (n, 1)),
+    }
+
+
+def yfinance_frame(rows):
+    # yfinance statement: one row per line item, newest period first, raw units. Scalars fill the latest period only.
+    T = len(YEARS)
+    columns = {}
+    for name, values in rows.items():
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        columns[name] = np.concatenate([values[::-1], [np.nan] * (T - len(values))]) * 1000000
+    return pd.DataFrame(columns, index=YEARS).T
+
+
+def statements(universe, i):
+    # The fundamentals store entry dcf_inputs / erm_inputs / company_stage would see for ticker i
+    u = {name: values[i] for name, values in universe.items()}
+    return {
+        'info': {'sharesOutstanding': u['shares'] * 1000000, 'previousClose': u['price']},
+        'balance_sheet': yfinance_frame({'Total Debt': u['debt'], 'Cash Cash Equivalents And Short Term Investments': u['cash'],
+                                         'Stockholders Equity': u['equity'], 'Total Assets': u['assets'],
+                                         'Total Liabilities Net Minority Interest': u['liabilities'],
+                                         'Retained Earnings': u['retained_earnings'], 'Current Assets': u['current_assets'],
+                                         'Current Liabilities': u['current_liabilities']}),
+        'income_stmt': yfinance_frame({'Total Revenue': u['revenues'], 'Interest Expense': u['interest'], 'EBIT': u['ebit'],
+                                       'Net Income': u['net_income']}),
+        'cashflow': yfinance_frame({'Operating Cash Flow': u['ocf'], 'Capital Expenditure': u['capex']}),
+        'financials_sorted': pd.DataFrame({'Tax Rate For Calcs': [u['tax_rate']] * len(YEARS)}, index=YEARS),
+    }
+
+
+### Benchmarks ###
+# Each benchmark takes (universe, sampled statements) and returns how many tickers it valued.
+# Per-ticker benchmarks run over the sample, batch benchmarks over the whole universe.
+def bench_dcf(universe, sample):
+    for s in sample:
+        value_dcf(dcf_inputs('BENCH', s['info']['previousClose'], s['balance_sheet'], s['income_stmt'], s['cashflow'],
+                             s['financials_sorted'], None, COST_OF_EQUITY, DCF_GROWTH_RATE, NUMBER_OF_YEARS, s['info'], ''))
+    return len(sample)
+
+
+def bench_erm(universe, sample):
+    high_growth_period, stable_growth_period = ERM_PERIODS[ERM_HIGH_GROWTH]
+    for s in sample:
+        value_erm(erm_inputs('BENCH', s['balance_sheet'], s['income_stmt'], None, COST_OF_EQUITY, STABLE_ROE, high_growth_period,
+                             stable_growth_period, NUMBER_OF_YEARS, '', s['info'], STABLE_GROWTH_RATE))
+    return len(sample)
+
+
+def bench_stage(universe, sample):
+    for s in sample:
+        company_stage(None, s['info'], s['balance_sheet'], s['income_stmt'], s['cashflow'], s['financials_sorted'])
+    return len(sample)
+
+
+def bench_classify(universe, sample):
+    u = universe
+    growth = u['revenues'][:, 1:] / u['revenues'][:, :-1] - 1
+    features = [{'industry_group': None, 'revenue_growth': growth[i], 'capex': -u['capex'][i, -1], 'ebit': u['ebit'][i],
+                 'tax_rate': u['tax_rate'][i], 'current_assets': u['current_assets'][i, -1], 'previous_current_assets': u['current_assets'][i, 0],
+                 'current_liabilities': u['current_liabilities'][i, -1], 'previous_current_liabilities': u['current_liabilities'][i, 0]}
+                for i in range(len(growth))]
+    classify(features)
+    return len(features)
+
+
+def bench_smoothing(universe, sample):
+    for revenues in universe['revenues'][:len(sample)]:
+        smoothing_forecast(revenues)
+    return len(sample)
+
+
+def bench_linear_forecasts(universe, sample):
+    linear_forecasts(universe['revenues'])
+    return len(universe['revenues'])
+
+
+def bench_dcf_batch(universe, sample):
+    u = universe
+    dcf_batch(u['revenues'], average_margin(u['ocf'], u['revenues']), average_margin(u['capex'], u['revenues']),
+              u['price'] * u['shares'], u['debt'], u['interest'], u['tax_rate'], COST_OF_EQUITY, u['cash'], u['shares'],
+              DCF_GROWTH_RATE)
+    return len(u['revenues'])
+
+
+def bench_erm_batch(universe, sample):
+    u = universe
+    erm_batch((u['assets'] - u['liabilities']) / u['shares'], u['net_income'] / u['equity'], COST_OF_EQUITY, STABLE_ROE,
+              u['retained_earnings'], u['shares'], ERM_PERIODS[ERM_HIGH_GROWTH][0], STABLE_GROWTH_RATE)
+    return len(u['revenues'])
+
+
+BENCHMARKS = {
+    'dcf': bench_dcf,
+    'erm': bench_erm,
+    'stage': bench_stage,
+    'classify': bench_classify,
+    'smoothing_forecast': bench_smoothing,
+    'linear_forecasts': bench_linear_forecasts,
+    'dcf_batch': bench_dcf_batch,
+    'erm_batch': bench_erm_batch,
+}
+
+
+def measure(benchmark, universe, sample, memory=True):
+    # (tickers, seconds, peak MiB). Timed without tracemalloc, which slows Python code down; the peak comes from a second run.
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        tickers = benchmark(universe, sample)
+        seconds = time.perf_counter() - start
+        peak = None
+        if memory:
+            tracemalloc.start()
+            try:
+                benchmark(universe, sample)
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            finally:
+                tracemalloc.stop()
+    return tickers, seconds, peak
+
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, sample_size=BENCHMARK_SAMPLE, names=None, memory=True):
+    # {'name@size': {'tickers', 'seconds', 'per_ticker', 'peak_mb'}}
+    results = {}
+    for size in sizes:
+        universe = synthetic_universe(size)
+        sample = [statements(universe, i) for i in range(min(size, sample_size))]
+        for name in names or BENCHMARKS:
+            tickers, seconds, peak = measure(BENCHMARKS[name], universe, sample, memory)
+            results[f'{name}@{size}'] = {'tickers': tickers, 'seconds': seconds, 'per_ticker': seconds / tickers, 'peak_mb': peak}
+    return results
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    # Benchmarks whose time per ticker grew by more than tolerance over the baseline
+    return [key for key, result in results.items()
+            if key in baseline and result['per_ticker'] > baseline[key]['per_ticker'] * tolerance]
+
+
+def report(results, baseline):
+    print(f"{'benchmark':<28}{'tickers':>9}{'us/ticker':>12}{'peak MiB':>10}{'baseline':>12}{'ratio':>8}")
+    for key, result in results.items():
+        line = f"{key:<28}{result['tickers']:>9}{result['per_ticker'] * 1e6:>12.1f}"
+        line += f"{result['peak_mb']:>10.1f}" if result['peak_mb'] is not None else f"{'-':>10}"
+        if key in baseline:
+            line += f"{baseline[key]['per_ticker'] * 1e6:>12.1f}{result['per_ticker'] / baseline[key]['per_ticker']:>8.2f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the valuation engines on synthetic statements, fully offline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCHMARK_SIZES)
+    parser.add_argument('--sample', type=int, default=BENCHMARK_SAMPLE, help='Tickers timed one by one per size')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Benchmarks to run, all by default')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the peak memory pass')
+    parser.add_argument('--baseline', default=BENCHMARK_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.sample, args.only, not args.no_memory)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(baseline, **results), f, indent=2)
+        print(f"Baseline saved to {args.baseline}.")
+    else:
+        regressions = compare(results, baseline)
+        for key in regressions:
+            print(f"Regression: {key} is more than {REGRESSION_TOLERANCE}x slower per ticker than the baseline.")
+        sys.exit(1 if regressions else 0)
@@ -1,4 +1,3 @@
-import yfinance as yf
 import pandas as pd
 import numpy as np
 import datetime as dt
@@ -7,18 +6,242 @@ import openpyxl
 import time
 import math
 from sklearn.linear_model import LinearRegression
-from statsmodels.tsa.holtwinters import SimpleExpSmoothing
-
-def get_first_numeric_value(dfs, sheet_index, row_name):
-    df = dfs[sheet_index]
-    row_values = df.loc[row_name]
-    for value in row_values:
-        if isinstance(value, (int, float)) and not np.isnan(value) and value != 0:
-            return value
+
+from telemetry import recorder
+
+### Statement sections ###
+# Sheet positions of the statements in a stockanalysis {symbol}-financials.xlsx export
+SECTIONS = {
+    'income_statement': 0,
+    'balance_sheet': 1,
+    'cash_flow': 2,
+    'income_statement_detail': 8,       # EBIT and interest lines
+    'balance_sheet_detail': 9,          # Total debt
+    'ratios': 11,                       # Market capitalization and return ratios
+}
+
+
+def _first(mask):
+    # Column of the first True in each row, -1 where the row has none
+    if mask.shape[1] == 0:
+        return np.full(mask.shape[0], -1)
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), -1)
+
+
+class SheetIndex:
+    # One sheet converted to floats once (text and blanks become NaN) with a label -> row position map.
+    # The first non-null non-zero and first two non-null values of every row are found with column masks up front,
+    # so a lookup is a dict hit and two array reads.
+    def __init__(self, df):
+        self.rows = {}
+        for position, label in enumerate(df.index):
+            self.rows.setdefault(label, position)
+        self.values = df.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        valid = ~np.isnan(self.values)
+        self.first_nonzero = _first(valid & (self.values != 0))
+        self.first_valid = _first(valid)
+        self.second_valid = _first(valid & (np.cumsum(valid, axis=1) == 2))
+
+    def _at(self, position, column):
+        return None if position is None or column < 0 else float(self.values[position, column])
+
+    def first(self, label):
+        position = self.rows.get(label)
+        return None if position is None else self._at(position, self.first_nonzero[position])
+
+    def first_two(self, label):
+        position = self.rows.get(label)
+        if position is None:
+            return None, None
+        return self._at(position, self.first_valid[position]), self._at(position, self.second_valid[position])
+
+
+def sheet(dfs, name):
+    return dfs[SECTIONS[name]]
+
+
+def _index(dfs, name):
+    try:
+        return SheetIndex(sheet(dfs, name))
+    except IndexError:
+        return SheetIndex(pd.DataFrame())       # Older exports lack the detail sheets: every lookup misses
+
+
+def section(dfs, name):
+    # SheetIndex of a named section, kept on the workbook so it is built once per file
+    indexes = getattr(dfs, 'indexes', None)
+    if indexes is None:
+        return _index(dfs, name)
+    if name not in indexes:
+        indexes[name] = _index(dfs, name)
+    return indexes[name]
+
+
+def get_first_numeric_value(dfs, section_name, row_name):
+    return section(dfs, section_name).first(row_name)
+
+
+def get_first_two_numeric_values(dfs, section_name, row_name):
+    return section(dfs, section_name).first_two(row_name)
+
+
+### Field sources ###
+# Where each valuation input is looked up, in order; the first usable value (not None, NaN or zero) wins.
+#   ('yfinance', statement, row)   latest column of a yfinance statement, in millions (pairs: latest two columns)
+#   ('info', key)                  yfinance info entry, in millions
+#   ('financials', column)         latest row of the sorted yfinance financials, as is
+#   ('excel', section, row)        workbook row: first non-null non-zero value (pairs: first two non-null values)
+#   ('derived', name)              DERIVED_FIELDS[name](resolver)
+FIELD_SOURCES = {
+    'shares_outstanding': [('info', 'sharesOutstanding'),
+                           ('excel', 'income_statement', 'Shares Outstanding (Diluted)'),
+                           ('excel', 'income_statement', 'Shares Outstanding (Basic)')],
+    'market_cap': [('excel', 'ratios', 'Market Capitalization')],
+    'total_debt': [('yfinance', 'balance_sheet', 'Total Debt'),
+                   ('excel', 'balance_sheet_detail', 'Total Debt')],
+    'interest_expense': [('yfinance', 'income_stmt', 'Interest Expense'),
+                         ('excel', 'income_statement_detail', 'Interest Expense / Income')],
+    'tax_rate': [('financials', 'Tax Rate For Calcs'),
+                 ('derived', 'effective_tax_rate'),
+                 ('excel', 'income_statement', 'Effective Tax Rate')],
+    'cash_and_cash_equivalents': [('yfinance', 'balance_sheet', 'Cash Cash Equivalents And Short Term Investments'),
+                                  ('derived', 'cash_and_short_term_investments')],
+    'return_on_equity': [('derived', 'return_on_equity'),
+                         ('excel', 'ratios', 'Return on Equity (ROE)')],
+    'total_assets': [('yfinance', 'balance_sheet', 'Total Assets'),
+                     ('excel', 'balance_sheet', 'Total Assets')],
+    'total_liabilities': [('yfinance', 'balance_sheet', 'Total Liabilities Net Minority Interest'),
+                          ('excel', 'balance_sheet', 'Total Liabilities')],
+    'capital_expenditure': [('yfinance', 'cashflow', 'Capital Expenditure'),
+                            ('excel', 'cash_flow', 'Capital Expenditures')],
+    'ebit': [('yfinance', 'income_stmt', 'EBIT'),
+             ('excel', 'income_statement_detail', 'EBIT')],
+}
+
+# (current, previous) fields, same source kinds
+PAIR_SOURCES = {
+    'current_assets': [('yfinance', 'balance_sheet', 'Current Assets'),
+                       ('excel', 'balance_sheet', 'Total Current Assets'),
+                       ('derived', 'current_assets_components')],
+    'current_liabilities': [('yfinance', 'balance_sheet', 'Current Liabilities'),
+                            ('excel', 'balance_sheet', 'Total Current Liabilities'),
+                            ('derived', 'current_liabilities_components')],
+}
+
+ZERO_ALLOWED_FIELDS = {'cash_and_cash_equivalents'}
+
+# Workbook rows summed when a statement has no current assets / liabilities total
+CURRENT_ASSETS_COMPONENTS = ['Cash & Equivalents', 'Receivables', 'Inventory', 'Other Current Assets']
+CURRENT_LIABILITIES_COMPONENTS = ['Accounts Payable', 'Deferred Revenue', 'Current Debt', 'Other Current Liabilities']
+
+
+def usable(value, allow_zero=False):
+    return value is not None and not math.isnan(value) and (allow_zero or value != 0)
+
+
+def _sum_pairs(resolver, labels):
+    if resolver.dfs is None:
+        return None, None
+    pairs = [section(resolver.dfs, 'balance_sheet').first_two(label) for label in labels]
+    if all(current is None and previous is None for current, previous in pairs):
+        return None, None
+    return sum(current or 0 for current, _ in pairs), sum(previous or 0 for _, previous in pairs)
+
+
+def _effective_tax_rate(resolver):
+    tax_provision = resolver.statement_value('income_stmt', 'Tax Provision')      # Income Tax Expense
+    pretax_income = resolver.statement_value('income_stmt', 'Pretax Income')
+    if usable(tax_provision) and usable(pretax_income):
+        return tax_provision / pretax_income
     return None
 
-def get_first_two_numeric_values(dfs, sheet_index, row_name):
-    df = dfs[sheet_index]
-    row_values = df.loc[row_name]
-    numeric_values = [value for value in row_values if isinstance(value, (int, float)) and not np.isnan(value)]
-    return numeric_values[0] if len(numeric_values) > 0 else None, numeric_values[1] if len(numeric_values) > 1 else None
+
+def _cash_and_short_term_investments(resolver):
+    if resolver.dfs is None:
+        return None
+    cash_and_equivalents = get_first_numeric_value(resolver.dfs, 'balance_sheet', 'Cash & Equivalents')
+    short_term_investments = get_first_numeric_value(resolver.dfs, 'balance_sheet', 'Short-TermInvestments')
+    if cash_and_equivalents is not None and short_term_investments is not None:
+        return cash_and_equivalents + short_term_investments
+    return cash_and_equivalents
+
+
+def _return_on_equity(resolver):
+    net_income = resolver.statement_value('income_stmt', 'Net Income')
+    shareholders_equity = resolver.statement_value('balance_sheet', 'Stockholders Equity')
+    if usable(net_income, allow_zero=True) and usable(shareholders_equity):
+        return net_income / shareholders_equity
+    return None
+
+
+DERIVED_FIELDS = {
+    'effective_tax_rate': _effective_tax_rate,
+    'cash_and_short_term_investments': _cash_and_short_term_investments,
+    'return_on_equity': _return_on_equity,
+    'current_assets_components': lambda resolver: _sum_pairs(resolver, CURRENT_ASSETS_COMPONENTS),
+    'current_liabilities_components': lambda resolver: _sum_pairs(resolver, CURRENT_LIABILITIES_COMPONENTS),
+}
+
+
+class FieldResolver:
+    # Resolves the fields of one ticker through FIELD_SOURCES / PAIR_SOURCES; dfs is the stockanalysis workbook or None.
+    # Statements are the yfinance frames by name (balance_sheet, income_stmt, cashflow, financials); missing ones may be None.
+    def __init__(self, dfs, info=None, **statements):
+        self.dfs = dfs
+        self.info = info or {}
+        self.statements = statements
+        self.resolved = {}
+
+    def statement_value(self, statement, row, column=0):
+        try:
+            df = self.statements[statement]
+            return float(df.at[row, df.columns[column]]) / 1000000
+        except Exception:
+            return None
+
+    def _lookup(self, source, pair):
+        kind = source[0]
+        if kind == 'yfinance':
+            if pair:
+                return self.statement_value(source[1], source[2]), self.statement_value(source[1], source[2], column=1)
+            return self.statement_value(source[1], source[2])
+        if kind == 'excel':
+            if self.dfs is None:
+                return (None, None) if pair else None
+            index = section(self.dfs, source[1])
+            return index.first_two(source[2]) if pair else index.first(source[2])
+        if kind == 'derived':
+            return DERIVED_FIELDS[source[1]](self)
+        try:
+            if kind == 'info':
+                return float(self.info[source[1]]) / 1000000
+            if kind == 'financials':
+                return float(self.statements['financials'][source[1]].iloc[0])
+        except Exception:
+            return None
+        raise ValueError(f'Unknown field source {source}')
+
+    def _resolve(self, field, sources, pair, accept, missing):
+        # Walks the sources in order, counting the fallbacks taken for the run telemetry
+        for position, source in enumerate(sources):
+            found = self._lookup(source, pair)
+            if accept(found):
+                if position:
+                    recorder.count(f'fallback.{field}.{source[0]}')
+                return found
+        recorder.count(f'missing.{field}')
+        return missing
+
+    def value(self, field):
+        # First usable value of the field, None when no source has one
+        if field not in self.resolved:
+            allow_zero = field in ZERO_ALLOWED_FIELDS
+            self.resolved[field] = self._resolve(field, FIELD_SOURCES[field], False, lambda value: usable(value, allow_zero), None)
+        return self.resolved[field]
+
+    def pair(self, field):
+        # (current, previous) from the first source that has both, (None, None) otherwise
+        if field not in self.resolved:
+            self.resolved[field] = self._resolve(field, PAIR_SOURCES[field], True, lambda values: all(usable(value) for value in values),
+                                                 (None, None))
+        return self.resolved[field]
@@ -1,32 +1,26 @@
-import yfinance as yf
-import pandas as pd
-import numpy as np
-import datetime as dt
 import os
-import openpyxl
-import time
-import math
-from sklearn.linear_model import LinearRegression
-from statsmodels.tsa.holtwinters import SimpleExpSmoothing
-from data_functions import get_first_numeric_value, get_first_two_numeric_values
 
-def dcf(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_sorted, xlsx, \
-        dfs, COST_OF_EQUITY, DCF_GROWTH_RATE, NUMBER_OF_YEARS, exchange_ticker, stock, filepath):
+from data_functions import FieldResolver, sheet
+from results import result_row, sink
+from telemetry import recorder
+from valuation import DCF_NEGATIVE_REVENUES, DCFInputs, value_dcf
+
+# Resolves the DCF inputs from the yfinance statements, falling back to the stockanalysis workbook (dfs)
+def dcf_inputs(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_sorted, \
+               dfs, COST_OF_EQUITY, DCF_GROWTH_RATE, NUMBER_OF_YEARS, info, filepath):
     ### Calculating Average Operating Cash Flow (ocf) Margin ###
     past_revenues = None
     ocf = None
     if os.path.exists(filepath):
-        df = pd.read_excel(xlsx, sheet_name=0, index_col=0)
+        df = sheet(dfs, 'income_statement')
         past_revenues = df.loc['Revenue'][:NUMBER_OF_YEARS][::-1]
-        df = pd.read_excel(xlsx, sheet_name=2, index_col=0)
+        df = sheet(dfs, 'cash_flow')
         ocf = df.loc['Operating Cash Flow'][:NUMBER_OF_YEARS][::-1]
 
     if (past_revenues is None or past_revenues.isnull().any()) or (ocf is None or ocf.isnull().any()) or (past_revenues == 0).any() or (len(past_revenues) != len(ocf)):
         try:
             past_revenues = income_stmt.loc['Total Revenue'][::-1] / 1000000
-            time.sleep(0.05)
             ocf = cash_flow.loc['Operating Cash Flow'][::-1] / 1000000
-            time.sleep(0.05)
         except Exception as e:
             raise Exception("Missing revenue or ocf data")
 
@@ -41,25 +35,20 @@ def dcf(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_s
             average_ocf_margin = ocf_margin.mean()
         except Exception as e:
             raise Exception("Missing revenue or ocf data")
-    
-    print(f'Average ocf margin is: {average_ocf_margin}.')
-
 
     ### Calculating Average Capital Expenditure (capex) Margin ###
     capex = None
     past_revenues = None
     if os.path.exists(filepath):
-        df = pd.read_excel(xlsx, sheet_name=2, index_col=0)
+        df = sheet(dfs, 'cash_flow')
         capex = df.loc['Capital Expenditures'][:NUMBER_OF_YEARS][::-1]
-        df = pd.read_excel(xlsx, sheet_name=0, index_col=0)
+        df = sheet(dfs, 'income_statement')
         past_revenues = df.loc['Revenue'][:NUMBER_OF_YEARS][::-1]
     
     if (past_revenues is None or past_revenues.isnull().any()) or (capex is None or capex.isnull().any()) or (len(past_revenues) != len(capex)):
         try:
             capex = cash_flow.loc['Capital Expenditure'][::-1] / 1000000
-            time.sleep(0.05)    
             past_revenues = income_stmt.loc['Total Revenue'][::-1] / 1000000
-            time.sleep(0.05)
         except Exception as e:
             raise Exception("Missing revenue or capex data")
         
@@ -73,259 +62,66 @@ def dcf(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_s
             average_capex_margin = capex_margin.mean()
         except Exception as e:
             raise Exception("Missing revenue or capex data")
-        
-    print(f'Average capex margin is: {average_capex_margin}.')
-
 
     ### Calculating Discount Rate (WACC/Cost of Capital) ###
-    market_cap = None
-    if stock_price is not None:
-        try:
-            shares_outstanding = None
-            shares_outstanding = stock.info['sharesOutstanding'] / 1000000
-            time.sleep(0.05)
-            if shares_outstanding is not None or not math.isnan(shares_outstanding) or shares_outstanding != 0:
-                market_cap = stock_price * shares_outstanding
-            else:
-                raise Exception("Missing shares outstanding data")
-        except Exception as e:
-            if os.path.exists(filepath):
-                shares_outstanding = get_first_numeric_value(dfs, 0, 'Shares Outstanding (Diluted)')
-                if shares_outstanding is None or math.isnan(shares_outstanding) or shares_outstanding == 0:
-                    shares_outstanding = get_first_numeric_value(dfs, 0, 'Shares Outstanding (Basic)')
-                if shares_outstanding is not None or not math.isnan(shares_outstanding) or shares_outstanding != 0:
-                    market_cap = stock_price * shares_outstanding
-                else:
-                    market_cap = get_first_numeric_value(dfs, 11, 'Market Capitalization')
-            else:
-                raise Exception("Missing shares outstanding data")
+    resolver = FieldResolver(dfs, info, balance_sheet=balance_sheet, income_stmt=income_stmt, cashflow=cash_flow, financials=financials_sorted)
+    shares_outstanding = resolver.value('shares_outstanding')
+    if stock_price is not None and shares_outstanding is not None:
+        market_cap = stock_price * shares_outstanding
     else:
-        market_cap = get_first_numeric_value(dfs, 11, 'Market Capitalization')
+        market_cap = resolver.value('market_cap')
 
-    if market_cap is None or math.isnan(market_cap) or market_cap == 0:
+    if market_cap is None:
         raise Exception("Missing market capitalization data")
-    # else:
-    #     print(f"The market capitalization is {market_cap}")
-
-    total_debt = None
-    try:
-        total_debt = balance_sheet.at['Total Debt', balance_sheet.columns[0]] / 1000000
-        time.sleep(0.05)
-        if total_debt is None or math.isnan(total_debt) or total_debt == 0:
-            raise Exception("Missing total debt data")
-    except Exception as e:
-        if os.path.exists(filepath):
-            total_debt = get_first_numeric_value(dfs, 9, 'Total Debt')
-        else:
-            raise Exception("Missing total debt data")    
+    if shares_outstanding is None:
+        raise Exception("Missing shares outstanding data")
 
-    if total_debt is None or math.isnan(total_debt) or total_debt == 0:
+    total_debt = resolver.value('total_debt')
+    if total_debt is None:
         raise Exception("Missing total debt data")
-    # else:
-    #     print(f"The total debt is {total_debt}")
 
-    interest_expense = None
-    try:
-        interest_expense = income_stmt.at['Interest Expense', income_stmt.columns[0]] / 1000000
-        time.sleep(0.05)
-        if interest_expense is None or math.isnan(interest_expense) or interest_expense == 0:
-            raise Exception("Missing total interest expense data")
-        print(f"Data obtained from yfinance.")
-        print(interest_expense)
-    except Exception as e:
-        if os.path.exists(filepath):
-            interest_expense = get_first_numeric_value(dfs, 8, 'Interest Expense / Income')
-            print(f"Data obtained from excel.")
-            print(interest_expense)
-        else:
-            raise Exception("Missing total interest expense data")
-        
-    if interest_expense is None or math.isnan(interest_expense) or interest_expense == 0:
+    interest_expense = resolver.value('interest_expense')
+    if interest_expense is None:
         raise Exception("Missing total interest expense data")
-    # else:
-    #     print(f"The total interest expense is {interest_expense}")
-    
-    tax_rate = None
-    try:
-        tax_rate = financials_sorted['Tax Rate For Calcs'].iloc[0]
-        time.sleep(0.05)
-        if tax_rate is None or math.isnan(tax_rate) or tax_rate == 0:
-            raise Exception("Missing tax rate data")
-    except Exception as e:
-        try:
-            tax_provision = income_stmt.at['Tax Provision', income_stmt[0]] / 1000000       # Income Tax Expense
-            time.sleep(0.05)
-            pretax_income = income_stmt.at['Pretax Income', income_stmt[0]] / 1000000
-            time.sleep(0.05)
-            if (tax_provision is not None and not math.isnan(tax_provision)) and (pretax_income is not None and not math.isnan(pretax_income)) and (pretax_income != 0 and tax_provision != 0):
-                tax_rate = tax_provision / pretax_income
-        except Exception as e:
-            if os.path.exists(filepath): 
-                tax_rate = get_first_numeric_value(dfs, 0, 'Effective Tax Rate')
-            else:
-                raise Exception("Missing tax rate")
-    
-    if tax_rate is None or math.isnan(tax_rate) or tax_rate == 0:
-        raise Exception("Missing tax rate")
-    # else:
-    #     print(f"The tax rate is {tax_rate}")
-
-    debt_weight = total_debt / (market_cap + total_debt)
-    equity_weight = 1 - debt_weight
-    cost_of_debt = interest_expense / total_debt
-
-    wacc = debt_weight * cost_of_debt * (1 - tax_rate) + equity_weight * COST_OF_EQUITY
-    print(f"The WACC is {wacc}")
-
-
-    ### Forecasting Revenue using Linear Regression ###
-    past_revenues = past_revenues.dropna()
-    years = np.array(range(1, len(past_revenues) + 1)).reshape(-1, 1)
-
-    train_data = past_revenues[:-2]
-    validation_data = past_revenues[-2:]
-
-    X_train = np.array(range(1, len(train_data) + 1)).reshape(-1, 1)
-    model = LinearRegression()
-    model.fit(X_train, train_data)
-
-    # Generating the validation period
-    X_validation = np.array(range(len(train_data) + 1, len(past_revenues) + 1)).reshape(-1, 1)
-    forecasted_values = model.predict(X_validation)
-    forecast_errors = validation_data - forecasted_values
-
-    # Mean Absolute Error or Root Mean Squared Error for error margin
-    mae = np.mean(np.abs(forecast_errors))
-    # rmse = np.sqrt(np.mean(forecast_errors**2))
-    error_margin = mae
-
-    # Forecast revenue for the next 5 years
-    next_years = np.array(range(len(past_revenues) + 1, len(past_revenues) + 6)).reshape(-1, 1)
-    predicted_revenues = model.predict(next_years)
-
-    # print(f"The predicted revenues are:\n{predicted_revenues}")
-    
-    negative_revenues = False
-    if any(revenue < 0 for revenue in predicted_revenues):
-        model = SimpleExpSmoothing(past_revenues)
-        model_fit = model.fit()
-        
-        # Generating the validation period for negative revenue forecasts
-        validation_forecasts = model_fit.predict(start=len(train_data), end=len(past_revenues) - 1)
-        validation_data = past_revenues[-len(validation_forecasts):]
-        forecast_errors_exp = validation_data - validation_forecasts
-
-        # Mean Absolute Error or Root Mean Squared Error for error margin
-        mae = np.mean(np.abs(forecast_errors_exp))
-        # rmse = np.sqrt(np.mean(forecast_errors_exp**2))
-        error_margin = mae
-        
-        predicted_revenues = model_fit.predict(start=len(past_revenues), end=len(past_revenues) + 4)
-
-        # print(f'Negative revenues, exponential smoothing predicted revenues are:\n{predicted_revenues}')
-        negative_revenues = True
-        percentage_error_margin = (error_margin / np.mean(validation_data))
-        print(f'Error margin for exponential smoothing: {percentage_error_margin}')
-    else:
-        percentage_error_margin = (error_margin / np.mean(validation_data))
-        print(f'Error margin for linear regression: {percentage_error_margin}')
-
-    if predicted_revenues is None or np.isnan(predicted_revenues).any():
-        raise Exception("Missing predicted revenue data")
-
-    ### Forecasting Unlevered Free Cash Flow to Firm (FCFF) ###
-    projected_FCFF = []
-
-    for revenue in predicted_revenues:
-        FCFF = revenue * (average_ocf_margin - average_capex_margin)
-        projected_FCFF.append(FCFF)
-
-    print(f"The projected free cash flows are:\n{projected_FCFF}")
-
-    ### Discounting Unlevered Free Cash Flow to Firm (FCFF) ###
-    # Calculate the present value of each year's free cash flow
-    discounted_FCFF = projected_FCFF / (1 + wacc)**(np.arange(1, len(projected_FCFF)+1))
-    # print(f"The discounted free cash flows are:\n{discounted_FCFF}")
-
-    ### Calculating the Discounted Terminal Value at the end of the projection period ###
-    terminal_value = projected_FCFF[-1] * (1 + DCF_GROWTH_RATE) / (wacc - DCF_GROWTH_RATE)
-    print(f"The Terminal Value is {terminal_value}")
 
-    # Discounting Terminal Value
-    forecasted_years = len(predicted_revenues)
-    discounted_terminal_value = terminal_value / ((1 + wacc) ** forecasted_years)
-    print(f"The Discounted Terminal Value is {discounted_terminal_value}")
-
-    ### Calculating the Enterprise Value ###
-    enterprise_value = sum(discounted_FCFF) + discounted_terminal_value
-
-    # lower_bound_ev = enterprise_value - error_margin
-    # upper_bound_ev = enterprise_value + error_margin
-    # print(f"The Enterprise Value is {enterprise_value} (Range: {lower_bound_ev} to {upper_bound_ev})")
-
-
-    ### Calculate Equity Value ###
-    cash_and_cash_equivalents = None
-    try:
-        cash_and_cash_equivalents = balance_sheet.at['Cash Cash Equivalents And Short Term Investments', balance_sheet.columns[0]] / 1000000
-        time.sleep(0.05)
-    except Exception as e:
-        if os.path.exists(filepath):
-            cash_and_equivalents = get_first_numeric_value(dfs, 1, 'Cash & Equivalents')
-            short_term_investments = get_first_numeric_value(dfs, 1, 'Short-TermInvestments')
-            if (cash_and_equivalents is not None) and (short_term_investments is not None):
-                cash_and_cash_equivalents = cash_and_equivalents + short_term_investments
-            elif cash_and_equivalents is not None:
-                cash_and_cash_equivalents = cash_and_equivalents
-            else:
-                raise Exception("Missing cash and cash equivalents data")
-        else:
-            raise Exception("Missing cash and cash equivalents data")
-    time.sleep(0.05)
+    tax_rate = resolver.value('tax_rate')
+    if tax_rate is None:
+        raise Exception("Missing tax rate")
 
-    if cash_and_cash_equivalents is None or math.isnan(cash_and_cash_equivalents):
+    ### Cash and Cash Equivalents ###
+    cash_and_cash_equivalents = resolver.value('cash_and_cash_equivalents')
+    if cash_and_cash_equivalents is None:
         raise Exception("Missing cash and cash equivalents data")
 
-    equity_value = enterprise_value + cash_and_cash_equivalents - total_debt
-    print(f"The Equity Value is {equity_value}")
-
-    ### Intrinsic Value Calculation ###
-    intrinsic_value_per_share = equity_value / shares_outstanding
-    lower_bound_iv = intrinsic_value_per_share - error_margin
-    upper_bound_iv = intrinsic_value_per_share + error_margin
-
-    print(f"The intrinsic value of {symbol} is {intrinsic_value_per_share} (Range: {lower_bound_iv} to {upper_bound_iv})\n")
-
-    workbook = openpyxl.load_workbook('valuation.xlsx')
-    worksheet = workbook.active
-    next_row = worksheet.max_row + 1
-
-    worksheet.cell(row=next_row, column=1, value=exchange_ticker)
-    worksheet.cell(row=next_row, column=2, value=percentage_error_margin)
-    cell = worksheet.cell(row=next_row, column=2)
-    cell.number_format = '0.00%'
-    # worksheet.cell(row=next_row, column=2, value=error_margin)
-    worksheet.cell(row=next_row, column=3, value=intrinsic_value_per_share) 
-    if stock_price is not None:
-        worksheet.cell(row=next_row, column=4, value=stock_price)
-    if (stock_price is not None) and (intrinsic_value_per_share is not None):
-        percentage_change = ((intrinsic_value_per_share - stock_price) / stock_price)
-        cell = worksheet.cell(row=next_row, column=5, value=percentage_change)
-        cell.number_format = '0.00%'
-    if negative_revenues:
-        worksheet.cell(row=next_row, column=6, value='DCF (Negative Revenues)')
-    else:
-        worksheet.cell(row=next_row, column=6, value='DCF')
-    worksheet.cell(row=next_row, column=7, value=wacc)
-    worksheet.cell(row=next_row, column=8, value=enterprise_value)
-    worksheet.cell(row=next_row, column=9, value=equity_value)
-    worksheet.cell(row=next_row, column=10, value=terminal_value)
-    worksheet.cell(row=next_row, column=11, value=discounted_terminal_value)
-    discounted_FCFF_str = ", ".join(map(str, discounted_FCFF.tolist()))
-    worksheet.cell(row=next_row, column=12, value=discounted_FCFF_str)
-
-    workbook.save('valuation.xlsx')
-    with open('processed.log', 'a') as f:
-        f.write(symbol + '\n')
-
-    return intrinsic_value_per_share
\ No newline at end of file
+    return DCFInputs(symbol, tuple(past_revenues.dropna()), average_ocf_margin, average_capex_margin, market_cap, shares_outstanding,
+                     total_debt, interest_expense, tax_rate, cash_and_cash_equivalents, COST_OF_EQUITY, DCF_GROWTH_RATE)
+
+
+def dcf(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_sorted, \
+        dfs, COST_OF_EQUITY, DCF_GROWTH_RATE, NUMBER_OF_YEARS, exchange_ticker, info, filepath):
+    with recorder.span('valuation'):
+        inputs = dcf_inputs(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_sorted, dfs, COST_OF_EQUITY,
+                            DCF_GROWTH_RATE, NUMBER_OF_YEARS, info, filepath)
+        result = value_dcf(inputs)
+    return record_dcf(symbol, exchange_ticker, stock_price, inputs, result)
+
+
+# Prints a DCFResult and the margins it was computed from, and writes its result row. dcf_inputs() and value_dcf()
+# print nothing themselves, so valuing on the web server or a Celery worker stays quiet.
+def record_dcf(symbol, exchange_ticker, stock_price, inputs, result):
+    print(f'Average ocf margin is: {inputs.average_ocf_margin}.')
+    print(f'Average capex margin is: {inputs.average_capex_margin}.')
+    print(f"The WACC is {result.wacc}")
+    print(f'Error margin for {"exponential smoothing" if result.model == DCF_NEGATIVE_REVENUES else "linear regression"}: {result.percentage_error_margin}')
+    print(f"The projected free cash flows are:\n{result.projected_fcff}")
+    print(f"The Terminal Value is {result.terminal_value}")
+    print(f"The Discounted Terminal Value is {result.discounted_terminal_value}")
+    print(f"The Equity Value is {result.equity_value}")
+    print(f"The intrinsic value of {symbol} is {result.value} (Range: {result.value - result.error_margin} to {result.value + result.error_margin})\n")
+
+    sink.write(result_row(exchange_ticker, result.value, stock_price, result.model, result.percentage_error_margin,
+                          wacc=result.wacc, enterprise_value=result.enterprise_value, equity_value=result.equity_value,
+                          terminal_value=result.terminal_value, discounted_terminal_value=result.discounted_terminal_value,
+                          discounted_cash_flows=", ".join(map(str, result.discounted_fcff.tolist()))))
+
+    return result.value
@@ -0,0 +1,176 @@
+import numpy as np
+
+### DEFINITIONS & ASSUMPTIONS ###
+FORECAST_YEARS = 5          # Revenue projection period used by dcf()
+VALIDATION_YEARS = 2        # Most recent years held out to measure the forecast error
+SES_GRID = np.linspace(0.005, 0.995, 87)    # Smoothing levels tried before refining, the grid statsmodels' brute start uses
+SES_REFINE_POINTS = 9                       # Points per refinement round, each round narrows the bracket 4x
+SES_REFINE_ROUNDS = 14                      # Rounds around the best grid point, down to ~1e-10 in alpha
+
+
+def as_column(values, n):
+    # Broadcasts a scalar or length-N input to a float array of length N
+    return np.broadcast_to(np.asarray(values, dtype=float), (n,)).copy()
+
+
+def average_margin(values, revenues):
+    # Row-wise mean of values / revenues over the years both are reported, e.g. the average OCF margin
+    values = np.asarray(values, dtype=float)
+    revenues = np.asarray(revenues, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nanmean(values / revenues, axis=1)
+
+
+def linear_forecasts(revenues, horizon=FORECAST_YEARS, validation=VALIDATION_YEARS):
+    # Ordinary least squares on every row at once, equivalent to fitting dcf()'s LinearRegression per ticker.
+    # revenues is N x T, oldest year first and right-aligned: shorter histories are NaN padded on the left.
+    # Each row is fitted on all but its last `validation` years, with years numbered 1..n like dcf().
+    revenues = np.asarray(revenues, dtype=float)
+    N, T = revenues.shape
+    valid = ~np.isnan(revenues)
+    n = valid.sum(axis=1)
+    x = np.arange(1, T + 1)[None, :] - (T - n)[:, None]
+    train = valid & (x <= (n - validation)[:, None])
+
+    k = train.sum(axis=1)
+    xs = np.where(train, x, 0.0)
+    ys = np.where(train, revenues, 0.0)
+    sum_x, sum_y = xs.sum(axis=1), ys.sum(axis=1)
+    sum_xx, sum_xy = (xs * xs).sum(axis=1), (xs * ys).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = k * sum_xx - sum_x * sum_x
+        slope = np.where(denominator != 0, (k * sum_xy - sum_x * sum_y) / denominator, 0.0)
+        intercept = (sum_y - slope * sum_x) / k
+
+    validation_x = (n - validation + 1)[:, None] + np.arange(validation)[None, :]
+    validation_data = revenues[:, T - validation:]
+    validation_forecasts = intercept[:, None] + slope[:, None] * validation_x
+    error_margin = np.mean(np.abs(validation_data - validation_forecasts), axis=1)
+
+    forecast_x = (n + 1)[:, None] + np.arange(horizon)[None, :]
+    forecasts = intercept[:, None] + slope[:, None] * forecast_x
+    return forecasts, error_margin, validation_data
+
+
+def right_align(values):
+    # Moves each row's reported values to the right end in their original order, NaN padding on the left
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(~np.isnan(values), axis=1, kind='stable')
+    return np.take_along_axis(values, order, axis=1)
+
+
+def ses_recursion(series, alpha, fitted=False):
+    # Simple exponential smoothing of every row of series (N x T, right-aligned) for every smoothing level in alpha (N x G).
+    # The level starts at the first observation, as in statsmodels' SimpleExpSmoothing(...).fit().
+    # Returns the sum of squared one-step errors and the final level (both N x G), plus the one-step predictions
+    # (N x G x T) when fitted is set.
+    T = series.shape[1]
+    level = np.full(alpha.shape, np.nan)
+    sse = np.zeros(alpha.shape)
+    predictions = np.full(alpha.shape + (T,), np.nan) if fitted else None
+    for t in range(T):
+        observed = series[:, t][:, None]
+        prediction = np.where(np.isnan(level), observed, level)        # The first observation predicts itself
+        if fitted:
+            predictions[..., t] = prediction
+        sse += np.where(np.isnan(observed), 0.0, (observed - prediction) ** 2)
+        level = np.where(np.isnan(observed), level, alpha * observed + (1 - alpha) * prediction)
+    return sse, level, predictions
+
+
+def smoothing_forecasts(revenues, horizon=FORECAST_YEARS, validation=VALIDATION_YEARS):
+    # SES fitted on every row at once, the fallback for series whose linear forecast goes negative.
+    # The smoothing level minimising the squared one-step errors is found on SES_GRID, refined on finer grids around
+    # the best point and checked against the 0 and 1 bounds, matching what statsmodels' optimiser converges to.
+    # Like linear_forecasts() it returns (forecasts N x horizon, error_margin N, validation_data N x validation);
+    # the error is the MAE of the in-sample one-step predictions over the last `validation` years.
+    # Rows with fewer than two values come back as NaN.
+    series = right_align(revenues)
+    N, T = series.shape
+    sse, _, _ = ses_recursion(series, np.broadcast_to(SES_GRID, (N, len(SES_GRID))))
+    best = SES_GRID[np.argmin(sse, axis=1)]
+
+    step = SES_GRID[1] - SES_GRID[0]
+    offsets = np.linspace(-1, 1, SES_REFINE_POINTS)[None, :]
+    for _ in range(SES_REFINE_ROUNDS):
+        points = np.clip(best[:, None] + step * offsets, 0.0, 1.0)
+        sse, _, _ = ses_recursion(series, points)
+        best = points[np.arange(N), np.argmin(sse, axis=1)]
+        step *= 2 / (SES_REFINE_POINTS - 1)
+
+    # The error can also bottom out at a bound beyond the grid, as the optimiser finds: keep whichever of the three is lowest
+    candidates = np.stack([best, np.zeros(N), np.ones(N)], axis=1)
+    sse, _, _ = ses_recursion(series, candidates)
+    alpha = candidates[np.arange(N), np.argmin(sse, axis=1)]
+
+    _, level, predictions = ses_recursion(series, alpha[:, None], fitted=True)
+    validation_data = series[:, T - validation:]
+    error_margin = np.mean(np.abs(validation_data - predictions[:, 0, T - validation:]), axis=1)
+    forecasts = np.repeat(level, horizon, axis=1)
+
+    too_short = (~np.isnan(series)).sum(axis=1) < 2
+    forecasts[too_short], error_margin[too_short] = np.nan, np.nan
+    return forecasts, error_margin, validation_data
+
+
+def smoothing_forecast(revenues, horizon=FORECAST_YEARS, validation=VALIDATION_YEARS):
+    # dcf()'s fallback for a single series whose linear forecast goes negative
+    forecasts, error_margin, validation_data = smoothing_forecasts(np.asarray(revenues, dtype=float)[None, :], horizon, validation)
+    if np.isnan(error_margin[0]):
+        raise Exception("Not enough revenue data for exponential smoothing")
+    return forecasts[0], error_margin[0], validation_data[0]
+
+
+def dcf_batch(revenues, ocf_margin, capex_margin, market_cap, total_debt, interest_expense, tax_rate,
+              cost_of_equity, cash_and_cash_equivalents, shares_outstanding, growth_rate, horizon=FORECAST_YEARS):
+    # Values N tickers with the same model as dcf(). Every argument after revenues is a length-N array or a scalar
+    # shared by all rows; monetary inputs are in millions. Rows with unusable inputs come back as NaN.
+    revenues = np.asarray(revenues, dtype=float)
+    N = revenues.shape[0]
+    ocf_margin, capex_margin = as_column(ocf_margin, N), as_column(capex_margin, N)
+    market_cap, total_debt = as_column(market_cap, N), as_column(total_debt, N)
+    interest_expense, tax_rate = as_column(interest_expense, N), as_column(tax_rate, N)
+    cost_of_equity, growth_rate = as_column(cost_of_equity, N), as_column(growth_rate, N)
+    cash_and_cash_equivalents, shares_outstanding = as_column(cash_and_cash_equivalents, N), as_column(shares_outstanding, N)
+
+    ### Forecasting Revenue ###
+    forecasts, error_margin, validation_data = linear_forecasts(revenues, horizon)
+    negative_revenues = (forecasts < 0).any(axis=1)
+    if negative_revenues.any():
+        forecasts[negative_revenues], error_margin[negative_revenues], validation_data[negative_revenues] = \
+            smoothing_forecasts(revenues[negative_revenues], horizon)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage_error_margin = error_margin / validation_data.mean(axis=1)
+
+        ### Discount Rate (WACC) ###
+        debt_weight = total_debt / (market_cap + total_debt)
+        equity_weight = 1 - debt_weight
+        cost_of_debt = interest_expense / total_debt
+        wacc = debt_weight * cost_of_debt * (1 - tax_rate) + equity_weight * cost_of_equity
+
+        ### Free Cash Flow to Firm, Terminal Value and Enterprise Value ###
+        projected_fcff = forecasts * (ocf_margin - capex_margin)[:, None]
+        discounted_fcff = projected_fcff / (1 + wacc)[:, None] ** np.arange(1, horizon + 1)[None, :]
+        terminal_value = projected_fcff[:, -1] * (1 + growth_rate) / (wacc - growth_rate)
+        discounted_terminal_value = terminal_value / (1 + wacc) ** horizon
+        enterprise_value = discounted_fcff.sum(axis=1) + discounted_terminal_value
+
+        ### Equity Value and Intrinsic Value ###
+        equity_value = enterprise_value + cash_and_cash_equivalents - total_debt
+        intrinsic_value_per_share = equity_value / shares_outstanding
+
+    return {
+        'predicted_revenues': forecasts,
+        'negative_revenues': negative_revenues,
+        'error_margin': error_margin,
+        'percentage_error_margin': percentage_error_margin,
+        'wacc': wacc,
+        'projected_fcff': projected_fcff,
+        'discounted_fcff': discounted_fcff,
+        'terminal_value': terminal_value,
+        'discounted_terminal_value': discounted_terminal_value,
+        'enterprise_value': enterprise_value,
+        'equity_value': equity_value,
+        'intrinsic_value_per_share': intrinsic_value_per_share,
+    }
@@ -0,0 +1,54 @@
+import numpy as np
+
+from dcf_batch import as_column, linear_forecasts
+
+
+def erm_batch(book_value_per_share, roe, cost_of_equity, stable_roe, retained_earnings, shares_outstanding,
+              high_growth_period, stable_growth_rate, horizon=None):
+    # Values N financial firms with the same Excess Returns Model as erm().
+    # retained_earnings is N x T (millions, oldest first, NaN padded on the left for shorter histories);
+    # every other argument is a length-N array or a scalar shared by all rows.
+    # Retained earnings are forecast over horizon years, the longest high growth period by default.
+    retained_earnings = np.asarray(retained_earnings, dtype=float)
+    N = retained_earnings.shape[0]
+    book_value_per_share, roe = as_column(book_value_per_share, N), as_column(roe, N)
+    cost_of_equity, stable_roe = as_column(cost_of_equity, N), as_column(stable_roe, N)
+    shares_outstanding, stable_growth_rate = as_column(shares_outstanding, N), as_column(stable_growth_rate, N)
+    high_growth_period = np.broadcast_to(np.asarray(high_growth_period, dtype=int), (N,))
+    max_period = int(high_growth_period.max())
+
+    ### Forecasting Retained Earnings ###
+    forecasted_retained_earnings, error_margin, validation_data = linear_forecasts(retained_earnings, max(horizon or 0, max_period))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage_error_margin = error_margin / validation_data.mean(axis=1)
+
+    ### Stage 1: High Growth Period ###
+    # Book value per share entering year t is the starting value plus the retained earnings of years 1..t-1
+    years = np.arange(1, max_period + 1)[None, :]
+    in_period = years <= high_growth_period[:, None]
+    retained_per_share = np.where(in_period, forecasted_retained_earnings[:, :max_period] / shares_outstanding[:, None], 0.0)
+    opening_book_value = book_value_per_share[:, None] + np.cumsum(retained_per_share, axis=1) - retained_per_share
+
+    excess_returns = opening_book_value * ((roe - cost_of_equity) * (1 + stable_growth_rate))[:, None]
+    discounted_excess_returns = np.where(in_period, excess_returns / (1 + cost_of_equity)[:, None] ** years, np.nan)
+    final_book_value = book_value_per_share + retained_per_share.sum(axis=1)
+
+    ### Stage 2: Stable Growth Period ###
+    terminal_year_excess_return = final_book_value * (stable_roe - cost_of_equity)
+    excess_returns_terminal_stage = terminal_year_excess_return * (cost_of_equity - stable_growth_rate)
+    discounted_excess_return_terminal_stage = excess_returns_terminal_stage / (1 + cost_of_equity) ** high_growth_period
+
+    estimated_value = np.nansum(discounted_excess_returns, axis=1) + discounted_excess_return_terminal_stage + final_book_value
+
+    return {
+        'forecasted_retained_earnings': forecasted_retained_earnings,
+        'error_margin': error_margin,
+        'percentage_error_margin': percentage_error_margin,
+        'excess_returns': np.where(in_period, excess_returns, np.nan),
+        'discounted_excess_returns': discounted_excess_returns,
+        'book_value_equity_per_share': final_book_value,
+        'terminal_year_excess_return': terminal_year_excess_return,
+        'excess_returns_terminal_stage': excess_returns_terminal_stage,
+        'discounted_excess_return_terminal_stage': discounted_excess_return_terminal_stage,
+        'estimated_value': estimated_value,
+    }
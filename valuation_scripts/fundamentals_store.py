@@ -0,0 +1,140 @@
+import datetime as dt
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+from market_data import client
+
+### DEFINITIONS & ASSUMPTIONS ###
+FUNDAMENTALS_DB = os.environ.get('FUNDAMENTALS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fundamentals.sqlite3'))
+STATEMENTS_MAX_AGE_DAYS = float(os.environ.get('STATEMENTS_MAX_AGE_DAYS', 30))     # Annual statements only change a few times a year
+INFO_MAX_AGE_DAYS = float(os.environ.get('INFO_MAX_AGE_DAYS', 1))                  # Shares outstanding, EBITDA, yields, previous close
+STATEMENT_VERSIONS = int(os.environ.get('STATEMENT_VERSIONS', 5))                   # Versions kept per statement, older ones are pruned
+INFO_VERSIONS = 1                                                                   # info changes daily with the price, only the latest is kept
+
+STATEMENT_KINDS = ('balance_sheet', 'income_stmt', 'cashflow', 'financials')
+INFO_KIND = 'info'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    symbol TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    as_of TEXT,
+    fetched_at REAL NOT NULL,
+    checksum TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (symbol, kind, version)
+)
+"""
+
+
+def statement_as_of(df):
+    # Date of the most recent fiscal period column, None for an empty statement
+    try:
+        return str(max(df.columns).date())
+    except Exception:
+        return None
+
+
+class FundamentalsStore:
+    # Versioned per-ticker copies of the yfinance statements and info dict.
+    # A refresh that returns identical data only touches fetched_at; changed data becomes a new version and the
+    # oldest versions beyond statement_versions (INFO_VERSIONS for info) are pruned.
+    def __init__(self, path=FUNDAMENTALS_DB, statements_max_age_days=STATEMENTS_MAX_AGE_DAYS,
+                 info_max_age_days=INFO_MAX_AGE_DAYS, statement_versions=STATEMENT_VERSIONS, client=client, clock=time.time):
+        self.path = path
+        self.max_age = {kind: statements_max_age_days * 86400 for kind in STATEMENT_KINDS}
+        self.max_age[INFO_KIND] = info_max_age_days * 86400
+        self.keep = {kind: statement_versions for kind in STATEMENT_KINDS}
+        self.keep[INFO_KIND] = INFO_VERSIONS
+        self.client = client
+        self.clock = clock
+        self.created = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self.created:
+            # Once per store, on first use so importing the module never touches the file; WAL mode persists in the file
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+            self.created = True
+        return conn
+
+    def latest(self, symbol):
+        # {kind: (data, as_of, fetched_at)} for the newest version of every stored kind
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT kind, data, as_of, fetched_at FROM snapshots s WHERE symbol = ? AND version = '
+                '(SELECT MAX(version) FROM snapshots WHERE symbol = s.symbol AND kind = s.kind)', (symbol,)).fetchall()
+        return {kind: (pickle.loads(data), as_of, fetched_at) for kind, data, as_of, fetched_at in rows}
+
+    def versions(self, symbol, kind):
+        with self._connect() as conn:
+            return conn.execute('SELECT version, as_of, fetched_at FROM snapshots WHERE symbol = ? AND kind = ? ORDER BY version',
+                                (symbol, kind)).fetchall()
+
+    def save(self, symbol, kind, data, as_of=None):
+        blob = pickle.dumps(data)
+        checksum = hashlib.sha1(blob).hexdigest()
+        now = self.clock()
+        with self._connect() as conn:
+            row = conn.execute('SELECT version, checksum FROM snapshots WHERE symbol = ? AND kind = ? ORDER BY version DESC LIMIT 1',
+                               (symbol, kind)).fetchone()
+            if row is not None and row[1] == checksum:
+                conn.execute('UPDATE snapshots SET fetched_at = ? WHERE symbol = ? AND kind = ? AND version = ?', (now, symbol, kind, row[0]))
+                return row[0]
+            version = row[0] + 1 if row is not None else 1
+            conn.execute('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', (symbol, kind, version, as_of, now, checksum, blob))
+            conn.execute('DELETE FROM snapshots WHERE symbol = ? AND kind = ? AND version <= ?', (symbol, kind, version - self.keep[kind]))
+            return version
+
+    def statement_status(self, symbols):
+        # {symbol: (as_of, stale)} for the stored statements, without unpickling them. Symbols never stored are left out.
+        placeholders = ', '.join('?' * len(symbols))
+        with self._connect() as conn:
+            rows = conn.execute(
+                f'SELECT symbol, kind, as_of, fetched_at FROM snapshots s WHERE symbol IN ({placeholders}) AND kind IN '
+                f'({", ".join("?" * len(STATEMENT_KINDS))}) AND version = '
+                '(SELECT MAX(version) FROM snapshots WHERE symbol = s.symbol AND kind = s.kind)',
+                list(symbols) + list(STATEMENT_KINDS)).fetchall()
+        snapshots = {}
+        for symbol, kind, as_of, fetched_at in rows:
+            snapshots.setdefault(symbol, {})[kind] = (None, as_of, fetched_at)
+        return {symbol: (max((value[1] for value in snapshot.values() if value[1]), default=None),
+                         any(self.is_stale(snapshot, kind) for kind in STATEMENT_KINDS))
+                for symbol, snapshot in snapshots.items()}
+
+    def is_stale(self, snapshot, kind):
+        return kind not in snapshot or self.clock() - snapshot[kind][2] > self.max_age[kind]
+
+    def refresh(self, symbol, kinds=STATEMENT_KINDS + (INFO_KIND,)):
+        if any(kind in STATEMENT_KINDS for kind in kinds):
+            for kind, df in self.client.statements(symbol).items():
+                self.save(symbol, kind, df, statement_as_of(df))
+        if INFO_KIND in kinds:
+            self.save(symbol, INFO_KIND, dict(self.client.info(symbol)), str(dt.date.today()))
+
+    def get(self, symbol, refresh=False):
+        # Statements and info for a symbol, hitting Yahoo only for kinds that are missing or past their max age.
+        # Falls back to the stored copy when the refresh fails.
+        snapshot = self.latest(symbol)
+        stale = [kind for kind in STATEMENT_KINDS + (INFO_KIND,) if refresh or self.is_stale(snapshot, kind)]
+        if stale:
+            try:
+                self.refresh(symbol, stale)
+                snapshot = self.latest(symbol)
+            except Exception as e:
+                if not snapshot:
+                    raise
+                print(f"Refreshing fundamentals for {symbol} failed, using stored copy: {e}")
+
+        fundamentals = {kind: value[0] for kind, value in snapshot.items()}
+        fundamentals.setdefault(INFO_KIND, {})
+        fundamentals['as_of'] = max((value[1] for kind, value in snapshot.items() if kind in STATEMENT_KINDS and value[1]), default=None)
+        return fundamentals
+
+
+store = FundamentalsStore()
@@ -0,0 +1,100 @@
+import os
+import re
+import sqlite3
+import time
+
+### DEFINITIONS & ASSUMPTIONS ###
+VALUATION_JOURNAL = os.environ.get('VALUATION_JOURNAL', 'journal.sqlite3')     # Kept next to valuation.xlsx in the working directory
+
+RESUME = 'resume'                   # Skip every ticker that already has an outcome
+RETRY_FAILURES = 'retry-failures'   # Only rerun tickers whose last attempt failed
+ALL = 'all'                         # Value everything again
+MODES = (RESUME, RETRY_FAILURES, ALL)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outcomes (
+    symbol TEXT PRIMARY KEY,
+    exchange_ticker TEXT,
+    status TEXT NOT NULL,
+    model TEXT,
+    reason TEXT,
+    seconds REAL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    updated_at REAL NOT NULL
+)
+"""
+
+# Symbol in the free-text lines main.py used to write to missing_data.log, e.g. 'DCF not applicable for AAPL due to: ...'
+LEGACY_MISSING_DATA = re.compile(r' for (\S+?)(?: |due to)')
+
+
+def symbol_of(exchange_ticker):
+    return exchange_ticker.split(':')[1].strip().upper()
+
+
+class RunJournal:
+    # Last outcome per symbol, read once into memory and written through to SQLite as results come in.
+    # Only the process collecting results (main.run / runner.run_parallel) writes to it.
+    def __init__(self, path=VALUATION_JOURNAL, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(SCHEMA)
+        self.outcomes = {row[0]: dict(zip(('symbol', 'exchange_ticker', 'status', 'model', 'reason', 'seconds', 'attempts'), row))
+                         for row in self.conn.execute('SELECT symbol, exchange_ticker, status, model, reason, seconds, attempts FROM outcomes')}
+
+    def record(self, outcome):
+        symbol = symbol_of(outcome['exchange_ticker'])
+        previous = self.outcomes.get(symbol)
+        entry = {
+            'symbol': symbol,
+            'exchange_ticker': outcome['exchange_ticker'],
+            'status': outcome['status'],
+            'model': outcome.get('model'),
+            'reason': outcome.get('reason'),
+            'seconds': outcome.get('seconds'),
+            'attempts': previous['attempts'] + 1 if previous else 1,
+        }
+        self.outcomes[symbol] = entry
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (symbol, entry['exchange_ticker'], entry['status'], entry['model'], entry['reason'],
+                               entry['seconds'], entry['attempts'], self.clock()))
+
+    def status(self, exchange_ticker):
+        outcome = self.outcomes.get(symbol_of(exchange_ticker))
+        return outcome['status'] if outcome else None
+
+    def should_run(self, exchange_ticker, mode=RESUME):
+        try:
+            status = self.status(exchange_ticker)
+        except Exception:
+            return True     # Malformed tickers are left to value_ticker to report
+        if mode == ALL:
+            return True
+        if mode == RETRY_FAILURES:
+            return status == 'failed'
+        return status is None
+
+    def failures(self):
+        return [outcome for outcome in self.outcomes.values() if outcome['status'] == 'failed']
+
+    def import_logs(self, processed_log='processed.log', missing_data_log='missing_data.log'):
+        # One-off migration of the logs written by earlier versions, so an interrupted run keeps its progress
+        imported = 0
+        if os.path.exists(processed_log):
+            for line in open(processed_log):
+                symbol = line.strip()
+                if symbol and symbol not in self.outcomes:
+                    self.record({'exchange_ticker': f':{symbol}', 'status': 'processed'})
+                    imported += 1
+        if os.path.exists(missing_data_log):
+            for line in open(missing_data_log):
+                match = LEGACY_MISSING_DATA.search(line)
+                if match and match.group(1) not in self.outcomes:
+                    self.record({'exchange_ticker': f':{match.group(1)}', 'status': 'failed', 'reason': line.strip()})
+                    imported += 1
+        return imported
+
+    def close(self):
+        self.conn.close()
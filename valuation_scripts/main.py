@@ -1,351 +1,345 @@
-import yfinance as yf
-import pandas as pd
-import numpy as np
-import datetime as dt
+import argparse
+import itertools
 import os
-import openpyxl
 import time
-import math
-from sklearn.linear_model import LinearRegression
-from statsmodels.tsa.holtwinters import SimpleExpSmoothing
 
-from dcf import dcf
-from erm import erm
-from data_functions import get_first_numeric_value, get_first_two_numeric_values
+from dcf import dcf_inputs, record_dcf
+from erm import erm_inputs, record_erm
+from fundamentals_store import store
+from stage import by_model, classify, stage_features
+from valuation import DCF, DCF_GROWTH_RATE, ERM_HIGH_GROWTH, ERM_MATURE, ERM_PERIODS, NUMBER_OF_YEARS, STABLE_GROWTH_RATE, value_dcf, \
+    value_dcf_many, value_erm, value_erm_many
+from journal import MODES, RESUME, VALUATION_JOURNAL, RunJournal
+from pipeline import FETCHERS, PREFETCH, Prefetcher
+from workbook_cache import load_financials
+from results import VALUATION_EXPORT, VALUATION_RESULTS, ResultSink, sink
+from telemetry import VALUATION_TELEMETRY, TelemetryLog, recorder
+from universe import Universe
 
 ### DEFINITIONS & ASSUMPTIONS ###
-NUMBER_OF_YEARS = 10                    # Default historical number of years and DCF projection period
-STABLE_GROWTH_RATE = 4.3/100            # Default stable growth rate for ERM based on US 10 year treasury bond rate
+BATCH_SIZE = int(os.environ.get('VALUATION_BATCH_SIZE', 0))      # Tickers valued together by run(), 0 to value them one at a time
+path = 'C:\\Users\\jakec\\OneDrive - Nanyang Technological University\\Work\\Year 4\\Final Year Project\\FINAL Report\\stockanalysis_all\\'
+ind_fin_const_path = 'C:\\Users\\jakec\\OneDrive - Nanyang Technological University\\Work\\Year 4\\Final Year Project\\\
+                              FINAL Report\\ind_fin_const.xls'
 
-revenue_growth_threshold = 0.2          # Threshold for revenue growth rate
-reinvestment_rate_threshold = 0.5       # Threshold for reinvestment rate
 
-path = 'C:\\Users\\jakec\\OneDrive - Nanyang Technological University\\Work\\Year 4\\Final Year Project\\FINAL Report\\stockanalysis_all\\'
-ind_fin_const = pd.read_excel('C:\\Users\\jakec\\OneDrive - Nanyang Technological University\\Work\\Year 4\\Final Year Project\\\
-                              FINAL Report\\ind_fin_const.xls', sheet_name=0)
+def load_constituents():
+    return Universe.from_excel(ind_fin_const_path)
 
-# Iterate over every row in the ind_fin_const DataFrame
-for exchange_ticker in ind_fin_const['Exchange:Ticker']:
 
-    ### DEFINITIONS & ASSUMPTIONS ###
-    DCF_GROWTH_RATE = 4.3/100      # Default growth rate for DCF based on US 10 year treasury bond rate
-    HIGH_GROWTH_PERIOD = 5          # Default high growth period in years for ERM applied to mature financial firms
-    STABLE_GROWTH_PERIOD = 10       # Default stable growth period in years for ERM applied to mature financial firms
+def result(exchange_ticker, status, model=None, reason=None):
+    # Outcome of one ticker: processed or failed, recorded in the run journal
+    return {'exchange_ticker': exchange_ticker, 'status': status, 'model': model, 'reason': reason}
 
-    print(f"Processing the following ticker: {exchange_ticker}.")
-    time.sleep(0.1)
 
-    processed_symbols = set(line.strip() for line in open('processed.log'))
-    missing_data_symbols = set(line.split(' ')[4] for line in open('missing_data.log'))
+# (average revenue growth, reinvestment rate) used to tell growth from mature firms; raises when the data is missing
+def company_stage(dfs, info, balance_sheet, income_stmt, cash_flow, financials_sorted):
+    stage = classify([stage_features(dfs, info, balance_sheet, income_stmt, cash_flow, financials_sorted)])
+    if stage['stage_error'][0] is not None:
+        raise Exception(stage['stage_error'][0])
+    return stage['average_revenue_growth'][0], stage['reinvestment_rate'][0]
+
+
+# Workbook, yfinance statements and ind_fin_const assumptions of one Exchange:Ticker, given its single-row slice of ind_fin_const.
+# Returns (ticker, None), or (None, failed outcome) when the ticker cannot be valued at all.
+def load_ticker(exchange_ticker, row):
     try:
         symbol = exchange_ticker.split(':')[1].strip().upper()
         file_symbol = exchange_ticker.split(':')[1].strip().lower()
-        ind_fin_const['Industry Group'] = ind_fin_const['Industry Group'].str.strip()        
     except Exception as e:
         print(f"Problem assigning symbols or industry group due to: {e}. Skipping to next symbol.")
-        continue
-    
+        return None, result(exchange_ticker, 'failed', reason=f'Problem assigning symbols: {e}')
+
     filename = f"{file_symbol}-financials.xlsx"
     filepath = os.path.join(path, filename)
 
-    fin_firm = False
-    average_revenue_growth = None
-    reinvestment_rate = None
-
-    if symbol in processed_symbols or symbol in missing_data_symbols:
-            print(f"{symbol} has already been processed or has missing data. Skipping to next symbol.")
-            continue
+    dfs = load_financials(filepath)     # Sheets are parsed (or loaded from the cache) on first use
+    if dfs is not None:
+        print(f"Financial excel located, processing stock file: {filename}...")
     else:
-        if os.path.exists(filepath):
-            xlsx = pd.ExcelFile(filepath)
-            dfs = [pd.read_excel(xlsx, sheet_name=sheet, index_col=0) for sheet in xlsx.sheet_names]
-            print(f"Financial excel located, processing stock file: {filename}...")
-        else:
-            print('No financial excel located, assigning None to xlsx and dfs...')
-            xlsx = None
-            dfs = None
+        print('No financial excel located, assigning None to dfs...')
 
-        try:
-            print(f"Processing the following symbol: {symbol}.")
-            print(f'Exchangeticker is : {exchange_ticker}.')
-            try:
-                stock = yf.Ticker(symbol)
-                balance_sheet = stock.balance_sheet
-                income_stmt = stock.income_stmt
-                cash_flow = stock.cashflow
-                financials = stock.financials.transpose()
-                financials_sorted = financials.sort_index(ascending=False)
-            except Exception as e:
-                print(f"Stock not found for {symbol} from yfinance. Attempting to process with local data...")
-
-            try:
-                stock_price = stock.info['previousClose']
-                time.sleep(0.1)
-            except Exception as e:
-                print(f"Stock price not found for {symbol} from yfinance.")
-                stock_price = None
-
-            row = ind_fin_const[ind_fin_const['Exchange:Ticker'] == exchange_ticker]
+    print(f"Processing the following symbol: {symbol}.")
+    print(f'Exchangeticker is : {exchange_ticker}.')
+    ticker = {'exchange_ticker': exchange_ticker, 'symbol': symbol, 'filepath': filepath, 'dfs': dfs, 'info': {},
+              'balance_sheet': None, 'income_stmt': None, 'cash_flow': None, 'financials_sorted': None,   # Resolved from the workbook alone when yfinance has nothing
+              'stable_roe': None, 'industry_group': None}
+    try:
+        upstream_calls = store.client.thread_calls()      # Prefetch threads fetch concurrently, only count this thread's calls
+        with recorder.span('fetch'):
+            fundamentals = store.get(symbol)
+        fetched = store.client.thread_calls() - upstream_calls
+        recorder.count('upstream_calls', fetched)
+        recorder.count('fundamentals_cache_hits' if not fetched else 'fundamentals_refreshes')
+        ticker['info'] = fundamentals['info']
+        ticker['balance_sheet'] = fundamentals['balance_sheet']
+        ticker['income_stmt'] = fundamentals['income_stmt']
+        ticker['cash_flow'] = fundamentals['cashflow']
+        financials = fundamentals['financials'].transpose()
+        ticker['financials_sorted'] = financials.sort_index(ascending=False)
+    except Exception as e:
+        print(f"Stock not found for {symbol} from yfinance. Attempting to process with local data...")
 
-            if 'Cost Of Equity' in row.columns:
-                COST_OF_EQUITY = row['Cost Of Equity'].values[0]
-                print(f"The cost of equity is {COST_OF_EQUITY}")
-            else:
-                print(f"No Cost of Equity found for {symbol}. Skipping to next file.")      # Cost of Equity is required for both DCF and ERM
-                with open('missing_data.log', 'a') as f:
-                    f.write('Neither model applies for ' + symbol + 'due to missing COE' + '\n')
-                continue
+    try:
+        ticker['stock_price'] = ticker['info']['previousClose']
+    except Exception as e:
+        print(f"Stock price not found for {symbol} from yfinance.")
+        ticker['stock_price'] = None
 
-            if 'Return On Equity' in row.columns:
-                STABLE_ROE = row['Return On Equity'].values[0]      # Stable Return on Equity is required for ERM
-                print(f"The stable ROE is {STABLE_ROE}")
-                financial_firms = ['Bank (Money Center)', 'Banks (Regional)', 'Brokerage & Investment Banking', 'Financial Svcs. (Non-bank & Insurance)', 'Insurance (General)', 'Insurance (Life)', 'Insurance (Prop/Cas.)', 'Investments & Asset Management', 'R.E.I.T.']
-                if row['Industry Group'].values[0] in financial_firms:
-                    fin_firm = True
-                    print(f"The company is a financial firm.")
+    if 'Cost Of Equity' in row.columns:
+        ticker['cost_of_equity'] = row['Cost Of Equity'].values[0]
+        print(f"The cost of equity is {ticker['cost_of_equity']}")
+    else:
+        print(f"No Cost of Equity found for {symbol}. Skipping to next file.")      # Cost of Equity is required for both DCF and ERM
+        return None, result(exchange_ticker, 'failed', reason='missing COE')
+
+    if 'Return On Equity' in row.columns:
+        ticker['stable_roe'] = row['Return On Equity'].values[0]        # Stable Return on Equity is required for ERM
+        ticker['industry_group'] = row['Industry Group'].values[0]      # Financial firms are only told apart when ERM is possible
+        print(f"The stable ROE is {ticker['stable_roe']}")
+    return ticker, None
+
+
+def ticker_features(ticker):
+    return stage_features(ticker['dfs'], ticker['info'], ticker['balance_sheet'], ticker['income_stmt'], ticker['cash_flow'],
+                          ticker['financials_sorted'], ticker['industry_group'])
+
+
+# DCFInputs / ERMInputs of a loaded ticker for the given model, raising when its data is missing
+def model_inputs(ticker, model):
+    if model == DCF:
+        return dcf_inputs(ticker['symbol'], ticker['stock_price'], ticker['balance_sheet'], ticker['income_stmt'], ticker['cash_flow'],
+                          ticker['financials_sorted'], ticker['dfs'], ticker['cost_of_equity'], DCF_GROWTH_RATE, NUMBER_OF_YEARS,
+                          ticker['info'], ticker['filepath'])
+    high_growth_period, stable_growth_period = ERM_PERIODS[model]
+    return erm_inputs(ticker['symbol'], ticker['balance_sheet'], ticker['income_stmt'], ticker['dfs'], ticker['cost_of_equity'],
+                      ticker['stable_roe'], high_growth_period, stable_growth_period, NUMBER_OF_YEARS, ticker['filepath'], ticker['info'],
+                      STABLE_GROWTH_RATE)
+
+
+def report_stage(ticker, stage):
+    if stage['stage_error'] is None:
+        print('Company stage determination successful.')
+        print(f"The average revenue growth is {stage['average_revenue_growth']}.")
+        print(f"The reinvestment rate is {stage['reinvestment_rate']}.")
+    else:
+        print(f"Growth stage determination not possible due to: {stage['stage_error']}\n.")
+    print(f"Financial Firm Status: {stage['fin_firm']}.")
+    print(f"Model for {ticker['symbol']}: {stage['model']}.")
 
 
+# Values one Exchange:Ticker given its single-row slice of ind_fin_const
+def value_ticker(exchange_ticker, row):
+    print(f"Processing the following ticker: {exchange_ticker}.")
+    ticker, failure = load_ticker(exchange_ticker, row)
+    if failure is not None:
+        return failure
+    symbol, stock_price = ticker['symbol'], ticker['stock_price']
 
-            ### Determining Company Stage For Non-Financial Firms ###
-            print('Determining company stage...')
+    try:
+        ### Determining Company Stage and Model ###
+        print('Determining company stage...')
+        with recorder.span('stage'):
+            stage = {name: values[0] for name, values in classify([ticker_features(ticker)]).items()}
+        report_stage(ticker, stage)
+        model = str(stage['model'])
+
+        ### Valuing with the model, non-financial growth firms fall back to DCF ###
+        if model != DCF:
             try:
-                # Revenue Growth Rate
-                if os.path.exists(filepath):
-                    df = pd.read_excel(xlsx, sheet_name=0, index_col=0)
-                    if df.shape[1] > 6:  # Check if there are more than 6 columns
-                        revenue_growth = df.loc['Revenue Growth'][:5]
-                        revenue_growth = pd.to_numeric(revenue_growth, errors='coerce')
-                    else:
-                        print("DataFrame has less than 7 columns")
-                        revenue_growth = df.loc['Revenue Growth']
-                    
-                    average_revenue_growth = revenue_growth.mean()     
-                else:
-                    try:
-                        past_revenues = income_stmt.loc['Total Revenue'][::-1] / 1000000
-                        past_revenues_df = past_revenues.to_frame().sort_index()
-                        past_revenues_df['Growth'] = past_revenues_df['Total Revenue'].pct_change()
-                        average_revenue_growth = past_revenues_df['Growth'].mean()
-                    except Exception as e:
-                        print("No numerical values found in Total Revenue, error traced to: ", str(e))
-                        raise Exception("No numerical values found in Total Revenue")
-
-                if average_revenue_growth is None or math.isnan(average_revenue_growth) or average_revenue_growth == 0:
-                    raise Exception("No numerical values found in Revenue Growth")
-
-
-                # Reinvestment Rate
-                capex = None
-                try:
-                    capex = cash_flow.at['Capital Expenditure', cash_flow.columns[0]] / 1000000
-                    time.sleep(0.1)
-                except Exception as e:
-                    if os.path.exists(filepath):
-                        capex = get_first_numeric_value(dfs, 2, 'Capital Expenditures')
-                        if capex is None:
-                            raise Exception("No numerical values found in Capex")
-                    else:
-                        raise Exception("No numerical values found in Capex")
-                
-                if capex is not None and not math.isnan(capex) and capex != 0:
-                    capex = -capex
-                else:
-                    raise Exception("No numerical values found in Capex")
-
-                ebit = None
-                try:
-                    ebit = income_stmt.at['EBIT', income_stmt.columns[0]] / 1000000
-                    time.sleep(0.1)
-                except Exception as e:
-                    if os.path.exists(filepath):
-                            ebit = get_first_numeric_value(dfs, 8, 'EBIT')
-                    else:
-                        raise Exception("No numerical values found in EBIT")
-                    
-                if ebit is None or math.isnan(ebit) or ebit == 0:
-                    raise Exception("No numerical values found in EBIT")
-                
-                tax_rate = None
-                try:
-                    tax_rate = financials_sorted['Tax Rate For Calcs'].iloc[0]
-                    time.sleep(0.1)
-                    if tax_rate == 0 or math.isnan(tax_rate) or tax_rate is None:
-                        raise Exception("Missing tax rate data")
-                except Exception as e:
-                    try:            
-                        tax_provision = income_stmt.at['Tax Provision', income_stmt[0]] / 1000000       # Income Tax Expense
-                        time.sleep(0.1)
-                        pretax_income = income_stmt.at['Pretax Income', income_stmt[0]] / 1000000
-                        time.sleep(0.1)
-                        if (tax_provision is not None and not math.isnan(tax_provision)) and (pretax_income is not None and not math.isnan(pretax_income)) and (pretax_income != 0 and tax_provision != 0):
-                            tax_rate = tax_provision / pretax_income
-                        else:
-                            raise Exception("Missing tax rate data")
-                    except Exception as e:
-                        if os.path.exists(filepath): 
-                            tax_rate = get_first_numeric_value(dfs, 0, 'Effective Tax Rate')
-                        else:
-                            raise Exception("Missing tax rate data")
-                
-                if tax_rate is None or math.isnan(tax_rate) or tax_rate == 0:
-                    raise Exception("Missing tax rate")
-
-                nopat = ebit * (1 - tax_rate)
-                
-                current_assets = None
-                prev_current_assets = None
-                try:
-                    current_assets = balance_sheet.at['Current Assets', balance_sheet.columns[0]] / 1000000
-                    time.sleep(0.1)
-                    prev_current_assets = balance_sheet.at['Current Assets', balance_sheet.columns[1]] / 1000000
-                    time.sleep(0.1)
-                except Exception as e:
-                    if os.path.exists(filepath):
-                        current_assets, prev_current_assets = get_first_two_numeric_values(dfs, 1, 'Total Current Assets')
-                        if current_assets is None or current_assets == 0 or prev_current_assets is None or prev_current_assets == 0:
-                            cash_and_equivalents, prev_cash_and_equivalents = get_first_two_numeric_values(dfs, 1, 'Cash & Equivalents')
-                            cash_and_equivalents = 0 if cash_and_equivalents is None else cash_and_equivalents
-                            prev_cash_and_equivalents = 0 if prev_cash_and_equivalents is None else prev_cash_and_equivalents
-
-                            receivables, prev_receivables = get_first_two_numeric_values(dfs, 1, 'Receivables')
-                            receivables = 0 if receivables is None else receivables
-                            prev_receivables = 0 if prev_receivables is None else prev_receivables
-
-                            inventory, prev_inventory = get_first_two_numeric_values(dfs, 1, 'Inventory')
-                            inventory = 0 if inventory is None else inventory
-                            prev_inventory = 0 if prev_inventory is None else prev_inventory
-
-                            other_current_assets, prev_other_current_assets = get_first_two_numeric_values(dfs, 1, 'Other Current Assets')
-                            other_current_assets = 0 if other_current_assets is None else other_current_assets
-                            prev_other_current_assets = 0 if prev_other_current_assets is None else prev_other_current_assets
-
-                            current_assets = cash_and_equivalents + receivables + inventory + other_current_assets
-                            prev_current_assets = prev_cash_and_equivalents + prev_receivables + prev_inventory + prev_other_current_assets
-                    else:
-                        raise Exception("No numerical values found in Current Assets")
-                
-                if (current_assets is None) or (prev_current_assets is None):
-                    raise Exception("No numerical values found in Current Assets")
+                with recorder.span('valuation'):
+                    inputs = model_inputs(ticker, model)
+                    valuation = value_erm(inputs)
+                record_erm(symbol, exchange_ticker, stock_price, inputs, valuation)
+                return result(exchange_ticker, 'processed', model=model)
+            except Exception as e:
+                if stage['fin_firm']:
+                    print(f"ERM not applicable for financial firm {symbol} due to: {str(e)}\n")
+                    return result(exchange_ticker, 'failed', model=model, reason=str(e))
+                print(f"ERM not applicable for non-financial firm {symbol} due to: {str(e)}, applying DCF model...")
 
-                current_liabilities = None
-                prev_current_liabilities = None    
+        try:
+            with recorder.span('valuation'):
+                inputs = model_inputs(ticker, DCF)
+                valuation = value_dcf(inputs)
+            record_dcf(symbol, exchange_ticker, stock_price, inputs, valuation)
+            return result(exchange_ticker, 'processed', model=DCF)
+        except Exception as e:
+            print(f"DCF not applicable for non-financial firm {symbol} due to: {str(e)}\n")
+            return result(exchange_ticker, 'failed', model=DCF, reason=str(e))
+
+    except KeyError:
+        print(f"KeyError occurred for: {symbol}. Skipping to next file.")
+        return result(exchange_ticker, 'failed', reason='KeyError')
+    except TypeError:
+        print(f"TypeError occurred for: {symbol}. Skipping to next file.")
+        return result(exchange_ticker, 'failed', reason='TypeError')
+
+
+def value_task(task):
+    # value_ticker() for one (exchange_ticker, row) pair, timed and never raising. The result rows dcf()/erm()
+    # wrote and the ticker's telemetry come back with the outcome so only the collecting process writes files.
+    exchange_ticker, row = task
+    start = time.perf_counter()
+    try:
+        outcome = value_ticker(exchange_ticker, row)
+    except Exception as e:
+        print(f"Valuation crashed for {exchange_ticker} due to: {e}")
+        outcome = result(exchange_ticker, 'failed', reason=str(e))
+    if outcome is None:
+        outcome = result(exchange_ticker, 'failed', reason='No model applied')
+    outcome['seconds'] = time.perf_counter() - start
+    outcome['rows'] = sink.drain()
+    outcome['telemetry'] = recorder.drain()
+    return outcome
+
+
+def value_batch(tasks):
+    # Values a list of (exchange_ticker, row) pairs model by model: every ticker is loaded, then all are classified in one
+    # array pass and each model's tickers go through its batch engine together. Non-financial growth firms whose ERM inputs
+    # are missing fall back to DCF, as in value_ticker(). Returns outcomes like value_task(); the time spent on the shared
+    # passes is split evenly across the loaded tickers.
+    outcomes, loaded = [], []
+    for exchange_ticker, row in tasks:
+        start = time.perf_counter()
+        try:
+            ticker, outcome = load_ticker(exchange_ticker, row)
+        except Exception as e:
+            print(f"Loading {exchange_ticker} failed due to: {e}")
+            ticker, outcome = None, result(exchange_ticker, 'failed', reason=str(e))
+        if ticker is not None:
+            outcome = result(exchange_ticker, 'failed', reason='No model applied')     # Replaced once valued
+            loaded.append((ticker, outcome))
+        outcome.update(seconds=time.perf_counter() - start, rows=[], telemetry=recorder.drain())
+        outcomes.append(outcome)
+    if not loaded:
+        return outcomes
+
+    start = time.perf_counter()
+    with recorder.span('stage'):
+        stages = classify([ticker_features(ticker) for ticker, _ in loaded])
+    groups = {model: [] for model in (ERM_MATURE, ERM_HIGH_GROWTH, DCF)}      # DCF last so ERM fallbacks join it
+    with recorder.span('valuation'):
+        for model, positions in by_model(range(len(loaded)), stages['model']).items():
+            groups[model].extend(positions)
+        for model, positions in groups.items():
+            valued = []
+            for i in positions:
+                ticker, outcome = loaded[i]
                 try:
-                    current_liabilities = balance_sheet.at['Current Liabilities', balance_sheet.columns[0]] / 1000000
-                    time.sleep(0.1)
-                    prev_current_liabilities = balance_sheet.at['Current Liabilities', balance_sheet.columns[1]] / 1000000
-                    time.sleep(0.1)
+                    valued.append((i, model_inputs(ticker, model)))
                 except Exception as e:
-                    if os.path.exists(filepath):
-                        current_liabilities, prev_current_liabilities = get_first_two_numeric_values(dfs, 1, 'Total Current Liabilities')
-                        if current_liabilities is None or current_liabilities == 0 or prev_current_liabilities is None or prev_current_liabilities == 0:
-                            accounts_payable, prev_accounts_payable = get_first_two_numeric_values(dfs, 1, 'Accounts Payable')
-                            accounts_payable = 0 if accounts_payable is None else accounts_payable
-                            prev_accounts_payable = 0 if prev_accounts_payable is None else prev_accounts_payable
-
-                            deferred_revenue, prev_deferred_revenue = get_first_two_numeric_values(dfs, 1, 'Deferred Revenue')
-                            deferred_revenue = 0 if deferred_revenue is None else deferred_revenue
-                            prev_deferred_revenue = 0 if prev_deferred_revenue is None else prev_deferred_revenue
-
-                            current_debt, prev_current_debt = get_first_two_numeric_values(dfs, 1, 'Current Debt')
-                            current_debt = 0 if current_debt is None else current_debt
-                            prev_current_debt = 0 if prev_current_debt is None else prev_current_debt
-
-                            other_current_liabilities, prev_other_current_liabilities = get_first_two_numeric_values(dfs, 1, 'Other Current Liabilities')
-                            other_current_liabilities = 0 if other_current_liabilities is None else other_current_liabilities
-                            prev_other_current_liabilities = 0 if prev_other_current_liabilities is None else prev_other_current_liabilities
-
-                            current_liabilities = accounts_payable + deferred_revenue + current_debt + other_current_liabilities
-                            prev_current_liabilities = prev_accounts_payable + prev_deferred_revenue + prev_current_debt + prev_other_current_liabilities
+                    if model == ERM_HIGH_GROWTH and not stages['fin_firm'][i]:
+                        groups[DCF].append(i)
                     else:
-                        raise Exception("No numerical values found in Current Liabilities")
-                
-                if (current_liabilities is None) or (prev_current_liabilities is None):
-                    raise Exception("No numerical values found in Current Liabilities")
-
-                net_working_capital_diff = current_assets - current_liabilities - prev_current_assets + prev_current_liabilities
-
-                reinvestment_rate = (capex + net_working_capital_diff) / nopat
-                print('Company stage determination successful.')
-                print(f"The average revenue growth is {average_revenue_growth}.")
-                print(f"The reinvestment rate is {reinvestment_rate}.")
-
-            except Exception as e:
-                print(f"Growth stage determination not possible due to: {str(e)}\n.")
-
-            print(f'Financial Firm Status: {fin_firm}.')
-            print(f"Begin model determination for {symbol}.")
-
-
-
-
-            ### Determining model based on company stage and type ###
-            if fin_firm:
-                # Is a financial firm, determine whether the company is in the growth stage or mature stage  
-                if (average_revenue_growth is not None and average_revenue_growth <= revenue_growth_threshold) and (reinvestment_rate is not None and reinvestment_rate <= reinvestment_rate_threshold):
-                    try:
-                        print("The company is a financial firm in the mature stage, applying the ERM for mature firms...")
-                        HIGH_GROWTH_PERIOD = 1
-                        STABLE_GROWTH_PERIOD = 14
-                        erm(symbol, stock_price, balance_sheet, income_stmt, xlsx, dfs, COST_OF_EQUITY, STABLE_ROE, HIGH_GROWTH_PERIOD, STABLE_GROWTH_PERIOD)
-                        continue                  
-                    except Exception as e:
-                        print(f"ERM not applicable for mature stage financial firm {symbol} due to: {str(e)}\n")
-                        with open('missing_data.log', 'a') as f:
-                            f.write('ERM not applicable for ' + symbol + ' due to: ' + str(e) + ' (mature financial firm)\n')
-                        continue
-                else:
-                    try:
-                        print("The company is a financial firm in the growth stage or stage indeterminate, applying the ERM for growing companies...")
-                        
-                        erm(symbol, stock_price, balance_sheet, income_stmt, xlsx, dfs, COST_OF_EQUITY, STABLE_ROE, HIGH_GROWTH_PERIOD, STABLE_GROWTH_PERIOD)
-                        continue
-                    except Exception as e:
-                        print(f"ERM not applicable for growth stage financial firm {symbol} due to: {str(e)}\n")
-                        with open('missing_data.log', 'a') as f:
-                            f.write('ERM not applicable for ' + symbol + ' due to: ' + str(e) + '(growing financial firm)\n')
-                        continue
-
-            # Is not a financial firm, determine whether the company is in the growth stage or mature stage        
-            elif average_revenue_growth is not None and average_revenue_growth > revenue_growth_threshold and reinvestment_rate is not None and reinvestment_rate > reinvestment_rate_threshold:
-                try:
-                    print("The company is not a financial firm and is a growth company, applying the ERM for growing companies...")
-                    erm(symbol, stock_price, balance_sheet, income_stmt, xlsx, dfs, COST_OF_EQUITY, STABLE_ROE, HIGH_GROWTH_PERIOD, STABLE_GROWTH_PERIOD)
-                    continue
-                except Exception as e:
-                    print(f"ERM not applicable for non-financial firm {symbol} due to: {str(e)}, applying DCF model...")
-                    try:
-                        dcf(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_sorted, xlsx, dfs, COST_OF_EQUITY, DCF_GROWTH_RATE)
-                        continue
-                    except Exception as e:
-                        print(f"Both ERM and DCF are not applicable for non-financial firm {symbol} due to: {str(e)}\n")
-                        with open('missing_data.log', 'a') as f:
-                            f.write('ERM/DCF not applicable for ' + symbol + ' due to: ' + str(e) + '(growing non-financial firm)\n')
-                        continue
-    
-            else:
-                print("The company is neither a financial firm nor a growth company, applying DCF model...")
-                try:
-                    dcf(symbol, stock_price, balance_sheet, income_stmt, cash_flow, financials_sorted, xlsx, dfs, COST_OF_EQUITY, DCF_GROWTH_RATE)
+                        outcome.update(result(ticker['exchange_ticker'], 'failed', model=model, reason=str(e)))
+            engine, record = (value_dcf_many, record_dcf) if model == DCF else (value_erm_many, record_erm)
+            for (i, inputs), valuation in zip(valued, engine([inputs for _, inputs in valued])):
+                ticker, outcome = loaded[i]
+                if valuation is None:
+                    outcome.update(result(ticker['exchange_ticker'], 'failed', model=model, reason='Missing predicted revenue data'))
                     continue
-                except Exception as e:
-                    print(f"DCF not applicable for non-financial firm {symbol} due to: {str(e)}\n")
-                    with open('missing_data.log', 'a') as f:
-                        f.write('DCF not applicable for ' + symbol + ' due to: ' + str(e) + '(mature non-financial firm)\n')
-                    continue
-
-
-        except KeyError:
-            print(f"KeyError occurred for: {symbol}. Skipping to next file.")
-            with open('missing_data.log', 'a') as f:
-                f.write('The script failed for ' + symbol + ' due to KeyError\n')
-            continue
-        except TypeError:
-            print(f"TypeError occurred for: {symbol}. Skipping to next file.")
-            with open('missing_data.log', 'a') as f:
-                f.write('The script failed for ' + symbol + ' due to TypeError\n')
-            continue
-        except NameError:
-            print(f"NameError occurred for: {symbol}. Skipping to next file.")
-            with open('missing_data.log', 'a') as f:
-                f.write('The script failed for ' + symbol + ' due to NameError\n')
-            continue
\ No newline at end of file
+                record(ticker['symbol'], ticker['exchange_ticker'], ticker['stock_price'], inputs, valuation)
+                outcome.update(result(ticker['exchange_ticker'], 'processed', model=model), rows=sink.drain())
+
+    share = (time.perf_counter() - start) / len(loaded)
+    shared = recorder.drain()
+    for position, (_, outcome) in enumerate(loaded):
+        outcome['seconds'] += share
+        spans = outcome['telemetry']['spans']
+        for stage, seconds in shared['spans'].items():
+            spans[stage] = spans.get(stage, 0.0) + seconds / len(loaded)
+        if position == 0:
+            outcome['telemetry']['counters'].update(shared['counters'])       # Counted once for the batch
+    return outcomes
+
+
+def pending(universe, journal, mode=RESUME):
+    # (exchange_ticker, row) pairs the journal says still need valuing, and how many were skipped
+    tickers = [exchange_ticker for exchange_ticker in universe.tickers if journal.should_run(exchange_ticker, mode)]
+    return [(exchange_ticker, universe.row(exchange_ticker)) for exchange_ticker in tickers], len(universe) - len(tickers)
+
+
+def collect(outcome, journal, result_sink, telemetry_log=None, prefetched=None):
+    # prefetched: the telemetry Prefetcher's fetch returned for this ticker, added to the one valuing it reported
+    telemetry = outcome.pop('telemetry', {'spans': {}, 'counters': {}})
+    if prefetched is not None:
+        for stage, seconds in prefetched['spans'].items():
+            telemetry['spans'][stage] = telemetry['spans'].get(stage, 0.0) + seconds
+        for name, n in prefetched['counters'].items():
+            telemetry['counters'][name] = telemetry['counters'].get(name, 0) + n
+    start = time.perf_counter()
+    result_sink.write_many(outcome.pop('rows', []))
+    journal.record(outcome)
+    telemetry['spans']['write'] = time.perf_counter() - start
+    if telemetry_log is not None:
+        telemetry_log.write(outcome, telemetry)
+
+
+def finish(result_sink, export, telemetry_log=None):
+    if export:
+        print(f"Exported {result_sink.export_excel(export)} results to {export}.")
+    result_sink.close()
+    if telemetry_log is not None:
+        telemetry_log.print_summary()
+        telemetry_log.close()
+
+
+def batches(tasks, size):
+    tasks = iter(tasks)
+    while batch := list(itertools.islice(tasks, size)):
+        yield batch
+
+
+def run(universe, journal, mode=RESUME, result_sink=None, export=VALUATION_EXPORT, telemetry_log=None, prefetch=PREFETCH,
+        fetchers=FETCHERS, batch_size=BATCH_SIZE):
+    # Values the pending tickers while the next `prefetch` tickers' fundamentals are fetched: one after another, or
+    # batch_size at a time through value_batch() so each model's tickers share one pass of its batch engine
+    result_sink = result_sink or ResultSink()
+    telemetry_log = telemetry_log or TelemetryLog()
+    tasks, skipped = pending(universe, journal, mode)
+    print(f"{skipped} tickers already in the journal, valuing {len(tasks)}.")
+    prefetcher = Prefetcher(tasks, prefetch, fetchers, in_flight=batch_size)      # A batch holds its slots until it is collected
+    try:
+        if batch_size > 0:
+            for batch in batches(prefetcher, batch_size):
+                for outcome in value_batch(batch):
+                    collect(outcome, journal, result_sink, telemetry_log, prefetcher.prefetched(outcome['exchange_ticker']))
+                    prefetcher.release()
+        else:
+            for task in prefetcher:
+                collect(value_task(task), journal, result_sink, telemetry_log, prefetcher.prefetched(task[0]))
+                prefetcher.release()
+    finally:
+        prefetcher.stop()
+        finish(result_sink, export, telemetry_log)
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--mode', choices=MODES, default=RESUME,
+                        help='resume: skip tickers with any outcome; retry-failures: rerun failed tickers only; all: rerun everything')
+    parser.add_argument('--journal', default=VALUATION_JOURNAL)
+    parser.add_argument('--results', default=VALUATION_RESULTS)
+    parser.add_argument('--export', default=VALUATION_EXPORT, help="Excel file written at the end of the run, '' to skip")
+    parser.add_argument('--telemetry', default=VALUATION_TELEMETRY, help="JSON lines file of per-ticker stage timings, '' to skip")
+    parser.add_argument('--prefetch', type=int, default=PREFETCH, help='Tickers whose fundamentals are fetched ahead, 0 to fetch inline')
+    parser.add_argument('--fetchers', type=int, default=FETCHERS, help='Threads fetching fundamentals')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Tickers classified and valued together through the batch engines, 0 to value one at a time')
+    return parser
+
+
+def open_journal(path):
+    journal = RunJournal(path)
+    if not journal.outcomes:
+        imported = journal.import_logs()
+        if imported:
+            print(f"Imported {imported} outcomes from processed.log and missing_data.log.")
+    return journal
+
+
+if __name__ == '__main__':
+    args = argument_parser('Value every ticker in ind_fin_const.').parse_args()
+    run(load_constituents(), open_journal(args.journal), args.mode, ResultSink(args.results), args.export, TelemetryLog(args.telemetry),
+        args.prefetch, args.fetchers, args.batch_size)
@@ -0,0 +1,270 @@
+import abc
+import hashlib
+import os
+import pickle
+import random
+import re
+import threading
+import time
+
+import pandas as pd
+import yfinance as yf
+
+try:
+    # Recent yfinance releases only accept curl_cffi sessions
+    from curl_cffi import requests as session_requests
+    HTTPAdapter = None
+    SESSION_KWARGS = {'impersonate': 'chrome'}
+except ImportError:
+    import requests as session_requests
+    from requests.adapters import HTTPAdapter
+    SESSION_KWARGS = {}
+
+### DEFINITIONS & ASSUMPTIONS ###
+MARKET_DATA_RATE = float(os.environ.get('MARKET_DATA_RATE', 2))        # Sustained upstream requests per second
+MARKET_DATA_BURST = int(os.environ.get('MARKET_DATA_BURST', 5))        # Requests allowed back to back before throttling
+MARKET_DATA_POOL_SIZE = int(os.environ.get('MARKET_DATA_POOL_SIZE', 16))
+MARKET_DATA_PROVIDER = os.environ.get('MARKET_DATA_PROVIDER', 'yfinance')             # yfinance, record or replay
+MARKET_DATA_REPLAY_DIR = os.environ.get('MARKET_DATA_REPLAY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'market_data_recordings'))
+MARKET_DATA_REPLAY_LATENCY = float(os.environ.get('MARKET_DATA_REPLAY_LATENCY', 0))  # Seconds added to every replayed call
+MARKET_DATA_REPLAY_JITTER = float(os.environ.get('MARKET_DATA_REPLAY_JITTER', 0))
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # Blocks until the bucket holds enough tokens, returns the seconds spent waiting
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            self.sleep(delay)
+            waited += delay
+
+
+def new_session(pool_size=MARKET_DATA_POOL_SIZE):
+    session = session_requests.Session(**SESSION_KWARGS)
+    if HTTPAdapter is not None:
+        session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    return session
+
+
+STATEMENT_ATTRIBUTES = {
+    'balance_sheet': 'balance_sheet',
+    'income_stmt': 'income_stmt',
+    'cashflow': 'cashflow',
+    'financials': 'financials',
+}
+STATEMENT_ALIASES = {'financials': 'income_stmt'}      # yfinance's financials is the income statement under another name
+
+
+### Providers ###
+class MarketDataProvider(abc.ABC):
+    # Source of quotes, statements and info. upstream=True means calls cost a real network round trip.
+    upstream = True
+
+    @abc.abstractmethod
+    def history(self, symbol, period="1d"):
+        pass
+
+    @abc.abstractmethod
+    def download(self, symbols, period="1d"):
+        pass
+
+    @abc.abstractmethod
+    def info(self, symbol):
+        pass
+
+    @abc.abstractmethod
+    def statement(self, symbol, kind):
+        pass
+
+    def statements(self, symbol, kinds):
+        # {kind: statement}; providers that can read several statements off one response override this
+        return {kind: self.statement(symbol, kind) for kind in kinds}
+
+
+class YFinanceProvider(MarketDataProvider):
+    def __init__(self, session=None):
+        self.session = session if session is not None else new_session()
+
+    def ticker(self, symbol):
+        return yf.Ticker(symbol, session=self.session)
+
+    def history(self, symbol, period="1d"):
+        return self.ticker(symbol).history(period=period)
+
+    def download(self, symbols, period="1d"):
+        return yf.download(symbols, period=period, progress=False, threads=True, session=self.session)
+
+    def info(self, symbol):
+        return dict(self.ticker(symbol).info)
+
+    def statement(self, symbol, kind):
+        return getattr(self.ticker(symbol), STATEMENT_ATTRIBUTES[kind])
+
+    def statements(self, symbol, kinds):
+        # One Ticker for all kinds, so statements yfinance already holds (financials is income_stmt) are not requested again
+        ticker = self.ticker(symbol)
+        return {kind: getattr(ticker, STATEMENT_ATTRIBUTES[kind]) for kind in kinds}
+
+
+def recording_path(directory, method, *key):
+    name = re.sub(r'[^A-Za-z0-9_.=-]', '_', '-'.join(str(part) for part in key))
+    if len(name) > 120:
+        name = hashlib.sha1(name.encode()).hexdigest()
+    return os.path.join(directory, method, name + '.pkl')
+
+
+class RecordingProvider(MarketDataProvider):
+    # Passes every call through to another provider and keeps a copy of the response for ReplayProvider
+    def __init__(self, directory, provider=None):
+        self.directory = directory
+        self.provider = provider if provider is not None else YFinanceProvider()
+        self.upstream = self.provider.upstream
+
+    def _record(self, value, method, *key):
+        path = recording_path(self.directory, method, *key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            pickle.dump(value, f)
+        return value
+
+    def history(self, symbol, period="1d"):
+        return self._record(self.provider.history(symbol, period), 'history', symbol, period)
+
+    def download(self, symbols, period="1d"):
+        return self._record(self.provider.download(symbols, period), 'download', *sorted(symbols), period)
+
+    def info(self, symbol):
+        return self._record(self.provider.info(symbol), 'info', symbol)
+
+    def statement(self, symbol, kind):
+        return self._record(self.provider.statement(symbol, kind), 'statement', symbol, kind)
+
+    def statements(self, symbol, kinds):
+        return {kind: self._record(df, 'statement', symbol, kind) for kind, df in self.provider.statements(symbol, kinds).items()}
+
+
+class ReplayProvider(MarketDataProvider):
+    # Serves recorded responses from disk, optionally sleeping latency (+ up to jitter) seconds per call
+    # so benchmarks see realistic but repeatable upstream delays. Unrecorded calls raise LookupError.
+    upstream = False
+
+    def __init__(self, directory, latency=0.0, jitter=0.0, seed=0):
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def _load(self, method, *key):
+        if self.latency or self.jitter:
+            with self.lock:
+                delay = self.latency + self.random.uniform(0, self.jitter)
+            time.sleep(delay)
+        path = recording_path(self.directory, method, *key)
+        if not os.path.exists(path):
+            raise LookupError(f"No recording for {method} {key}")
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def history(self, symbol, period="1d"):
+        return self._load('history', symbol, period)
+
+    def download(self, symbols, period="1d"):
+        try:
+            return self._load('download', *sorted(symbols), period)
+        except LookupError:
+            # Batch never recorded as a whole, assemble it from per-symbol histories
+            frames = {}
+            for symbol in symbols:
+                try:
+                    frames[symbol] = self._load('history', symbol, period)
+                except LookupError:
+                    continue
+            if not frames:
+                return pd.DataFrame()
+            return pd.concat(frames, axis=1).swaplevel(axis=1).sort_index(axis=1)
+
+    def info(self, symbol):
+        return self._load('info', symbol)
+
+    def statement(self, symbol, kind):
+        return self._load('statement', symbol, kind)
+
+
+def build_provider(name=MARKET_DATA_PROVIDER, directory=MARKET_DATA_REPLAY_DIR):
+    if name == 'yfinance':
+        return YFinanceProvider()
+    if name == 'record':
+        return RecordingProvider(directory)
+    if name == 'replay':
+        return ReplayProvider(directory, MARKET_DATA_REPLAY_LATENCY, MARKET_DATA_REPLAY_JITTER)
+    raise ValueError(f"Unknown market data provider: {name}")
+
+
+### Client ###
+class MarketDataClient:
+    # Every market data call goes through here so upstream providers share one rate limit.
+    # Reading the returned DataFrames costs nothing, so callers never need to throttle themselves.
+    def __init__(self, provider=None, rate=MARKET_DATA_RATE, burst=MARKET_DATA_BURST):
+        self.provider = provider if provider is not None else build_provider()
+        self.bucket = TokenBucket(rate, burst) if self.provider.upstream else None
+        self.upstream_calls = 0
+        self.throttled_seconds = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _request(self, fetch, *args, calls=1):
+        # calls: upstream requests the fetch makes, each charged to the rate limit. Taken one token at a time, since a
+        # worker's share of the bucket may hold fewer tokens than calls.
+        waited = sum(self.bucket.acquire() for _ in range(calls)) if self.bucket is not None else 0.0
+        with self._lock:
+            self.upstream_calls += calls
+            self.throttled_seconds += waited
+        self._local.calls = self.thread_calls() + calls
+        return fetch(*args)
+
+    def thread_calls(self):
+        # Upstream calls made by the calling thread, so concurrent fetchers each count only their own
+        return getattr(self._local, 'calls', 0)
+
+    def history(self, symbol, period="1d"):
+        return self._request(self.provider.history, symbol, period)
+
+    def download(self, symbols, period="1d"):
+        return self._request(self.provider.download, symbols, period)
+
+    def info(self, symbol):
+        return self._request(self.provider.info, symbol)
+
+    def statements(self, symbol):
+        # Annual balance sheet, income statement, cash flow (one request each) off one provider call, and financials
+        # as the income statement instead of a fourth request for the same data
+        kinds = [kind for kind in STATEMENT_ATTRIBUTES if kind not in STATEMENT_ALIASES]
+        statements = self._request(self.provider.statements, symbol, kinds, calls=len(kinds))
+        for alias, kind in STATEMENT_ALIASES.items():
+            statements[alias] = statements[kind]
+        return statements
+
+    def stats(self):
+        with self._lock:
+            return {'upstream_calls': self.upstream_calls, 'throttled_seconds': self.throttled_seconds}
+
+
+client = MarketDataClient()
@@ -0,0 +1,81 @@
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fundamentals_store import store
+from journal import symbol_of
+
+### DEFINITIONS & ASSUMPTIONS ###
+PREFETCH = int(os.environ.get('VALUATION_PREFETCH', 8))      # Tickers fetched ahead of the ones being valued, 0 to fetch inline
+FETCHERS = int(os.environ.get('VALUATION_FETCHERS', 4))      # Threads fetching fundamentals
+
+
+def warm(exchange_ticker):
+    # Pulls the ticker's fundamentals into the store, so valuing it later only reads SQLite.
+    # Returns the fetch's own telemetry, which the collector adds to the ticker's outcome.
+    calls = store.client.thread_calls()
+    start = time.perf_counter()
+    try:
+        store.get(symbol_of(exchange_ticker))
+    except Exception as e:
+        print(f"Prefetching fundamentals for {exchange_ticker} failed: {e}")       # value_ticker retries and records the failure
+    fetched = store.client.thread_calls() - calls
+    counters = {'upstream_calls': fetched, 'fundamentals_prefetched': 1} if fetched else {}
+    return {'spans': {'prefetch': time.perf_counter() - start}, 'counters': counters}
+
+
+class Prefetcher:
+    # Fetch stage of a run: while earlier tickers are valued, the fundamentals of the next `prefetch` are fetched on
+    # background threads. Tasks come out in their original order once fetched.
+    # Each task takes a slot before its fetch starts and gives it back through release() once its outcome is collected,
+    # so fetched but not yet valued tickers never exceed prefetch + in_flight however slow the compute side is.
+    def __init__(self, tasks, prefetch=PREFETCH, fetchers=FETCHERS, in_flight=0, fetch=warm):
+        self.tasks = tasks
+        self.prefetch = prefetch
+        self.fetchers = fetchers
+        self.fetch = fetch
+        self.slots = threading.Semaphore(prefetch + in_flight)
+        self.stopped = threading.Event()
+        self.telemetry = {}         # exchange_ticker -> what fetch() returned, until the outcome is collected
+
+    def _acquire(self):
+        # Waits for a free slot, giving up once stop() is called so an interrupted pool can shut down
+        while not self.stopped.is_set():
+            if self.slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            yield from self.tasks
+            return
+        window = collections.deque()
+        with ThreadPoolExecutor(self.fetchers) as executor:
+            for task in self.tasks:
+                if not self._acquire():
+                    return
+                window.append((task, executor.submit(self.fetch, task[0])))
+                if len(window) >= self.prefetch:
+                    yield self._next(window)
+            while window:
+                yield self._next(window)
+
+    def _next(self, window):
+        task, future = window.popleft()
+        telemetry = future.result()
+        if telemetry is not None:
+            self.telemetry[task[0]] = telemetry
+        return task
+
+    def prefetched(self, exchange_ticker):
+        # Telemetry of the ticker's prefetch, None when it was fetched inline
+        return self.telemetry.pop(exchange_ticker, None)
+
+    def release(self):
+        if self.prefetch > 0:
+            self.slots.release()
+
+    def stop(self):
+        self.stopped.set()
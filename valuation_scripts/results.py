@@ -0,0 +1,131 @@
+import os
+import sqlite3
+import time
+
+import openpyxl
+
+### DEFINITIONS & ASSUMPTIONS ###
+VALUATION_RESULTS = os.environ.get('VALUATION_RESULTS', 'valuation.sqlite3')     # Kept next to valuation.xlsx in the working directory
+VALUATION_EXPORT = os.environ.get('VALUATION_EXPORT', 'valuation.xlsx')          # Excel export written at the end of a run, '' to skip
+RESULTS_BATCH_SIZE = int(os.environ.get('RESULTS_BATCH_SIZE', 100))              # Rows buffered before a write to SQLite
+
+# Result field -> valuation.xlsx column, in the layout dcf() and erm() have always written
+RESULT_COLUMNS = {
+    'exchange_ticker': 1,
+    'percentage_error_margin': 2,
+    'value': 3,
+    'stock_price': 4,
+    'percentage_change': 5,
+    'model': 6,
+    'wacc': 7,
+    'enterprise_value': 8,
+    'equity_value': 9,
+    'terminal_value': 10,
+    'discounted_terminal_value': 11,
+    'discounted_cash_flows': 12,
+    'excess_returns_terminal_stage': 14,
+    'discounted_excess_return_terminal_stage': 15,
+    'discounted_excess_returns': 16,
+}
+PERCENT_COLUMNS = ('percentage_error_margin', 'percentage_change')
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS results (%s, written_at REAL NOT NULL)' % ', '.join(
+    f'{field} TEXT PRIMARY KEY' if field == 'exchange_ticker' else field for field in RESULT_COLUMNS)
+
+
+def result_row(exchange_ticker, value, stock_price, model, percentage_error_margin, **fields):
+    # One valuation result; fields not given stay empty in the export
+    row = dict.fromkeys(RESULT_COLUMNS)
+    row.update(exchange_ticker=exchange_ticker, value=value, stock_price=stock_price, model=model,
+               percentage_error_margin=percentage_error_margin, **fields)
+    if stock_price is not None and value is not None:
+        row['percentage_change'] = (value - stock_price) / stock_price
+    return row
+
+
+def _cell(value):
+    # numpy scalars become plain floats so SQLite and openpyxl accept them
+    if value is None or isinstance(value, str):
+        return value
+    return float(value)
+
+
+class MemorySink:
+    # Collects the rows written while valuing one ticker so they travel back with its outcome
+    def __init__(self):
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+
+    def drain(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class ResultSink:
+    # Buffers result rows and writes them to SQLite in batches, one row per ticker (a rerun replaces it).
+    # SQLite serialises writers, so several processes can share the file; Excel is only produced by export_excel().
+    def __init__(self, path=VALUATION_RESULTS, batch_size=RESULTS_BATCH_SIZE, clock=time.time):
+        self.path = path
+        self.batch_size = batch_size
+        self.clock = clock
+        self.buffer = []
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(SCHEMA)
+
+    def write(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        now = self.clock()
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO results VALUES (%s)' % ', '.join('?' * (len(RESULT_COLUMNS) + 1)),
+                [[_cell(row.get(field)) for field in RESULT_COLUMNS] + [now] for row in self.buffer])
+        self.buffer = []
+
+    def rows(self):
+        self.flush()
+        cursor = self.conn.execute('SELECT %s FROM results ORDER BY written_at, exchange_ticker' % ', '.join(RESULT_COLUMNS))
+        return [dict(zip(RESULT_COLUMNS, values)) for values in cursor]
+
+    def export_excel(self, path=VALUATION_EXPORT):
+        # Rewrites the data rows below the header in one save; an existing sheet keeps its header and formatting
+        if os.path.exists(path):
+            workbook = openpyxl.load_workbook(path)
+            worksheet = workbook.active
+            if worksheet.max_row > 1:
+                worksheet.delete_rows(2, worksheet.max_row - 1)
+        else:
+            workbook = openpyxl.Workbook()
+            worksheet = workbook.active
+            for field, column in RESULT_COLUMNS.items():
+                worksheet.cell(row=1, column=column, value=field)
+        rows = self.rows()
+        for offset, row in enumerate(rows):
+            for field, column in RESULT_COLUMNS.items():
+                if row[field] is None:
+                    continue
+                cell = worksheet.cell(row=2 + offset, column=column, value=row[field])
+                if field in PERCENT_COLUMNS:
+                    cell.number_format = '0.00%'
+        workbook.save(path)
+        return len(rows)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+# Where dcf() and erm() send their rows; main.value_task() drains it into each outcome
+sink = MemorySink()
@@ -0,0 +1,92 @@
+import collections
+import itertools
+import multiprocessing as mp
+import os
+import time
+
+import market_data
+import main
+
+### DEFINITIONS & ASSUMPTIONS ###
+WORKERS = int(os.environ.get('VALUATION_WORKERS', os.cpu_count() or 1))      # Worker processes valuing tickers
+CHUNK_SIZE = int(os.environ.get('VALUATION_CHUNK_SIZE', 4))                   # Tickers handed to a worker at a time
+PROGRESS_EVERY = int(os.environ.get('VALUATION_PROGRESS_EVERY', 50))          # Print throughput every N tickers
+
+
+def rate_share(shares, share=1):
+    # Token bucket for `share` of `shares` equal slices of the upstream request budget
+    return market_data.TokenBucket(market_data.MARKET_DATA_RATE * share / shares, max(1, market_data.MARKET_DATA_BURST * share // shares))
+
+
+def init_worker(shares):
+    # Every fetcher gets its slice of the upstream request budget so the run as a whole stays within MARKET_DATA_RATE
+    if market_data.client.bucket is not None:
+        market_data.client.bucket = rate_share(shares)
+
+
+def run_parallel(universe, journal, mode=main.RESUME, workers=WORKERS, chunk_size=CHUNK_SIZE, result_sink=None,
+                 export=main.VALUATION_EXPORT, telemetry_log=None, prefetch=main.PREFETCH, fetchers=main.FETCHERS,
+                 batch_size=main.BATCH_SIZE):
+    # Values every pending ticker across a process pool. Outcomes and result rows come back here and only this
+    # process writes the journal and result sink, so interrupting is safe: recorded tickers are skipped when resuming.
+    # With prefetch, this process's fetch threads fill the fundamentals store ahead of the workers; workers then only
+    # hit upstream when a prefetch failed, and the request budget is split across fetch threads and workers.
+    # With batch_size, workers take batch_size tickers at a time through main.value_batch() instead of chunks of single tickers.
+    result_sink = result_sink or main.ResultSink()
+    telemetry_log = telemetry_log or main.TelemetryLog()
+    tasks, skipped = main.pending(universe, journal, mode)
+    results = []
+    counts = collections.Counter(skipped=skipped)
+    total = len(tasks)
+    start = time.perf_counter()
+
+    shares = workers + fetchers if prefetch > 0 else workers
+    if prefetch > 0 and market_data.client.bucket is not None:
+        market_data.client.bucket = rate_share(shares, fetchers)
+    # Enough slots for every worker to hold two chunks on top of the prefetched tickers, so workers never wait on slots
+    prefetcher = main.Prefetcher(tasks, prefetch, fetchers, in_flight=2 * workers * (batch_size or chunk_size))
+    pool = mp.Pool(workers, initializer=init_worker, initargs=(shares,))
+    if batch_size > 0:
+        outcomes = itertools.chain.from_iterable(pool.imap_unordered(main.value_batch, main.batches(prefetcher, batch_size)))
+    else:
+        outcomes = pool.imap_unordered(main.value_task, prefetcher, chunksize=chunk_size)
+    try:
+        for outcome in outcomes:
+            main.collect(outcome, journal, result_sink, telemetry_log, prefetcher.prefetched(outcome['exchange_ticker']))
+            prefetcher.release()
+            results.append(outcome)
+            counts[outcome['status']] += 1
+            if len(results) % PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{len(results)}/{total} tickers done, {len(results) / elapsed:.2f} tickers/sec.")
+        pool.close()
+    except KeyboardInterrupt:
+        print("Interrupted, stopping workers. Rerun to resume from the journal.")
+        pool.terminate()
+        raise
+    except BaseException:
+        pool.terminate()        # join() on a running pool would raise over the real error and leave the workers alive
+        raise
+    finally:
+        prefetcher.stop()
+        pool.join()
+        main.finish(result_sink, export, telemetry_log)
+
+    elapsed = time.perf_counter() - start
+    print(f"Valued {len(results)} tickers in {elapsed:.1f}s ({len(results) / elapsed if elapsed else 0:.2f} tickers/sec) "
+          f"with {workers} workers.")
+    print(f"Processed: {counts['processed']}, skipped: {counts['skipped']}, failed: {counts['failed']}.")
+    reasons = collections.Counter(outcome['reason'] for outcome in results if outcome['status'] == 'failed')
+    for reason, count in reasons.most_common(5):
+        print(f"  {count} failed due to: {reason}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = main.argument_parser('Value every ticker in ind_fin_const across a process pool.')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    run_parallel(main.load_constituents(), main.open_journal(args.journal), args.mode, args.workers, args.chunk_size,
+                 main.ResultSink(args.results), args.export, main.TelemetryLog(args.telemetry), args.prefetch, args.fetchers,
+                 args.batch_size)
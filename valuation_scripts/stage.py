@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+from data_functions import PAIR_SOURCES, FieldResolver, sheet
+from valuation import DCF, ERM_HIGH_GROWTH, ERM_MATURE
+
+### DEFINITIONS & ASSUMPTIONS ###
+revenue_growth_threshold = 0.2          # Threshold for revenue growth rate
+reinvestment_rate_threshold = 0.5       # Threshold for reinvestment rate
+REPORTED_GROWTH_YEARS = 5               # Workbook revenue growth rates averaged when the sheet has the full history
+
+FINANCIAL_FIRMS = ['Bank (Money Center)', 'Banks (Regional)', 'Brokerage & Investment Banking', 'Financial Svcs. (Non-bank & Insurance)',
+                   'Insurance (General)', 'Insurance (Life)', 'Insurance (Prop/Cas.)', 'Investments & Asset Management', 'R.E.I.T.']
+
+# Reinvestment rate inputs in the order they are resolved: (feature, resolver field, error reported when it is missing)
+REINVESTMENT_INPUTS = [
+    ('capex', 'capital_expenditure', "No numerical values found in Capex"),
+    ('ebit', 'ebit', "No numerical values found in EBIT"),
+    ('tax_rate', 'tax_rate', "Missing tax rate"),
+    ('current_assets', 'current_assets', "No numerical values found in Current Assets"),
+    ('current_liabilities', 'current_liabilities', "No numerical values found in Current Liabilities"),
+]
+FEATURE_COLUMNS = ['capex', 'ebit', 'tax_rate', 'current_assets', 'previous_current_assets', 'current_liabilities',
+                   'previous_current_liabilities']
+
+
+### Features ###
+def revenue_growth(dfs, income_stmt):
+    # Yearly revenue growth rates: reported by the workbook, else computed from the yfinance revenues. Empty when neither has them.
+    try:
+        if dfs is not None:
+            df = sheet(dfs, 'income_statement')
+            if df.shape[1] > 6:  # Check if there are more than 6 columns
+                growth = df.loc['Revenue Growth'][:REPORTED_GROWTH_YEARS]
+            else:
+                print("DataFrame has less than 7 columns")
+                growth = df.loc['Revenue Growth']
+            return pd.to_numeric(growth, errors='coerce').to_numpy(dtype=float)
+        past_revenues = (income_stmt.loc['Total Revenue'][::-1] / 1000000).sort_index()
+        return past_revenues.pct_change().to_numpy(dtype=float)
+    except Exception as e:
+        print("No numerical values found in Revenue Growth, error traced to: ", str(e))
+        return np.array([])
+
+
+def stage_features(dfs, info, balance_sheet, income_stmt, cash_flow, financials_sorted, industry_group=None):
+    # The raw figures classify() needs for one ticker, NaN where missing. Like the per-ticker checks it replaces,
+    # resolution stops at the first missing input, so the resolver's telemetry counts what was actually looked up.
+    features = dict.fromkeys(FEATURE_COLUMNS, np.nan)
+    features.update(industry_group=industry_group, revenue_growth=revenue_growth(dfs, income_stmt))
+    growth = features['revenue_growth']
+    if not np.isfinite(growth).any() or np.nanmean(growth) == 0:
+        return features
+
+    resolver = FieldResolver(dfs, info, balance_sheet=balance_sheet, income_stmt=income_stmt, cashflow=cash_flow, financials=financials_sorted)
+    for name, field, _ in REINVESTMENT_INPUTS:
+        if field in PAIR_SOURCES:
+            current, previous = resolver.pair(field)
+            if current is None:
+                return features
+            features[name], features[f'previous_{name}'] = current, previous
+        else:
+            value = resolver.value(field)
+            if value is None:
+                return features
+            features[name] = -value if name == 'capex' else value
+    return features
+
+
+### Classification ###
+def padded(rows):
+    # Variable length rows as an N x T float array, NaN padded on the right
+    T = max((len(row) for row in rows), default=0)
+    matrix = np.full((len(rows), T), np.nan)
+    for i, row in enumerate(rows):
+        matrix[i, :len(row)] = row
+    return matrix
+
+
+def classify(features):
+    # Company stage and model of every ticker in one array pass over a list of stage_features() rows.
+    # Returns arrays in the same order: fin_firm, average_revenue_growth, reinvestment_rate, stage_error (None when
+    # the stage was determined) and model. Kept on plain arrays so classifying a single ticker stays cheap.
+    growth = padded([row['revenue_growth'] for row in features])
+    reported = (~np.isnan(growth)).sum(axis=1)
+    with np.errstate(invalid='ignore'):
+        average_revenue_growth = np.where(reported > 0, np.nansum(growth, axis=1) / np.maximum(reported, 1), np.nan)
+
+    columns = {name: np.array([row[name] for row in features], dtype=float) for name in FEATURE_COLUMNS}
+    nopat = columns['ebit'] * (1 - columns['tax_rate'])
+    net_working_capital_diff = columns['current_assets'] - columns['current_liabilities'] - columns['previous_current_assets'] \
+        + columns['previous_current_liabilities']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reinvestment_rate = (columns['capex'] + net_working_capital_diff) / nopat
+
+    # First reason each ticker's stage is unknown, in the order the inputs are resolved
+    errors = [(np.isnan(average_revenue_growth) | (average_revenue_growth == 0), "No numerical values found in Revenue Growth")]
+    errors += [(np.isnan(columns[name]), message) for name, _, message in REINVESTMENT_INPUTS]
+    errors += [(nopat == 0, "NOPAT is zero")]
+    stage_error = np.select([mask for mask, _ in errors], [message for _, message in errors], default='')
+    known = stage_error == ''
+    average_revenue_growth = np.where(known, average_revenue_growth, np.nan)
+    reinvestment_rate = np.where(known, reinvestment_rate, np.nan)
+
+    # Unknown stages compare False both ways, so they fall to ERM (High-Growth) for financial firms and DCF otherwise
+    fin_firm = np.array([row['industry_group'] in FINANCIAL_FIRMS for row in features], dtype=bool)
+    mature = (average_revenue_growth <= revenue_growth_threshold) & (reinvestment_rate <= reinvestment_rate_threshold)
+    growing = (average_revenue_growth > revenue_growth_threshold) & (reinvestment_rate > reinvestment_rate_threshold)
+    model = np.select([fin_firm & mature, fin_firm | growing], [ERM_MATURE, ERM_HIGH_GROWTH], default=DCF)
+
+    return {'fin_firm': fin_firm, 'average_revenue_growth': average_revenue_growth, 'reinvestment_rate': reinvestment_rate,
+            'stage_error': np.where(known, None, stage_error), 'model': model}
+
+
+def by_model(keys, models):
+    # {model: [keys]} so each model's tickers can be sent to its batch engine together
+    groups = {}
+    for key, model in zip(keys, models):
+        groups.setdefault(str(model), []).append(key)
+    return groups
@@ -0,0 +1,97 @@
+import collections
+import contextlib
+import json
+import os
+import time
+
+import numpy as np
+
+### DEFINITIONS & ASSUMPTIONS ###
+VALUATION_TELEMETRY = os.environ.get('VALUATION_TELEMETRY', 'telemetry.jsonl')   # One JSON line per ticker, '' to skip the file
+
+# Stages a ticker's time is split into: yfinance fundamentals, workbook sheets, stage determination,
+# input resolution and models, revenue / retained earnings forecasting, result and journal writes.
+# 'prefetch' is the fundamentals fetched ahead on a Prefetcher thread, overlapping other tickers' valuation.
+STAGES = ('prefetch', 'fetch', 'excel', 'stage', 'valuation', 'forecast', 'write')
+
+
+class Recorder:
+    # Spans and counters of the ticker being valued in this process, drained into its outcome like the result rows.
+    # Spans nest and only record their own time: a sheet parsed during the stage determination counts as 'excel',
+    # not 'stage', so the spans of a ticker add up to its wall time.
+    def __init__(self):
+        self.spans = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self.stack = []
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        frame = [0.0]           # Time spent in nested spans
+        self.stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+            self.spans[stage] += elapsed - frame[0]
+            if self.stack:
+                self.stack[-1][0] += elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def drain(self):
+        record = {'spans': dict(self.spans), 'counters': dict(self.counters)}
+        self.spans.clear()
+        self.counters.clear()
+        return record
+
+
+recorder = Recorder()
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+class TelemetryLog:
+    # Writes each ticker's spans and counters as a JSON line and keeps them for the end-of-run summary
+    def __init__(self, path=VALUATION_TELEMETRY):
+        self.path = path
+        self.file = open(path, 'a') if path else None
+        self.durations = collections.defaultdict(list)
+        self.counters = collections.Counter()
+        self.tickers = 0
+
+    def write(self, outcome, telemetry):
+        self.tickers += 1
+        for stage, seconds in telemetry['spans'].items():
+            self.durations[stage].append(seconds)
+        self.counters.update(telemetry['counters'])
+        if self.file is not None:
+            line = {'exchange_ticker': outcome['exchange_ticker'], 'status': outcome['status'], 'model': outcome.get('model'),
+                    'seconds': outcome.get('seconds'), 'spans': telemetry['spans'], 'counters': telemetry['counters'],
+                    'logged_at': time.time()}
+            self.file.write(json.dumps(line) + '\n')
+
+    def summary(self):
+        # [(stage, tickers, total seconds, p50, p95)] in pipeline order, stages nobody reached left out
+        stages = [stage for stage in STAGES if stage in self.durations] + sorted(set(self.durations) - set(STAGES))
+        return [(stage, len(self.durations[stage]), sum(self.durations[stage]), percentile(self.durations[stage], 50),
+                 percentile(self.durations[stage], 95)) for stage in stages]
+
+    def print_summary(self):
+        if not self.tickers:
+            return
+        print(f"Stage timings over {self.tickers} tickers:")
+        print(f"  {'stage':<12}{'tickers':>9}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for stage, tickers, total, p50, p95 in self.summary():
+            print(f"  {stage:<12}{tickers:>9}{total:>10.1f}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}")
+        for name, count in sorted(self.counters.items()):
+            print(f"  {name}: {count}")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,701 @@
+import collections
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from statsmodels.tsa.holtwinters import SimpleExpSmoothing
+
+import main
+import runner
+from benchmark import BENCHMARKS, compare, run_benchmarks, statements, synthetic_universe
+from data_functions import FieldResolver, SheetIndex
+from dcf import dcf, dcf_inputs
+from erm import erm_inputs
+from dcf_batch import average_margin, dcf_batch, linear_forecasts, smoothing_forecasts
+from erm import erm
+from erm_batch import erm_batch
+from fundamentals_store import FundamentalsStore
+from journal import ALL, RETRY_FAILURES, RunJournal
+from market_data import MarketDataClient, MarketDataProvider, RecordingProvider, ReplayProvider, TokenBucket, YFinanceProvider
+from pipeline import Prefetcher
+from results import ResultSink, result_row, sink
+from stage import by_model, classify, stage_features
+from telemetry import Recorder, TelemetryLog
+from universe import Universe
+from valuation import DCF, DCF_NEGATIVE_REVENUES, ERM_HIGH_GROWTH, ERM_MATURE, as_dict, fingerprint, value_dcf, value_dcf_many, \
+    value_erm, value_erm_many
+from workbook_cache import FinancialsWorkbook, load_financials
+
+YEARS = pd.to_datetime(['2023-12-31', '2022-12-31', '2021-12-31', '2020-12-31', '2019-12-31'])
+
+
+class ValuationWorkspace(unittest.TestCase):
+    # Runs each test in a temporary working directory, where the journal, result sink and exports are written
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workspace = tempfile.TemporaryDirectory()
+        os.chdir(self.workspace.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.workspace.cleanup()
+
+
+def yfinance_frame(rows):
+    # yfinance statements: one row per line item, newest period first, raw units
+    return pd.DataFrame({name: np.asarray(values[::-1], dtype=float) * 1000000 for name, values in rows.items()}, index=YEARS).T
+
+
+def dcf_case(revenues, ocf, capex, price=50.0, shares=100.0, debt=400.0, interest=20.0, tax=0.21, cash=150.0):
+    # revenues/ocf/capex oldest first, in millions
+    last = [np.nan] * (len(revenues) - 1)
+    return {
+        'stock_price': price,
+        'balance_sheet': yfinance_frame({'Total Debt': last + [debt], 'Cash Cash Equivalents And Short Term Investments': last + [cash]}),
+        'income_stmt': yfinance_frame({'Total Revenue': revenues, 'Interest Expense': last + [interest]}),
+        'cash_flow': yfinance_frame({'Operating Cash Flow': ocf, 'Capital Expenditure': capex}),
+        'financials_sorted': pd.DataFrame({'Tax Rate For Calcs': [tax] * len(YEARS)}, index=YEARS),
+        'info': {'sharesOutstanding': shares * 1000000},
+    }
+
+
+class DCFBatchTestCase(ValuationWorkspace):
+    cases = [
+        dcf_case([800, 900, 1000, 1150, 1250], [120, 140, 150, 180, 200], [-40, -45, -50, -60, -65]),
+        dcf_case([300, 310, 290, 330, 340], [30, 20, 25, 40, 45], [-10, -12, -9, -14, -15], debt=900.0, cash=20.0),
+        dcf_case([900, 600, 300, 250, 240], [90, 50, 20, 15, 10], [-20, -15, -10, -8, -8]),      # Negative linear forecast
+    ]
+    expected = [65.08445458254747, -0.13581300971519114, 2.24537001634958]      # dcf() before the batch engines shared its forecasts
+
+    def scalar(self, case):
+        return dcf('TEST', case['stock_price'], case['balance_sheet'], case['income_stmt'], case['cash_flow'],
+                   case['financials_sorted'], None, 0.09, 0.043, 10, 'TEST:TEST', case['info'], 'missing.xlsx')
+
+    def test_matches_scalar_dcf(self):
+        revenues = np.array([case['income_stmt'].loc['Total Revenue'][::-1] / 1000000 for case in self.cases])
+        ocf = np.array([case['cash_flow'].loc['Operating Cash Flow'][::-1] / 1000000 for case in self.cases])
+        capex = np.array([case['cash_flow'].loc['Capital Expenditure'][::-1] / 1000000 for case in self.cases])
+
+        result = dcf_batch(
+            revenues, average_margin(ocf, revenues), average_margin(capex, revenues),
+            market_cap=[case['stock_price'] * case['info']['sharesOutstanding'] / 1000000 for case in self.cases],
+            total_debt=[case['balance_sheet'].iat[0, 0] / 1000000 for case in self.cases],
+            interest_expense=[case['income_stmt'].iat[1, 0] / 1000000 for case in self.cases],
+            tax_rate=0.21, cost_of_equity=0.09,
+            cash_and_cash_equivalents=[case['balance_sheet'].iat[1, 0] / 1000000 for case in self.cases],
+            shares_outstanding=[case['info']['sharesOutstanding'] / 1000000 for case in self.cases],
+            growth_rate=0.043)
+
+        np.testing.assert_allclose(result['intrinsic_value_per_share'], self.expected, rtol=1e-6)
+        np.testing.assert_allclose([self.scalar(case) for case in self.cases], self.expected, rtol=1e-6)
+        np.testing.assert_array_equal(result['negative_revenues'], [False, False, True])
+        self.assertEqual([row['model'] for row in sink.drain()], ['DCF', 'DCF', 'DCF (Negative Revenues)'])
+
+    def test_shorter_histories_are_left_padded(self):
+        full = [[800, 900, 1000, 1150, 1250, 1400]]
+        padded = [[np.nan, 900, 1000, 1150, 1250, 1400]]
+        args = dict(ocf_margin=0.15, capex_margin=-0.05, market_cap=5000, total_debt=400, interest_expense=20, tax_rate=0.21,
+                    cost_of_equity=0.09, cash_and_cash_equivalents=150, shares_outstanding=100, growth_rate=0.043)
+
+        short = dcf_batch(padded, **args)
+        trimmed = dcf_batch([[900, 1000, 1150, 1250, 1400]], **args)
+        np.testing.assert_allclose(short['intrinsic_value_per_share'], trimmed['intrinsic_value_per_share'])
+        self.assertFalse(np.allclose(dcf_batch(full, **args)['intrinsic_value_per_share'], trimmed['intrinsic_value_per_share']))
+
+    def test_linear_forecasts_match_sklearn(self):
+        rng = np.random.default_rng(1)
+        revenues = rng.lognormal(5, 1, (50, 1)) * np.cumprod(1 + rng.normal(0.02, 0.2, (50, 7)), axis=1)
+        revenues[:10, :2] = np.nan          # Shorter histories
+        forecasts, error_margin, validation_data = linear_forecasts(revenues)
+
+        for row, series in enumerate(revenues):
+            series = series[~np.isnan(series)]
+            model = LinearRegression().fit(np.arange(1, len(series) - 1).reshape(-1, 1), series[:-2])
+            np.testing.assert_allclose(forecasts[row], model.predict(np.arange(len(series) + 1, len(series) + 6).reshape(-1, 1)), rtol=1e-9)
+            validation_forecasts = model.predict(np.arange(len(series) - 1, len(series) + 1).reshape(-1, 1))
+            self.assertAlmostEqual(error_margin[row], np.mean(np.abs(series[-2:] - validation_forecasts)), delta=1e-9 * error_margin[row])
+        np.testing.assert_array_equal(validation_data, revenues[:, -2:])
+
+    def test_smoothing_matches_statsmodels(self):
+        rng = np.random.default_rng(2)
+        revenues = rng.lognormal(5, 1, (50, 1)) * np.cumprod(1 + rng.normal(-0.05, 0.3, (50, 7)), axis=1)
+        revenues[:10, :2] = np.nan          # Shorter histories
+        forecasts, error_margin, validation_data = smoothing_forecasts(revenues)
+
+        for row, series in enumerate(revenues):
+            series = series[~np.isnan(series)]
+            model_fit = SimpleExpSmoothing(series).fit()
+            np.testing.assert_allclose(forecasts[row], model_fit.predict(start=len(series), end=len(series) + 4), rtol=1e-5)
+            validation_forecasts = model_fit.predict(start=len(series) - 2, end=len(series) - 1)
+            self.assertAlmostEqual(error_margin[row], np.mean(np.abs(series[-2:] - validation_forecasts)), delta=1e-4 * error_margin[row])
+        np.testing.assert_array_equal(validation_data, revenues[:, -2:])
+
+    def test_pure_valuation_and_fingerprint(self):
+        case = self.cases[2]
+        args = ('TEST', case['stock_price'], case['balance_sheet'], case['income_stmt'], case['cash_flow'], case['financials_sorted'],
+                None, 0.09, 0.043, 10, case['info'], 'missing.xlsx')
+        inputs = dcf_inputs(*args)
+        result = value_dcf(inputs)
+
+        self.assertEqual(result.model, DCF_NEGATIVE_REVENUES)
+        self.assertEqual(len(result.predicted_revenues), 5)
+        self.assertAlmostEqual(result.value, self.scalar(case))
+        self.assertEqual(as_dict(result)['discounted_fcff'], result.discounted_fcff.tolist())
+
+        self.assertEqual(fingerprint(inputs), fingerprint(dcf_inputs(*args)))
+        self.assertNotEqual(fingerprint(inputs), fingerprint(dcf_inputs(*args[:7], 0.1, *args[8:])))
+
+    def test_inputs_print_nothing(self):
+        # dcf_inputs()/erm_inputs() also run on the web server and Celery workers; only record_dcf()/record_erm() print
+        case = self.cases[0]
+        erm = ERMBatchTestCase.cases[0][0]
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            dcf_inputs('TEST', case['stock_price'], case['balance_sheet'], case['income_stmt'], case['cash_flow'], case['financials_sorted'],
+                       None, 0.09, 0.043, 10, case['info'], 'missing.xlsx')
+            inputs = erm_inputs('TEST', erm['balance_sheet'], erm['income_stmt'], None, 0.1, 0.12, 5, 10, 10, 'missing.xlsx', erm['info'], 0.043)
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual(inputs.retained_earnings_source, 'yfinance')
+
+
+def erm_case(retained_earnings, net_income=120.0, equity=1000.0, assets=9000.0, liabilities=8000.0, shares=50.0):
+    last = [np.nan] * (len(retained_earnings) - 1)
+    return {
+        'balance_sheet': yfinance_frame({'Stockholders Equity': last + [equity], 'Total Assets': last + [assets],
+                                         'Total Liabilities Net Minority Interest': last + [liabilities],
+                                         'Retained Earnings': retained_earnings}),
+        'income_stmt': yfinance_frame({'Net Income': last + [net_income]}),
+        'info': {'sharesOutstanding': shares * 1000000},
+        'shares': shares,
+    }
+
+
+class ERMBatchTestCase(ValuationWorkspace):
+    cases = [
+        (erm_case([400, 450, 520, 560, 630]), 5, 10),
+        (erm_case([900, 880, 950, 1010, 990], net_income=60.0, equity=1400.0, assets=12000.0, liabilities=10500.0, shares=80.0), 1, 14),
+        (erm_case([100, 140, 170, 230, 260], net_income=40.0, equity=300.0, assets=2500.0, liabilities=2150.0, shares=20.0), 3, 12),
+    ]
+    expected = [105.4778816374937, 30.391606818181817, 66.98392666332748]       # erm() before the batch engines shared its forecasts
+
+    def scalar(self, case, high_growth_period, stable_growth_period):
+        return erm('TEST', 25.0, case['balance_sheet'], case['income_stmt'], None, 0.1, 0.12,
+                   high_growth_period, stable_growth_period, 10, 'TEST:TEST', 'missing.xlsx', case['info'], 0.043)
+
+    def test_matches_scalar_erm(self):
+        cases = [case for case, _, _ in self.cases]
+        bs = [case['balance_sheet'] for case in cases]
+        result = erm_batch(
+            book_value_per_share=[(b.at['Total Assets', YEARS[0]] - b.at['Total Liabilities Net Minority Interest', YEARS[0]]) / 1000000 / case['shares']
+                                  for b, case in zip(bs, cases)],
+            roe=[case['income_stmt'].iat[0, 0] / b.at['Stockholders Equity', YEARS[0]] for b, case in zip(bs, cases)],
+            cost_of_equity=0.1, stable_roe=0.12,
+            retained_earnings=[b.loc['Retained Earnings'][::-1] / 1000000 for b in bs],
+            shares_outstanding=[case['shares'] for case in cases],
+            high_growth_period=[high for _, high, _ in self.cases],
+            stable_growth_rate=0.043)
+
+        np.testing.assert_allclose(result['estimated_value'], self.expected, rtol=1e-6)
+        np.testing.assert_allclose([self.scalar(*case) for case in self.cases], self.expected, rtol=1e-6)
+
+
+class StageTestCase(ValuationWorkspace):
+    def features(self, growth, capex=10.0, industry_group=None):
+        # ebit 100 at a 20% tax rate and working capital up by 5, so the reinvestment rate is (capex + 5) / 80
+        return {'industry_group': industry_group, 'revenue_growth': np.array(growth), 'capex': capex, 'ebit': 100.0, 'tax_rate': 0.2,
+                'current_assets': 50.0, 'previous_current_assets': 40.0, 'current_liabilities': 30.0, 'previous_current_liabilities': 25.0}
+
+    def test_classifies_every_row_at_once(self):
+        features = [self.features([0.1, 0.05], industry_group='Banks (Regional)'),
+                    self.features([0.3, np.nan, 0.5], capex=60.0, industry_group='R.E.I.T.'),
+                    self.features([0.3, 0.5], capex=60.0),
+                    self.features([0.3, 0.5]),
+                    dict(self.features([]), capex=np.nan),
+                    dict(self.features([0.1]), ebit=np.nan, industry_group='Insurance (Life)')]
+        stages = classify(features)
+
+        self.assertEqual(stages['model'].tolist(), [ERM_MATURE, ERM_HIGH_GROWTH, ERM_HIGH_GROWTH, DCF, DCF, ERM_HIGH_GROWTH])
+        self.assertEqual(stages['fin_firm'].tolist(), [True, True, False, False, False, True])
+        np.testing.assert_allclose(stages['average_revenue_growth'][:4], [0.075, 0.4, 0.4, 0.4])
+        np.testing.assert_allclose(stages['reinvestment_rate'][:4], [0.1875, 0.8125, 0.8125, 0.1875])
+        self.assertEqual(stages['stage_error'].tolist()[3:], [None, "No numerical values found in Revenue Growth",
+                                                               "No numerical values found in EBIT"])
+        self.assertEqual(by_model('ABCDEF', stages['model']), {ERM_MATURE: ['A'], ERM_HIGH_GROWTH: ['B', 'C', 'F'], DCF: ['D', 'E']})
+
+    def test_stage_features_match_company_stage(self):
+        case = dict(dcf_case([800, 900, 1000, 1150, 1250], [120, 140, 150, 180, 200], [-40, -45, -50, -60, -65]))
+        case['balance_sheet'] = pd.concat([case['balance_sheet'], yfinance_frame({'Current Assets': [0, 0, 0, 300, 340],
+                                                                                  'Current Liabilities': [0, 0, 0, 200, 210]})])
+        case['income_stmt'] = pd.concat([case['income_stmt'], yfinance_frame({'EBIT': [0, 0, 0, 0, 180]})])
+        args = (None, case['info'], case['balance_sheet'], case['income_stmt'], case['cash_flow'], case['financials_sorted'])
+
+        stage = classify([stage_features(*args)])
+        growth, reinvestment_rate = main.company_stage(*args)
+        self.assertAlmostEqual(growth, np.mean([900 / 800, 1000 / 900, 1150 / 1000, 1250 / 1150]) - 1)
+        self.assertAlmostEqual(reinvestment_rate, (65 + 30) / (180 * 0.79))
+        self.assertEqual((stage['average_revenue_growth'][0], stage['reinvestment_rate'][0]), (growth, reinvestment_rate))
+        with self.assertRaisesRegex(Exception, 'Revenue Growth'):
+            main.company_stage(None, {}, None, None, None, None)
+
+    def test_batch_engines_match_scalar_models(self):
+        dcf_cases = DCFBatchTestCase.cases
+        inputs = [dcf_inputs('TEST', case['stock_price'], case['balance_sheet'], case['income_stmt'], case['cash_flow'],
+                             case['financials_sorted'], None, 0.09, 0.043, 10, case['info'], 'missing.xlsx') for case in dcf_cases]
+        for batch, scalar in zip(value_dcf_many(inputs), map(value_dcf, inputs)):
+            self.assertEqual(batch.model, scalar.model)
+            self.assertAlmostEqual(batch.value, scalar.value)
+            np.testing.assert_allclose(batch.discounted_fcff, scalar.discounted_fcff)
+
+        inputs = [erm_inputs('TEST', case['balance_sheet'], case['income_stmt'], None, 0.1, 0.12, high, stable, 10, 'missing.xlsx',
+                             case['info'], 0.043) for case, high, stable in ERMBatchTestCase.cases]
+        for batch, scalar in zip(value_erm_many(inputs), map(value_erm, inputs)):
+            self.assertEqual(batch.model, scalar.model)
+            self.assertAlmostEqual(batch.value, scalar.value)
+            np.testing.assert_allclose(batch.excess_returns, scalar.excess_returns)
+            np.testing.assert_allclose(batch.forecasted_retained_earnings, scalar.forecasted_retained_earnings)
+
+    def test_value_batch_matches_value_task(self):
+        universe = synthetic_universe(24)
+
+        def fundamentals(symbol):
+            s = statements(universe, int(symbol[1:]))
+            return dict(s, financials=s['financials_sorted'].T)
+
+        store = mock.Mock()
+        store.client.thread_calls.return_value = 0
+        store.get.side_effect = fundamentals
+        tasks = [(f'NYSE:T{i}', pd.DataFrame({'Exchange:Ticker': [f'NYSE:T{i}'], 'Cost Of Equity': [0.09], 'Return On Equity': [0.12],
+                                              'Industry Group': ['Banks (Regional)' if i % 3 == 0 else 'Software']})) for i in range(24)]
+        sink.drain()        # Rows other tests left behind
+        with mock.patch('main.store', store):
+            single = [main.value_task(task) for task in tasks]
+            batch = main.value_batch(tasks)
+
+        self.assertEqual({outcome['model'] for outcome in batch}, {DCF, ERM_HIGH_GROWTH, ERM_MATURE})
+        for one, many in zip(single, batch):
+            self.assertEqual((one['exchange_ticker'], one['status'], one['model']), (many['exchange_ticker'], many['status'], many['model']))
+            np.testing.assert_allclose([row['value'] for row in many['rows']], [row['value'] for row in one['rows']])
+
+
+class UniverseTestCase(ValuationWorkspace):
+    def test_lookup_groups_and_pending(self):
+        universe = Universe(pd.DataFrame({
+            'Exchange:Ticker': ['NYSE:AAA', ' NasdaqGS:BBB', 'NYSE:CCC', 'NYSE:AAA'],
+            'Industry Group': ['Banks (Regional) ', 'Software', 'Banks (Regional)', 'Retail'],
+            'Country': ['United States', 'United States', np.nan, 'Canada'],
+            'Cost Of Equity': [0.09, '-', 0.1, 0.2],
+        }))
+
+        self.assertEqual(universe.row('NasdaqGS:BBB').index.tolist(), [1])
+        self.assertEqual(universe.row('NYSE:AAA')['Cost Of Equity'].values[0], 0.09)          # First of a duplicated ticker
+        self.assertEqual(universe.row('NYSE:AAA')['Industry Group'].values[0], 'Banks (Regional)')
+        self.assertNotIn('NYSE:ZZZ', universe)
+        self.assertEqual(universe.members('industry', 'Banks (Regional)'), ['NYSE:AAA', 'NYSE:CCC'])
+        self.assertEqual(universe.members('country', 'United States'), ['NYSE:AAA', 'NasdaqGS:BBB'])
+        self.assertEqual(universe.members('exchange', 'NYSE'), ['NYSE:AAA', 'NYSE:CCC', 'NYSE:AAA'])
+        self.assertEqual(universe.column('Cost Of Equity', 0), [0.09, 0, 0.1, 0.2])
+
+        journal = RunJournal('journal.sqlite3')
+        journal.record({'exchange_ticker': 'NYSE:CCC', 'status': 'processed', 'model': 'DCF', 'reason': None, 'seconds': 1.0})
+        tasks, skipped = main.pending(universe, journal)
+        self.assertEqual(([task[0] for task in tasks], skipped), (['NYSE:AAA', 'NasdaqGS:BBB', 'NYSE:AAA'], 1))
+
+
+def fake_value_task(task):
+    # Stands in for main.value_task in the pool workers: NYSE:BAD fails, every other ticker is valued at 10
+    exchange_ticker, row = task
+    if exchange_ticker == 'NYSE:BAD':
+        outcome, rows = main.result(exchange_ticker, 'failed', reason='No data'), []
+    else:
+        outcome, rows = main.result(exchange_ticker, 'processed', model='DCF'), [result_row(exchange_ticker, 10.0, 8.0, 'DCF', 0.1)]
+    return dict(outcome, seconds=0.0, rows=rows, telemetry={'spans': {}, 'counters': {}})
+
+
+class RunnerTestCase(ValuationWorkspace):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('main.value_task', fake_value_task)      # Picked up by the forked workers
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.universe = Universe(pd.DataFrame({'Exchange:Ticker': ['NYSE:AAA', 'NYSE:BBB', 'NYSE:BAD', 'NYSE:CCC', 'NYSE:DDD'],
+                                               'Cost Of Equity': [0.09] * 5}))
+
+    def run_parallel(self, journal, result_sink, mode=main.RESUME):
+        return runner.run_parallel(self.universe, journal, mode, workers=2, chunk_size=1, result_sink=result_sink, export='',
+                                   telemetry_log=TelemetryLog(''), prefetch=0)
+
+    def test_resume_and_retry_failures(self):
+        journal = RunJournal('journal.sqlite3')
+        journal.record({'exchange_ticker': 'NYSE:AAA', 'status': 'processed'})
+        results = self.run_parallel(journal, ResultSink('results.sqlite3'))
+        self.assertEqual(sorted(outcome['exchange_ticker'] for outcome in results), ['NYSE:BAD', 'NYSE:BBB', 'NYSE:CCC', 'NYSE:DDD'])
+        self.assertEqual(journal.status('NYSE:BAD'), 'failed')
+        self.assertEqual(len(ResultSink('results.sqlite3').rows()), 3)
+
+        retried = self.run_parallel(journal, ResultSink('results.sqlite3'), mode=RETRY_FAILURES)
+        self.assertEqual([outcome['exchange_ticker'] for outcome in retried], ['NYSE:BAD'])
+        self.assertEqual(journal.outcomes['BAD']['attempts'], 2)
+
+    def test_failure_in_collect_stops_workers_and_flushes_results(self):
+        journal = RunJournal('journal.sqlite3')
+        collect = main.collect
+        collected = []
+
+        def failing_collect(outcome, *args):
+            if collected:
+                raise RuntimeError('disk full')
+            collected.append(outcome['exchange_ticker'])
+            collect(outcome, *args)
+
+        with mock.patch('main.collect', side_effect=failing_collect), self.assertRaisesRegex(RuntimeError, 'disk full'):
+            self.run_parallel(journal, ResultSink('results.sqlite3'))
+        self.assertEqual([row['exchange_ticker'] for row in ResultSink('results.sqlite3').rows()], collected)
+        self.assertEqual(len(journal.outcomes), 1)
+
+
+class RunJournalTestCase(ValuationWorkspace):
+    def test_modes_and_reload(self):
+        journal = RunJournal('journal.sqlite3')
+        journal.record({'exchange_ticker': 'NYSE:AAA', 'status': 'processed', 'model': 'DCF', 'seconds': 0.5})
+        journal.record({'exchange_ticker': 'NYSE:BBB', 'status': 'failed', 'reason': 'KeyError'})
+        journal.close()
+
+        journal = RunJournal('journal.sqlite3')
+        self.assertEqual([journal.should_run(t) for t in ('NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC')], [False, False, True])
+        self.assertEqual([journal.should_run(t, RETRY_FAILURES) for t in ('NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC')], [False, True, False])
+        self.assertTrue(journal.should_run('NYSE:AAA', ALL))
+
+        journal.record({'exchange_ticker': 'NYSE:BBB', 'status': 'processed', 'model': 'ERM (Mature)'})
+        self.assertEqual(journal.outcomes['BBB']['attempts'], 2)
+        self.assertEqual(journal.failures(), [])
+        journal.close()
+
+    def test_imports_legacy_logs(self):
+        with open('processed.log', 'w') as f:
+            f.write('AAA\n')
+        with open('missing_data.log', 'w') as f:
+            f.write('Neither model applies for BBBdue to missing COE\n')
+            f.write('DCF not applicable for CCC due to: float division by zero (mature non-financial firm)\n')
+        journal = RunJournal('journal.sqlite3')
+        self.assertEqual(journal.import_logs(), 3)
+        self.assertEqual({symbol: outcome['status'] for symbol, outcome in journal.outcomes.items()},
+                         {'AAA': 'processed', 'BBB': 'failed', 'CCC': 'failed'})
+        journal.close()
+
+
+class FakeMarketData:
+    # Client double for the fundamentals store: statements scaled by `revenue`, info carrying the day's price
+    def __init__(self):
+        self.revenue = 100.0
+        self.price = 10.0
+        self.failing = False
+        self.upstream_calls = 0
+
+    def statements(self, symbol):
+        if self.failing:
+            raise ConnectionError('Yahoo unavailable')
+        self.upstream_calls += 3
+        frame = yfinance_frame({'Total Revenue': [self.revenue] * 5})
+        return {'balance_sheet': frame, 'income_stmt': frame, 'cashflow': frame, 'financials': frame}
+
+    def info(self, symbol):
+        if self.failing:
+            raise ConnectionError('Yahoo unavailable')
+        self.upstream_calls += 1
+        return {'previousClose': self.price}
+
+
+class FundamentalsStoreTestCase(ValuationWorkspace):
+    def setUp(self):
+        super().setUp()
+        self.now = 0.0
+        self.client = FakeMarketData()
+        self.store = FundamentalsStore('fundamentals.sqlite3', statements_max_age_days=30, info_max_age_days=1, statement_versions=2,
+                                       client=self.client, clock=lambda: self.now)
+
+    def test_unchanged_data_only_touches_fetched_at(self):
+        self.store.get('AAA')
+        self.now = 40 * 86400
+        fundamentals = self.store.get('AAA')
+        self.assertEqual(self.store.versions('AAA', 'income_stmt'), [(1, '2023-12-31', 40 * 86400)])
+        self.assertEqual(fundamentals['as_of'], '2023-12-31')
+        self.assertEqual(self.client.upstream_calls, 8)
+        self.store.get('AAA')
+        self.assertEqual(self.client.upstream_calls, 8)         # Fresh: served from SQLite
+
+    def test_changed_data_adds_versions_and_prunes_old_ones(self):
+        for day in range(4):
+            self.now = day * 40 * 86400
+            self.client.revenue = 100.0 + day
+            self.client.price = 10.0 + day
+            self.store.get('AAA')
+        self.assertEqual([version for version, _, _ in self.store.versions('AAA', 'income_stmt')], [3, 4])
+        self.assertEqual([version for version, _, _ in self.store.versions('AAA', 'info')], [4])
+        fundamentals = self.store.get('AAA')
+        self.assertEqual(fundamentals['income_stmt'].iat[0, 0], 103000000.0)
+        self.assertEqual(fundamentals['info'], {'previousClose': 13.0})
+
+    def test_failed_refresh_falls_back_to_stored_copy(self):
+        self.store.get('AAA')
+        self.client.failing = True
+        self.now = 40 * 86400
+        self.assertEqual(self.store.get('AAA')['info'], {'previousClose': 10.0})
+        with self.assertRaises(ConnectionError):
+            self.store.get('BBB')       # Nothing stored to fall back on
+
+
+class ResultSinkTestCase(ValuationWorkspace):
+    def test_batches_and_exports_once_per_ticker(self):
+        result_sink = ResultSink('valuation.sqlite3', batch_size=2)
+        result_sink.write(result_row('NYSE:AAA', np.float64(60.0), 50.0, 'DCF', 0.1, wacc=0.08))
+        self.assertEqual(result_sink.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0], 0)
+        result_sink.write(result_row('NYSE:BBB', 20.0, None, 'ERM (Mature)', 0.2))
+        result_sink.write(result_row('NYSE:AAA', 55.0, 50.0, 'DCF', 0.1))       # Rerun replaces the earlier row
+
+        self.assertEqual(result_sink.export_excel('valuation.xlsx'), 2)
+        self.assertEqual(result_sink.export_excel('valuation.xlsx'), 2)
+        result_sink.close()
+
+        worksheet = openpyxl.load_workbook('valuation.xlsx').active
+        self.assertEqual(worksheet.max_row, 3)
+        values = {row[0]: row for row in worksheet.iter_rows(min_row=2, values_only=True)}
+        self.assertEqual(values['NYSE:AAA'][2], 55.0)
+        self.assertAlmostEqual(values['NYSE:AAA'][4], 0.1)
+        self.assertIsNone(values['NYSE:BBB'][3])
+
+
+class FinancialsWorkbookTestCase(ValuationWorkspace):
+    def write_financials(self, revenue):
+        with pd.ExcelWriter('aaa-financials.xlsx') as writer:
+            pd.DataFrame({'FY2023': [revenue, 0.1], 'FY2022': [900.0, 0.2]}, index=['Revenue', 'Revenue Growth']).to_excel(writer, sheet_name='Income')
+            pd.DataFrame({'FY2023': [50.0]}, index=['Total Assets']).to_excel(writer, sheet_name='Balance Sheet')
+
+    def test_sheets_are_parsed_once_per_file_version(self):
+        self.write_financials(1000.0)
+        workbook = load_financials('aaa-financials.xlsx', 'cache')
+        pd.testing.assert_frame_equal(workbook[1], pd.read_excel('aaa-financials.xlsx', sheet_name=1, index_col=0))
+        self.assertEqual(len(workbook), 2)
+        self.assertEqual(sorted(os.listdir(workbook.directory)), ['manifest.pkl', 'sheet_1.pkl'])   # Only the sheet used
+
+        cached = FinancialsWorkbook('aaa-financials.xlsx', 'cache')
+        self.assertEqual(cached[1].at['Total Assets', 'FY2023'], 50.0)
+        self.assertIsNone(cached.excel)         # Served from the pickle without opening the workbook
+        self.assertEqual(cached[0].at['Revenue', 'FY2023'], 1000.0)
+
+        self.write_financials(1100.0)
+        os.utime('aaa-financials.xlsx', ns=(0, cached.version[0] + 1000000000))
+        self.assertEqual(FinancialsWorkbook('aaa-financials.xlsx', 'cache')[0].at['Revenue', 'FY2023'], 1100.0)
+        self.assertIsNone(load_financials('missing-financials.xlsx', 'cache'))
+
+
+class FieldResolverTestCase(unittest.TestCase):
+    def test_sheet_index_matches_row_scans(self):
+        df = pd.DataFrame({'FY2023': ['-', 0.0, 5.0], 'FY2022': [0.0, np.nan, 7.0], 'FY2021': [3.0, 2.0, 'n/a']},
+                          index=['Debt', 'Cash', 'Debt'])
+        index = SheetIndex(df)
+        self.assertEqual(index.first('Debt'), 3.0)         # Text and zero skipped, first of duplicate labels used
+        self.assertEqual(index.first_two('Debt'), (0.0, 3.0))
+        self.assertEqual(index.first_two('Cash'), (0.0, 2.0))
+        self.assertIsNone(index.first('Missing'))
+        self.assertEqual(index.first_two('Missing'), (None, None))
+
+    def test_fallback_order(self):
+        balance_sheet = pd.DataFrame({'FY2023': ['Upgrade', 40.0, 0.0, 10.0, 5.0], 'FY2022': ['Upgrade', 30.0, 0.0, 8.0, 4.0]},
+                                     index=['Total Current Assets', 'Cash & Equivalents', 'Inventory', 'Receivables', 'Short-TermInvestments'])
+        dfs = [pd.DataFrame({'FY2023': [12.0, 10.0]}, index=['Shares Outstanding (Diluted)', 'Shares Outstanding (Basic)']), balance_sheet]
+        resolver = FieldResolver(dfs, {'sharesOutstanding': 0}, balance_sheet=yfinance_frame({'Total Debt': [1, 2, 3, 4, 250]}))
+
+        self.assertEqual(resolver.value('total_debt'), 250.0)                      # yfinance first
+        self.assertEqual(resolver.value('shares_outstanding'), 12.0)               # Zero in info falls through to the workbook
+        self.assertEqual(resolver.value('cash_and_cash_equivalents'), 45.0)        # Derived from the workbook rows
+        self.assertEqual(resolver.pair('current_assets'), (50.0, 38.0))            # Total is text, summed from components
+        self.assertIsNone(resolver.value('interest_expense'))
+        self.assertIsNone(FieldResolver(None).value('shares_outstanding'))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_runs_offline_and_flags_regressions(self):
+        results = run_benchmarks([20], sample_size=3, memory=False)
+        self.assertEqual(sorted(results), sorted(f'{name}@20' for name in BENCHMARKS))
+        self.assertEqual(results['dcf@20']['tickers'], 3)
+        self.assertEqual(results['dcf_batch@20']['tickers'], 20)
+
+        baseline = {key: dict(result, per_ticker=result['per_ticker'] * 2) for key, result in results.items()}
+        self.assertEqual(compare(results, baseline), [])
+        baseline['erm@20']['per_ticker'] = results['erm@20']['per_ticker'] / 2
+        self.assertEqual(compare(results, baseline), ['erm@20'])
+
+
+class TelemetryTestCase(ValuationWorkspace):
+    def test_nested_spans_and_summary(self):
+        recorder = Recorder()
+        with recorder.span('stage'):
+            with recorder.span('excel'):
+                time.sleep(0.02)
+            recorder.count('sheet_parses')
+        telemetry = recorder.drain()
+        self.assertGreaterEqual(telemetry['spans']['excel'], 0.02)
+        self.assertLess(telemetry['spans']['stage'], 0.02)          # Only its own time
+        self.assertEqual(telemetry['counters'], {'sheet_parses': 1})
+        self.assertEqual(recorder.drain(), {'spans': {}, 'counters': {}})
+
+        log = TelemetryLog('telemetry.jsonl')
+        for seconds in (0.1, 0.2, 0.3):
+            log.write({'exchange_ticker': 'NYSE:AAA', 'status': 'processed'}, {'spans': {'write': 0.01, 'fetch': seconds}, 'counters': {'upstream_calls': 4}})
+        log.close()
+        self.assertEqual([row[:2] for row in log.summary()], [('fetch', 3), ('write', 3)])
+        self.assertAlmostEqual(log.summary()[0][3], 0.2)
+        self.assertEqual(log.counters['upstream_calls'], 12)
+        with open('telemetry.jsonl') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(lines[2]['spans']['fetch'], 0.3)
+
+
+class PrefetcherTestCase(unittest.TestCase):
+    def test_prefetches_in_order_with_bounded_lookahead(self):
+        started = []
+
+        def fetch(exchange_ticker):
+            started.append(exchange_ticker)
+            time.sleep(0.01)
+
+        tasks = [(f'NYSE:T{i}', None) for i in range(20)]
+        prefetcher = Prefetcher(tasks, prefetch=4, fetchers=2, fetch=fetch)
+        valued = []
+        for task in prefetcher:
+            self.assertIn(task[0], started)                    # Fetched before it is handed out
+            self.assertLessEqual(len(started), len(valued) + 4)
+            valued.append(task[0])
+            prefetcher.release()
+        self.assertEqual(valued, [task[0] for task in tasks])
+        self.assertEqual(list(Prefetcher(tasks, prefetch=0, fetch=fetch)), tasks)
+
+
+class SlowProvider(MarketDataProvider):
+    # Statements and info after a short delay, counting the calls made for each symbol
+    upstream = False
+
+    def __init__(self):
+        self.calls = collections.Counter()
+
+    def _fetch(self, symbol):
+        time.sleep(0.005)
+        self.calls[symbol] += 1
+
+    def history(self, symbol, period="1d"):
+        return pd.DataFrame()
+
+    def download(self, symbols, period="1d"):
+        return pd.DataFrame()
+
+    def info(self, symbol):
+        self._fetch(symbol)
+        return {'previousClose': 10.0}
+
+    def statement(self, symbol, kind):
+        self._fetch(symbol)
+        return yfinance_frame({'Total Revenue': [100.0] * 5})
+
+
+class PrefetchTelemetryTestCase(ValuationWorkspace):
+    def test_concurrent_prefetches_count_their_own_calls(self):
+        provider = SlowProvider()
+        tasks = [(f'NYSE:T{i}', None) for i in range(8)]
+        with mock.patch('pipeline.store', FundamentalsStore('fundamentals.sqlite3', client=MarketDataClient(provider))):
+            for attempt in range(2):
+                prefetcher = Prefetcher(tasks, prefetch=4, fetchers=4)
+                for exchange_ticker, _ in prefetcher:
+                    telemetry = prefetcher.prefetched(exchange_ticker)
+                    self.assertGreater(telemetry['spans']['prefetch'], 0)
+                    if attempt == 0:
+                        self.assertEqual(telemetry['counters'], {'upstream_calls': provider.calls[exchange_ticker.split(':')[1]],
+                                                                 'fundamentals_prefetched': 1})
+                    else:
+                        self.assertEqual(telemetry['counters'], {})         # Fresh in the store
+                    self.assertIsNone(prefetcher.prefetched(exchange_ticker))
+                    prefetcher.release()
+        self.assertEqual(set(provider.calls), {f'T{i}' for i in range(8)})
+
+    def test_collect_adds_prefetch_telemetry_to_the_outcome(self):
+        telemetry_log = TelemetryLog('')
+        outcome = {'exchange_ticker': 'NYSE:AAA', 'status': 'processed', 'rows': [],
+                   'telemetry': {'spans': {'fetch': 0.25}, 'counters': {'fundamentals_cache_hits': 1}}}
+        main.collect(outcome, RunJournal('journal.sqlite3'), ResultSink('results.sqlite3'), telemetry_log,
+                     {'spans': {'prefetch': 1.5}, 'counters': {'upstream_calls': 4, 'fundamentals_prefetched': 1}})
+        self.assertEqual(telemetry_log.durations['prefetch'], [1.5])
+        self.assertEqual(telemetry_log.durations['fetch'], [0.25])
+        self.assertEqual(telemetry_log.counters, {'fundamentals_cache_hits': 1, 'upstream_calls': 4, 'fundamentals_prefetched': 1})
+
+
+class QuoteProvider(SlowProvider):
+    # Upstream double with a distinct close history per symbol
+    upstream = True
+
+    def history(self, symbol, period="1d"):
+        self._fetch(symbol)
+        return pd.DataFrame({'Close': [ord(symbol[0]), ord(symbol[0]) + 1.0], 'Volume': [100.0, 200.0]},
+                            index=pd.to_datetime(['2024-01-02', '2024-01-03']))
+
+
+class MarketDataTestCase(ValuationWorkspace):
+    def test_provider_is_abstract(self):
+        with self.assertRaises(TypeError):
+            MarketDataProvider()
+
+    def test_recording_replays_and_assembles_downloads(self):
+        upstream = QuoteProvider()
+        recording = RecordingProvider('recordings', upstream)
+        histories = {symbol: recording.history(symbol) for symbol in ('AAA', 'BBB')}
+        info = recording.info('AAA')
+        statements = recording.statements('AAA', ['income_stmt', 'cashflow'])
+
+        replay = ReplayProvider('recordings')
+        self.assertFalse(replay.upstream)
+        pd.testing.assert_frame_equal(replay.history('BBB'), histories['BBB'])
+        self.assertEqual(replay.info('AAA'), info)
+        pd.testing.assert_frame_equal(replay.statement('AAA', 'cashflow'), statements['cashflow'])
+        with self.assertRaises(LookupError):
+            replay.info('BBB')
+
+        # Never downloaded as a batch: columns are (field, symbol) like yf.download, unrecorded symbols left out
+        download = replay.download(['BBB', 'AAA', 'CCC'])
+        self.assertEqual(list(download.columns), [('Close', 'AAA'), ('Close', 'BBB'), ('Volume', 'AAA'), ('Volume', 'BBB')])
+        pd.testing.assert_series_equal(download[('Close', 'BBB')], histories['BBB']['Close'], check_names=False)
+        self.assertTrue(replay.download(['CCC']).empty)
+        self.assertEqual(sum(upstream.calls.values()), 5)         # Replaying never reached upstream
+
+    def test_statements_share_one_ticker(self):
+        with mock.patch('market_data.yf.Ticker') as ticker:
+            client = MarketDataClient(YFinanceProvider(session=object()))
+            statements = client.statements('AAA')
+        ticker.assert_called_once_with('AAA', session=mock.ANY)
+        self.assertIs(statements['income_stmt'], ticker.return_value.income_stmt)
+        self.assertIs(statements['financials'], statements['income_stmt'])
+        self.assertEqual(client.upstream_calls, 3)            # financials is not requested, nor charged to the bucket
+        self.assertAlmostEqual(client.bucket.tokens, client.bucket.capacity - 3, places=2)
+
+    def test_token_bucket_bursts_then_refills(self):
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        bucket = TokenBucket(rate=2, capacity=3, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0.0, 0.0, 0.0])      # Burst
+        self.assertAlmostEqual(bucket.acquire(), 0.5)                                 # Waits for one token at 2/sec
+        self.assertAlmostEqual(now[0], 0.5)
+        now[0] += 10                                                                  # Refills up to capacity only
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.acquire(2), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
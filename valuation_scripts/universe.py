@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+### DEFINITIONS & ASSUMPTIONS ###
+TICKER_COLUMN = 'Exchange:Ticker'
+
+# Constituent columns read as numbers; text such as '-' or 'n/a' becomes NaN
+NUMERIC_COLUMNS = ['Cost Of Capital', 'Cost Of Equity', 'Return On Equity', 'Intrinsic Value', 'Growth', 'Weighted Average Cost Of Capital',
+                   'Enterprise Value', 'Equity Value', 'Terminal Value (TV)', 'Discounted TV', 'Book Value of Equity Per Share',
+                   'Discounted Excess Returns (Terminal)']
+
+# Text columns with few distinct values, kept as categories
+CATEGORY_COLUMNS = ['Industry Group', 'Primary Sector', 'Country', 'Broad Group', 'Model']
+
+
+def _strip(value):
+    return value.strip() if isinstance(value, str) else value
+
+
+def normalize(frame):
+    # Copy of a constituent table with text stripped once, repeated text as categories and numeric columns as float64
+    frame = frame.copy()
+    for column in frame.columns:
+        if column in NUMERIC_COLUMNS:
+            frame[column] = pd.to_numeric(frame[column], errors='coerce').astype(float)
+        elif not pd.api.types.is_numeric_dtype(frame[column]):
+            frame[column] = frame[column].map(_strip)
+            if column in CATEGORY_COLUMNS:
+                frame[column] = frame[column].astype('category')
+    return frame.reset_index(drop=True)
+
+
+def _groups(values):
+    # {value: [positions]} over a column, missing values left out
+    values = pd.Series(values)
+    return {key: positions.tolist() for key, positions in values.groupby(values, observed=True, sort=False).indices.items()}
+
+
+class Universe:
+    # The constituent table (ind_fin_const) loaded once. Rows are found by Exchange:Ticker through a dict instead of
+    # scanning the ticker column, and the tickers of each industry group, country and exchange are grouped up front.
+    def __init__(self, frame):
+        self.frame = normalize(frame)
+        self.tickers = self.frame[TICKER_COLUMN].tolist()
+        self.positions = {}
+        for position, exchange_ticker in enumerate(self.tickers):
+            self.positions.setdefault(exchange_ticker, position)      # Listed twice: the first row wins, as the mask scan's .values[0] did
+        exchanges = np.array([t.split(':')[0] if isinstance(t, str) and ':' in t else None for t in self.tickers], dtype=object)
+        self.groups = {
+            'industry': _groups(self.frame['Industry Group']) if 'Industry Group' in self.frame else {},
+            'country': _groups(self.frame['Country']) if 'Country' in self.frame else {},
+            'exchange': _groups(exchanges),
+        }
+
+    @classmethod
+    def from_excel(cls, path, sheet_name=0):
+        return cls(pd.read_excel(path, sheet_name=sheet_name))
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __contains__(self, exchange_ticker):
+        return exchange_ticker in self.positions
+
+    def row(self, exchange_ticker):
+        # Single-row slice of the table for a ticker, as value_ticker() takes it; KeyError for unknown tickers
+        position = self.positions[exchange_ticker]
+        return self.frame.iloc[position:position + 1]
+
+    def members(self, kind, value):
+        # Tickers of an industry group, country or exchange, in table order
+        return [self.tickers[position] for position in self.groups[kind].get(value, [])]
+
+    def column(self, name, missing=np.nan):
+        # A column as a list of plain values with missing ones replaced, e.g. for building model instances
+        values = self.frame[name]
+        return values.astype(object).where(values.notna(), missing).tolist()
@@ -0,0 +1,253 @@
+import dataclasses
+import hashlib
+from dataclasses import dataclass
+
+import numpy as np
+
+from dcf_batch import FORECAST_YEARS, VALIDATION_YEARS, dcf_batch, linear_forecasts, smoothing_forecast
+from erm_batch import erm_batch
+from telemetry import recorder
+
+### DEFINITIONS & ASSUMPTIONS ###
+NUMBER_OF_YEARS = 10                    # Default historical number of years and DCF projection period
+DCF_GROWTH_RATE = 4.3/100               # Default growth rate for DCF based on US 10 year treasury bond rate
+STABLE_GROWTH_RATE = 4.3/100            # Default stable growth rate for ERM based on US 10 year treasury bond rate
+
+DCF = 'DCF'
+DCF_NEGATIVE_REVENUES = 'DCF (Negative Revenues)'
+ERM_HIGH_GROWTH = 'ERM (High-Growth)'
+ERM_MATURE = 'ERM (Mature)'
+
+# Where erm_inputs() took the retained earnings from
+WORKBOOK = 'workbook'
+YFINANCE = 'yfinance'
+
+# (high growth period, stable growth period) in years for each ERM variant
+ERM_PERIODS = {
+    ERM_HIGH_GROWTH: (5, 10),
+    ERM_MATURE: (1, 14),
+}
+
+# Pure valuation models: inputs are already resolved figures (millions where monetary, series oldest first),
+# nothing is fetched, printed or written. dcf() and erm() gather the inputs from statements and record the results.
+
+
+@dataclass(frozen=True)
+class DCFInputs:
+    symbol: str
+    past_revenues: tuple
+    average_ocf_margin: float
+    average_capex_margin: float
+    market_cap: float
+    shares_outstanding: float
+    total_debt: float
+    interest_expense: float
+    tax_rate: float
+    cash_and_cash_equivalents: float
+    cost_of_equity: float
+    growth_rate: float = DCF_GROWTH_RATE
+    forecast_years: int = FORECAST_YEARS
+
+
+@dataclass(frozen=True)
+class DCFResult:
+    model: str
+    predicted_revenues: np.ndarray
+    error_margin: float
+    percentage_error_margin: float
+    wacc: float
+    projected_fcff: np.ndarray
+    discounted_fcff: np.ndarray
+    terminal_value: float
+    discounted_terminal_value: float
+    enterprise_value: float
+    equity_value: float
+    intrinsic_value_per_share: float
+
+    @property
+    def value(self):
+        return self.intrinsic_value_per_share
+
+
+@dataclass(frozen=True)
+class ERMInputs:
+    symbol: str
+    book_value_per_share: float
+    roe: float
+    retained_earnings: tuple
+    shares_outstanding: float
+    cost_of_equity: float
+    stable_roe: float
+    high_growth_period: int
+    stable_growth_period: int
+    stable_growth_rate: float = STABLE_GROWTH_RATE
+    retained_earnings_source: str = YFINANCE
+
+
+@dataclass(frozen=True)
+class ERMResult:
+    model: str
+    forecasted_retained_earnings: np.ndarray
+    error_margin: float
+    percentage_error_margin: float
+    excess_returns: np.ndarray
+    discounted_excess_returns: np.ndarray
+    book_value_equity_per_share: float
+    terminal_year_excess_return: float
+    excess_returns_terminal_stage: float
+    discounted_excess_return_terminal_stage: float
+    estimated_value: float
+
+    @property
+    def value(self):
+        return self.estimated_value
+
+
+def value_dcf(inputs):
+    past_revenues = np.asarray(inputs.past_revenues, dtype=float)
+
+    ### Discount Rate (WACC) ###
+    debt_weight = inputs.total_debt / (inputs.market_cap + inputs.total_debt)
+    equity_weight = 1 - debt_weight
+    cost_of_debt = inputs.interest_expense / inputs.total_debt
+    wacc = debt_weight * cost_of_debt * (1 - inputs.tax_rate) + equity_weight * inputs.cost_of_equity
+
+    ### Forecasting Revenue using Linear Regression, Exponential Smoothing if it goes negative ###
+    with recorder.span('forecast'):
+        forecasts, error_margin, validation_data = linear_forecasts(past_revenues[None, :], inputs.forecast_years, VALIDATION_YEARS)
+        predicted_revenues, error_margin, validation_data = forecasts[0], error_margin[0], validation_data[0]
+        model = DCF
+        if (predicted_revenues < 0).any():
+            recorder.count('smoothing_fallbacks')
+            predicted_revenues, error_margin, validation_data = smoothing_forecast(past_revenues, inputs.forecast_years, VALIDATION_YEARS)
+            model = DCF_NEGATIVE_REVENUES
+    percentage_error_margin = error_margin / np.mean(validation_data)
+
+    if np.isnan(predicted_revenues).any():
+        raise Exception("Missing predicted revenue data")
+
+    ### Free Cash Flow to Firm, Terminal Value and Enterprise Value ###
+    projected_fcff = predicted_revenues * (inputs.average_ocf_margin - inputs.average_capex_margin)
+    discounted_fcff = projected_fcff / (1 + wacc) ** np.arange(1, len(projected_fcff) + 1)
+    terminal_value = projected_fcff[-1] * (1 + inputs.growth_rate) / (wacc - inputs.growth_rate)
+    discounted_terminal_value = terminal_value / (1 + wacc) ** len(predicted_revenues)
+    enterprise_value = discounted_fcff.sum() + discounted_terminal_value
+
+    ### Equity Value and Intrinsic Value ###
+    equity_value = enterprise_value + inputs.cash_and_cash_equivalents - inputs.total_debt
+    intrinsic_value_per_share = equity_value / inputs.shares_outstanding
+
+    return DCFResult(model, predicted_revenues, float(error_margin), float(percentage_error_margin), float(wacc), projected_fcff,
+                     discounted_fcff, float(terminal_value), float(discounted_terminal_value), float(enterprise_value),
+                     float(equity_value), float(intrinsic_value_per_share))
+
+
+def value_erm(inputs):
+    retained_earnings = np.asarray(inputs.retained_earnings, dtype=float)
+    forecast_period = inputs.high_growth_period + inputs.stable_growth_period
+
+    ### Forecasting Retained Earnings using Linear Regression ###
+    with recorder.span('forecast'):
+        forecasts, error_margin, validation_data = linear_forecasts(retained_earnings[None, :], forecast_period, VALIDATION_YEARS)
+    forecasted_retained_earnings, error_margin = forecasts[0], error_margin[0]
+    percentage_error_margin = error_margin / np.mean(validation_data[0])
+
+    ### Stage 1: High Growth Period ###
+    book_value_equity_per_share = inputs.book_value_per_share
+    excess_returns = []
+    for year in range(1, inputs.high_growth_period + 1):
+        excess_returns.append(book_value_equity_per_share * (inputs.roe - inputs.cost_of_equity) * (1 + inputs.stable_growth_rate))
+        book_value_equity_per_share += forecasted_retained_earnings[year - 1] / inputs.shares_outstanding
+    excess_returns = np.asarray(excess_returns, dtype=float)
+    discounted_excess_returns = excess_returns / (1 + inputs.cost_of_equity) ** np.arange(1, len(excess_returns) + 1)
+
+    ### Stage 2: Stable Growth Period ###
+    terminal_year_excess_return = book_value_equity_per_share * (inputs.stable_roe - inputs.cost_of_equity)
+    excess_returns_terminal_stage = terminal_year_excess_return * (inputs.cost_of_equity - inputs.stable_growth_rate)
+    discounted_excess_return_terminal_stage = excess_returns_terminal_stage / (1 + inputs.cost_of_equity) ** inputs.high_growth_period
+
+    estimated_value = discounted_excess_returns.sum() + discounted_excess_return_terminal_stage + book_value_equity_per_share
+    model = ERM_HIGH_GROWTH if inputs.high_growth_period > 1 else ERM_MATURE
+
+    return ERMResult(model, forecasted_retained_earnings, float(error_margin), float(percentage_error_margin), excess_returns,
+                     discounted_excess_returns, float(book_value_equity_per_share), float(terminal_year_excess_return),
+                     float(excess_returns_terminal_stage), float(discounted_excess_return_terminal_stage), float(estimated_value))
+
+
+### Batch valuation ###
+# The same models for a list of inputs at once, through the array engines in dcf_batch / erm_batch.
+def pad_left(series):
+    # Series of different lengths as an N x T array, NaN padded on the left as the batch engines expect
+    T = max(len(values) for values in series)
+    return np.array([[np.nan] * (T - len(values)) + list(values) for values in series], dtype=float)
+
+
+def value_dcf_many(inputs):
+    # [DCFResult] for a list of DCFInputs sharing a forecast period; None where value_dcf() would raise on the forecast
+    if not inputs:
+        return []
+    if len({i.forecast_years for i in inputs}) > 1:
+        raise ValueError("value_dcf_many() needs inputs with the same forecast period")
+    field = lambda name: [getattr(i, name) for i in inputs]
+    with recorder.span('forecast'):
+        r = dcf_batch(pad_left(field('past_revenues')), field('average_ocf_margin'), field('average_capex_margin'), field('market_cap'),
+                      field('total_debt'), field('interest_expense'), field('tax_rate'), field('cost_of_equity'),
+                      field('cash_and_cash_equivalents'), field('shares_outstanding'), field('growth_rate'), inputs[0].forecast_years)
+    recorder.count('smoothing_fallbacks', int(r['negative_revenues'].sum()))
+    return [None if np.isnan(r['predicted_revenues'][i]).any() else
+            DCFResult(DCF_NEGATIVE_REVENUES if r['negative_revenues'][i] else DCF, r['predicted_revenues'][i], float(r['error_margin'][i]),
+                      float(r['percentage_error_margin'][i]), float(r['wacc'][i]), r['projected_fcff'][i], r['discounted_fcff'][i],
+                      float(r['terminal_value'][i]), float(r['discounted_terminal_value'][i]), float(r['enterprise_value'][i]),
+                      float(r['equity_value'][i]), float(r['intrinsic_value_per_share'][i]))
+            for i in range(len(inputs))]
+
+
+def value_erm_many(inputs):
+    # [ERMResult] for a list of ERMInputs, high growth periods may differ
+    if not inputs:
+        return []
+    field = lambda name: [getattr(i, name) for i in inputs]
+    forecast_periods = [i.high_growth_period + i.stable_growth_period for i in inputs]
+    with recorder.span('forecast'):
+        r = erm_batch(field('book_value_per_share'), field('roe'), field('cost_of_equity'), field('stable_roe'),
+                      pad_left(field('retained_earnings')), field('shares_outstanding'), field('high_growth_period'),
+                      field('stable_growth_rate'), max(forecast_periods))
+    results = []
+    for i, forecast_period in enumerate(forecast_periods):
+        period = inputs[i].high_growth_period
+        results.append(ERMResult(ERM_HIGH_GROWTH if period > 1 else ERM_MATURE, r['forecasted_retained_earnings'][i, :forecast_period],
+                                 float(r['error_margin'][i]), float(r['percentage_error_margin'][i]), r['excess_returns'][i, :period],
+                                 r['discounted_excess_returns'][i, :period], float(r['book_value_equity_per_share'][i]),
+                                 float(r['terminal_year_excess_return'][i]), float(r['excess_returns_terminal_stage'][i]),
+                                 float(r['discounted_excess_return_terminal_stage'][i]), float(r['estimated_value'][i])))
+    return results
+
+
+def _plain(value):
+    # Numbers as floats and sequences as tuples so equal inputs always hash the same
+    if isinstance(value, str) or value is None:
+        return value
+    if isinstance(value, (tuple, list, np.ndarray)):
+        return tuple(_plain(v) for v in value)
+    return float(value)
+
+
+def fingerprint(inputs):
+    # Stable hash of a DCFInputs / ERMInputs record
+    values = [type(inputs).__name__] + [(f.name, _plain(getattr(inputs, f.name))) for f in dataclasses.fields(inputs)]
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def _json(value):
+    if isinstance(value, np.ndarray):
+        return [_json(v) for v in value.tolist()]
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def as_dict(result):
+    # JSON friendly copy of a DCFResult / ERMResult: projection arrays as lists, NaN and inf as None
+    data = {f.name: _json(getattr(result, f.name)) for f in dataclasses.fields(result)}
+    data['value'] = _json(result.value)
+    return data
@@ -0,0 +1,81 @@
+import hashlib
+import os
+import pickle
+import shutil
+
+import pandas as pd
+
+from telemetry import recorder
+
+### DEFINITIONS & ASSUMPTIONS ###
+FINANCIALS_CACHE_DIR = os.environ.get('FINANCIALS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'financials_cache'))
+
+
+def _write(path, data):
+    # Write then rename so a parallel worker never reads a half-written file
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+class FinancialsWorkbook:
+    # A stockanalysis {symbol}-financials.xlsx read one sheet at a time. Each sheet is parsed from Excel at most once
+    # per version of the file (path + mtime + size) and pickled under FINANCIALS_CACHE_DIR; later runs load the pickle.
+    # workbook[i] is the same DataFrame pd.read_excel(filepath, sheet_name=i, index_col=0) returns.
+    def __init__(self, filepath, cache_dir=FINANCIALS_CACHE_DIR):
+        self.filepath = os.path.abspath(filepath)
+        stat = os.stat(self.filepath)
+        self.version = (stat.st_mtime_ns, stat.st_size)
+        self.directory = os.path.join(cache_dir, hashlib.sha1(self.filepath.encode()).hexdigest())
+        self.sheets = {}
+        self.indexes = {}       # Section name -> data_functions.SheetIndex, built on first lookup
+        self.excel = None
+
+        manifest = _read(os.path.join(self.directory, 'manifest.pkl'))
+        if manifest is None or manifest['version'] != self.version:
+            # New or changed workbook: drop sheets cached from an older version
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+            manifest = {'version': self.version, 'sheet_names': self._excel().sheet_names}
+            _write(os.path.join(self.directory, 'manifest.pkl'), manifest)
+        self.sheet_names = manifest['sheet_names']
+
+    def _excel(self):
+        if self.excel is None:
+            self.excel = pd.ExcelFile(self.filepath)
+        return self.excel
+
+    def __len__(self):
+        return len(self.sheet_names)
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(f'{self.filepath} has no sheet {index}')
+        index %= len(self)
+        if index not in self.sheets:
+            with recorder.span('excel'):
+                path = os.path.join(self.directory, f'sheet_{index}.pkl')
+                df = _read(path)
+                if df is None:
+                    recorder.count('sheet_parses')
+                    df = pd.read_excel(self._excel(), sheet_name=index, index_col=0)
+                    _write(path, df)
+                else:
+                    recorder.count('sheet_cache_hits')
+                self.sheets[index] = df
+        return self.sheets[index]
+
+
+def load_financials(filepath, cache_dir=FINANCIALS_CACHE_DIR):
+    # Cached workbook for filepath, or None when there is no local financials file
+    with recorder.span('excel'):
+        return FinancialsWorkbook(filepath, cache_dir) if os.path.exists(filepath) else None
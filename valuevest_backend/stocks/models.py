@@ -4,7 +4,7 @@ from django.contrib.auth.models import User
 class Stock(models.Model):
     id = models.AutoField(primary_key=True)
     company_name = models.CharField(max_length=255)
-    exchange_ticker = models.CharField(max_length=50)
+    exchange_ticker = models.CharField(max_length=50, db_index=True)
     industry_group = models.CharField(max_length=100)
     primary_sector = models.CharField(max_length=100)
     sic_code = models.CharField(max_length=50)
@@ -23,6 +23,8 @@ class Stock(models.Model):
     discounted_tv = models.DecimalField(max_digits=30, decimal_places=10, default = 0)
     book_value_of_equity_per_share = models.DecimalField(max_digits=30, decimal_places=10, default = 0)
     discounted_excess_returns = models.DecimalField(max_digits=30, decimal_places=10, default = 0)
+    valuation_fingerprint = models.CharField(max_length=40, blank=True, default='')     # Hash of the inputs intrinsic_value was computed from
+    valued_at = models.DateTimeField(null=True, blank=True)
 
 class Portfolio(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -33,3 +35,60 @@ class Portfolio(models.Model):
 class Watchlist(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     stock = models.ForeignKey(Stock, on_delete=models.CASCADE)
+
+class LatestPrice(models.Model):
+    symbol = models.CharField(max_length=50, unique=True)      # Yahoo symbol, shared by every Stock listing it
+    price = models.FloatField()
+    fetched_at = models.DateTimeField(db_index=True)
+
+class StockRatios(models.Model):
+    stock = models.OneToOneField(Stock, on_delete=models.CASCADE, primary_key=True, related_name='ratios')
+    as_of = models.DateField(null=True)                 # Fiscal period end of the statements used
+    price = models.FloatField(null=True)                # Price the market based ratios were computed with
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Statement components (millions)
+    net_income = models.FloatField(null=True)
+    shareholders_equity = models.FloatField(null=True)
+    total_assets = models.FloatField(null=True)
+    total_liabilities = models.FloatField(null=True)
+    shares_outstanding = models.FloatField(null=True)
+    total_debt = models.FloatField(null=True)
+    enterprise_value = models.FloatField(null=True)
+    revenue = models.FloatField(null=True)
+    ebitda = models.FloatField(null=True)
+    ebit = models.FloatField(null=True)
+    free_cash_flow = models.FloatField(null=True)
+    operating_cash_flow = models.FloatField(null=True)
+    current_assets = models.FloatField(null=True)
+    current_liabilities = models.FloatField(null=True)
+    inventory = models.FloatField(null=True)
+    high_price = models.FloatField(null=True)
+    low_price = models.FloatField(null=True)
+
+    # Ratios
+    market_cap = models.FloatField(null=True, db_index=True)
+    pe_ratio = models.FloatField(null=True, db_index=True)
+    ps_ratio = models.FloatField(null=True)
+    pb_ratio = models.FloatField(null=True, db_index=True)
+    p_fcf_ratio = models.FloatField(null=True)
+    p_ocf_ratio = models.FloatField(null=True)
+    ev_revenue = models.FloatField(null=True)
+    ev_ebitda = models.FloatField(null=True, db_index=True)
+    ev_ebit = models.FloatField(null=True)
+    ev_fcf = models.FloatField(null=True)
+    debt_equity = models.FloatField(null=True, db_index=True)
+    debt_ebitda = models.FloatField(null=True)
+    debt_fcf = models.FloatField(null=True)
+    quick_ratio = models.FloatField(null=True)
+    current_ratio = models.FloatField(null=True)
+    asset_turnover = models.FloatField(null=True)
+    return_on_equity = models.FloatField(null=True, db_index=True)
+    return_on_assets = models.FloatField(null=True)
+    return_on_invested_capital = models.FloatField(null=True, db_index=True)
+    earnings_yield = models.FloatField(null=True)
+    free_cash_flow_yield = models.FloatField(null=True, db_index=True)
+    dividend_yield = models.FloatField(null=True, db_index=True)
+    payout_ratio = models.FloatField(null=True)
+    buyback_yield = models.FloatField(null=True)
+    total_return = models.FloatField(null=True)
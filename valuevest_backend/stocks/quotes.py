@@ -0,0 +1,268 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+import pandas as pd
+
+from .models import LatestPrice
+from .schedule import LATEST_PRICE_REFRESH_SECONDS
+from . import valuation_scripts  # noqa: F401
+from market_data import client
+
+logger = logging.getLogger(__name__)
+
+QUOTE_CACHE_TTL = getattr(settings, 'QUOTE_CACHE_TTL', 60)                 # Seconds a cached price stays fresh
+QUOTE_CACHE_MAX_SIZE = getattr(settings, 'QUOTE_CACHE_MAX_SIZE', 4096)     # Symbols kept before LRU eviction
+QUOTE_FETCH_WORKERS = getattr(settings, 'QUOTE_FETCH_WORKERS', 16)         # Upstream lookups allowed in parallel
+QUOTE_FETCH_DEADLINE = getattr(settings, 'QUOTE_FETCH_DEADLINE', 5)        # Seconds a request waits for its prices
+LATEST_PRICE_MAX_AGE = getattr(settings, 'LATEST_PRICE_MAX_AGE', 3 * LATEST_PRICE_REFRESH_SECONDS)
+
+PRICE_FRESH = 'fresh'
+PRICE_STALE = 'stale'          # Lookup missed the deadline, last known (expired) price served instead
+PRICE_MISSING = 'missing'      # Lookup missed the deadline or failed and no earlier price is known
+
+
+def to_symbol(exchange_ticker):
+    # 'NasdaqGS:AAPL' -> 'AAPL'
+    return exchange_ticker.split(':', 1)[-1].strip().upper()
+
+
+class _Flight:
+    # A single upstream fetch that concurrent requests for the same symbol wait on
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QuoteCache:
+    # wait_timeout: seconds a request waits on another request's fetch of the same symbol. Upstream calls have no
+    # timeout of their own, so a hung fetch must not hold every later request for that symbol with it.
+    def __init__(self, ttl=QUOTE_CACHE_TTL, max_size=QUOTE_CACHE_MAX_SIZE, clock=time.monotonic, wait_timeout=QUOTE_FETCH_DEADLINE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.wait_timeout = wait_timeout
+        self._entries = OrderedDict()       # symbol -> (price, fetched_at), oldest first
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _fresh(self, symbol):
+        entry = self._entries.get(symbol)
+        if entry is not None and self.clock() - entry[1] < self.ttl:
+            self._entries.move_to_end(symbol)
+            return entry
+        return None
+
+    def peek(self, symbol):
+        with self._lock:
+            entry = self._fresh(symbol)
+            return entry[0] if entry is not None else None
+
+    def peek_stale(self, symbol):
+        # Last known price even if past its TTL, None once evicted
+        with self._lock:
+            entry = self._entries.get(symbol)
+            return entry[0] if entry is not None else None
+
+    def set(self, symbol, price):
+        with self._lock:
+            self._entries[symbol] = (price, self.clock())
+            self._entries.move_to_end(symbol)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, symbol, loader):
+        with self._lock:
+            entry = self._fresh(symbol)
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+
+            flight = self._inflight.get(symbol)
+            if flight is None:
+                self.misses += 1
+                flight = self._inflight[symbol] = _Flight()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            if not flight.event.wait(self.wait_timeout):
+                raise TimeoutError(f"Fetch of {symbol} still running after {self.wait_timeout}s")
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader(symbol)
+            self.set(symbol, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(symbol, None)
+            flight.event.set()
+
+    def get_many(self, symbols, bulk_loader):
+        # Resolves every symbol with at most one bulk_loader call for the ones nobody else is fetching.
+        # Symbols whose fetch fails or outlasts wait_timeout come back as None instead of failing the whole batch.
+        prices = {}
+        owned = {}
+        waiting = {}
+        with self._lock:
+            for symbol in dict.fromkeys(symbols):
+                entry = self._fresh(symbol)
+                if entry is not None:
+                    self.hits += 1
+                    prices[symbol] = entry[0]
+                elif symbol in self._inflight:
+                    self.coalesced += 1
+                    waiting[symbol] = self._inflight[symbol]
+                else:
+                    self.misses += 1
+                    owned[symbol] = self._inflight[symbol] = _Flight()
+
+        if owned:
+            try:
+                loaded = bulk_loader(list(owned))
+                for symbol, flight in owned.items():
+                    flight.value = loaded.get(symbol)
+                    self.set(symbol, flight.value)
+            except Exception as e:
+                logger.error(f"Bulk quote fetch failed for {len(owned)} symbols: {e}")
+                for flight in owned.values():
+                    flight.error = e
+            finally:
+                with self._lock:
+                    for symbol in owned:
+                        self._inflight.pop(symbol, None)
+                for flight in owned.values():
+                    flight.event.set()
+            for symbol, flight in owned.items():
+                prices[symbol] = flight.value
+
+        deadline = time.monotonic() + self.wait_timeout        # Shared by all waits so the batch as a whole is bounded
+        for symbol, flight in waiting.items():
+            if not flight.event.wait(max(0.0, deadline - time.monotonic())):
+                logger.error(f"Fetch of {symbol} still running after {self.wait_timeout}s")
+                prices[symbol] = None
+                continue
+            prices[symbol] = flight.value if flight.error is None else None
+
+        return prices
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+            }
+
+
+def fetch_latest_price(symbol):
+    hist = client.history(symbol, period="1d")
+    if hist.empty or 'Close' not in hist.columns:
+        return None
+    return float(hist['Close'].iloc[0])
+
+
+def fetch_latest_prices(symbols):
+    # One batched download for every symbol instead of one history() call each
+    data = client.download(symbols, period="1d")
+    if data.empty or 'Close' not in data.columns:
+        return {}
+
+    close = data['Close']
+    if isinstance(close, pd.Series):
+        close = close.to_frame(name=symbols[0])
+
+    prices = {}
+    for symbol in symbols:
+        if symbol in close.columns:
+            series = close[symbol].dropna()
+            prices[symbol] = float(series.iloc[-1]) if not series.empty else None
+    return prices
+
+
+quote_cache = QuoteCache()
+
+
+def get_latest_price(exchange_ticker):
+    # Latest close for 'Exchange:Ticker' or a bare symbol, None when Yahoo has no price
+    return quote_cache.get(to_symbol(exchange_ticker), fetch_latest_price)
+
+
+def get_stored_prices(symbols, max_age=LATEST_PRICE_MAX_AGE):
+    # Prices kept current by the refresh_latest_prices beat task, one query for all symbols
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    rows = LatestPrice.objects.filter(symbol__in=symbols, fetched_at__gte=cutoff).values_list('symbol', 'price')
+    return dict(rows)
+
+
+def get_latest_prices(exchange_tickers):
+    # {symbol: latest close or None} for every ticker a request needs. Symbols held in a portfolio or
+    # watchlist come from the LatestPrice table; anything it lacks is fetched in one batch.
+    symbols = list(dict.fromkeys(to_symbol(ticker) for ticker in exchange_tickers))
+    prices = get_stored_prices(symbols)
+    missing = [symbol for symbol in symbols if symbol not in prices]
+    if missing:
+        prices.update(quote_cache.get_many(missing, fetch_latest_prices))
+    return prices
+
+
+_fetch_pool = ThreadPoolExecutor(max_workers=QUOTE_FETCH_WORKERS, thread_name_prefix='quotes')
+
+
+def get_latest_prices_within(exchange_tickers, deadline=QUOTE_FETCH_DEADLINE):
+    # {symbol: (price, status)} with the lookups for uncached symbols fanned out over the shared pool.
+    # The caller never waits longer than the deadline; late or failed lookups are marked stale/missing.
+    # Lookups already running finish in the background so the next request finds them in the cache, while
+    # the ones still queued are cancelled so a slow upstream cannot pile up work nobody waits for.
+    symbols = list(dict.fromkeys(to_symbol(ticker) for ticker in exchange_tickers))
+    prices = {}
+    futures = {}
+    for symbol in symbols:
+        price = quote_cache.peek(symbol)
+        if price is not None:
+            prices[symbol] = (price, PRICE_FRESH)
+        else:
+            futures[symbol] = _fetch_pool.submit(get_latest_price, symbol)
+    _, late = wait(futures.values(), timeout=deadline)
+    for future in late:
+        future.cancel()
+
+    for symbol, future in futures.items():
+        price = None
+        if future.done() and not future.cancelled():
+            try:
+                price = future.result()
+            except Exception as e:
+                logger.error(f"Error fetching {symbol}: {e}")
+        if price is not None:
+            prices[symbol] = (price, PRICE_FRESH)
+            continue
+
+        stale_price = quote_cache.peek_stale(symbol)
+        prices[symbol] = (stale_price, PRICE_STALE) if stale_price is not None else (None, PRICE_MISSING)
+    return prices
@@ -0,0 +1,138 @@
+import math
+
+# Raw statement figures (in millions where monetary) kept next to the ratios so the
+# price-dependent ones can be recomputed against a live quote without touching the statements.
+COMPONENT_FIELDS = [
+    'net_income', 'shareholders_equity', 'total_assets', 'total_liabilities', 'shares_outstanding', 'total_debt',
+    'enterprise_value', 'revenue', 'ebitda', 'ebit', 'free_cash_flow', 'operating_cash_flow', 'current_assets',
+    'current_liabilities', 'inventory',
+]
+
+INFO_FIELDS = {
+    'high_price': 'dayHigh',
+    'low_price': 'dayLow',
+    'pe_ratio': 'trailingPE',
+    'earnings_yield': 'earningsYield',
+    'dividend_yield': 'dividendYield',
+    'payout_ratio': 'payoutRatio',
+    'buyback_yield': 'buybackYield',
+}
+
+RATIO_FIELDS = [
+    'market_cap', 'pe_ratio', 'ps_ratio', 'pb_ratio', 'p_fcf_ratio', 'p_ocf_ratio', 'ev_revenue', 'ev_ebitda', 'ev_ebit',
+    'ev_fcf', 'debt_equity', 'debt_ebitda', 'debt_fcf', 'quick_ratio', 'current_ratio', 'asset_turnover',
+    'return_on_equity', 'return_on_assets', 'return_on_invested_capital', 'earnings_yield', 'free_cash_flow_yield',
+    'dividend_yield', 'payout_ratio', 'buyback_yield', 'total_return',
+]
+
+
+def _number(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) else value
+
+
+def _ratio(numerator, denominator):
+    if numerator is None or denominator is None or denominator == 0:
+        return None
+    return numerator / denominator
+
+
+def _statement_value(df, row_name, scale=1000000):
+    try:
+        return _number(df.at[row_name, df.columns[0]] / scale)
+    except Exception:
+        return None
+
+
+def _info_value(info, key, scale=1):
+    value = _number(info.get(key))
+    return value / scale if value is not None else None
+
+
+def compute_components(fundamentals):
+    income_stmt = fundamentals.get('financials')
+    balance_sheet = fundamentals.get('balance_sheet')
+    cashflow_stmt = fundamentals.get('cashflow')
+    info = fundamentals.get('info', {})
+
+    components = {
+        'net_income': _statement_value(income_stmt, 'Net Income'),
+        'shareholders_equity': _statement_value(balance_sheet, 'Stockholders Equity'),
+        'total_assets': _statement_value(balance_sheet, 'Total Assets'),
+        'total_liabilities': _statement_value(balance_sheet, 'Total Liabilities Net Minority Interest'),
+        'shares_outstanding': _info_value(info, 'sharesOutstanding', 1000000),
+        'total_debt': _statement_value(balance_sheet, 'Total Debt'),
+        'enterprise_value': _info_value(info, 'enterpriseValue', 1000000),
+        'revenue': _statement_value(income_stmt, 'Total Revenue'),
+        'ebitda': _info_value(info, 'ebitda', 1000000),
+        'ebit': _statement_value(income_stmt, 'Ebit'),
+        'free_cash_flow': _statement_value(cashflow_stmt, 'Free Cash Flow'),
+        'operating_cash_flow': _statement_value(cashflow_stmt, 'Total Cash From Operating Activities'),
+        'current_assets': _statement_value(balance_sheet, 'Total Current Assets'),
+        'current_liabilities': _statement_value(balance_sheet, 'Total Current Liabilities'),
+        'inventory': _statement_value(balance_sheet, 'Inventory'),
+    }
+    for field, key in INFO_FIELDS.items():
+        components[field] = _info_value(info, key)
+    return components
+
+
+def compute_ratios(components, latest_price):
+    # Same formulas get_stock_details has always served, with None where an input is missing
+    c = components
+    latest_price = _number(latest_price)
+    shares_outstanding = c['shares_outstanding'] if c['shares_outstanding'] else None
+    market_cap = latest_price * shares_outstanding if latest_price is not None and shares_outstanding is not None else None
+    book_value = c['total_assets'] - c['total_liabilities'] if c['total_assets'] is not None and c['total_liabilities'] is not None else None
+    invested_capital = c['total_assets'] - c['current_liabilities'] if c['total_assets'] is not None and c['current_liabilities'] is not None else None
+    quick_assets = c['current_assets'] - c['inventory'] if c['current_assets'] is not None and c['inventory'] is not None else None
+    total_return = (latest_price + c['dividend_yield']) / latest_price - 1 if latest_price and c['dividend_yield'] is not None else None
+
+    return {
+        'current_price': latest_price,
+        'high_price': c['high_price'],
+        'low_price': c['low_price'],
+        'market_cap': market_cap,
+        'pe_ratio': c['pe_ratio'],
+        'ps_ratio': _ratio(market_cap, c['revenue']),
+        'pb_ratio': _ratio(market_cap, book_value),
+        'p_fcf_ratio': _ratio(market_cap, c['free_cash_flow']),
+        'p_ocf_ratio': _ratio(market_cap, c['operating_cash_flow']),
+        'ev_revenue': _ratio(c['enterprise_value'], c['revenue']),
+        'ev_ebitda': _ratio(c['enterprise_value'], c['ebitda']),
+        'ev_ebit': _ratio(c['enterprise_value'], c['ebit']),
+        'ev_fcf': _ratio(c['enterprise_value'], c['free_cash_flow']),
+        'debt_equity': _ratio(c['total_debt'], c['shareholders_equity']),
+        'debt_ebitda': _ratio(c['total_debt'], c['ebitda']),
+        'debt_fcf': _ratio(c['total_debt'], c['free_cash_flow']),
+        'quick_ratio': _ratio(quick_assets, c['current_liabilities']),
+        'current_ratio': _ratio(c['current_assets'], c['current_liabilities']),
+        'asset_turnover': _ratio(c['revenue'], c['total_assets']),
+        'return_on_equity': _ratio(c['net_income'], c['shareholders_equity']),
+        'return_on_assets': _ratio(c['net_income'], c['total_assets']),
+        'return_on_invested_capital': _ratio(c['net_income'], invested_capital),
+        'earnings_yield': c['earnings_yield'],
+        'free_cash_flow_yield': _ratio(c['free_cash_flow'], market_cap),
+        'dividend_yield': c['dividend_yield'],
+        'payout_ratio': c['payout_ratio'],
+        'buyback_yield': c['buyback_yield'],
+        'total_return': total_return,
+    }
+
+
+def ratios_row(fundamentals, latest_price):
+    # Field values for a StockRatios row
+    components = compute_components(fundamentals)
+    ratios = compute_ratios(components, latest_price)
+    row = dict(components)
+    row.update({field: ratios[field] for field in RATIO_FIELDS})
+    row['price'] = ratios['current_price']
+    row['as_of'] = fundamentals.get('as_of')
+    return row
+
+
+def stored_components(stock_ratios):
+    return {field: getattr(stock_ratios, field) for field in COMPONENT_FIELDS + list(INFO_FIELDS)}
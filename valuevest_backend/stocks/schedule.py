@@ -0,0 +1,7 @@
+# Timing of the periodic stocks tasks, read by the Celery beat schedule and by the code relying on it.
+# Kept free of model imports so valuevest_backend/celery.py can load it before the app registry is ready.
+from django.conf import settings
+
+LATEST_PRICE_REFRESH_SECONDS = getattr(settings, 'LATEST_PRICE_REFRESH_SECONDS', 60)     # Beat interval of refresh_latest_prices
+REVALUATION_HOUR = getattr(settings, 'REVALUATION_HOUR', 2)                             # Hour revalue_universe runs at
+RATIOS_HOUR = getattr(settings, 'RATIOS_HOUR', 3)                                       # Hour recompute_stock_ratios runs at, after the revaluation
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .quotes import get_latest_prices
+
+logger = logging.getLogger(__name__)
+
+STREAM_POLL_SECONDS = getattr(settings, 'STREAM_POLL_SECONDS', 15)            # How often each symbol's poller refreshes
+STREAM_KEEPALIVE_SECONDS = getattr(settings, 'STREAM_KEEPALIVE_SECONDS', 20)  # Comment line sent when nothing changed
+STREAM_QUEUE_SIZE = getattr(settings, 'STREAM_QUEUE_SIZE', 100)               # Updates buffered per slow subscriber
+
+
+async def fetch_price(symbol):
+    prices = await sync_to_async(get_latest_prices, thread_sensitive=False)([symbol])
+    return prices.get(symbol)
+
+
+class PriceHub:
+    # One poller per symbol no matter how many clients watch it; each update is fanned out to every
+    # subscriber queue. A poller stops as soon as its last subscriber leaves.
+    def __init__(self, fetch=fetch_price, interval=STREAM_POLL_SECONDS, queue_size=STREAM_QUEUE_SIZE):
+        self.fetch = fetch
+        self.interval = interval
+        self.queue_size = queue_size
+        self.subscribers = {}       # symbol -> set of queues
+        self.pollers = {}           # symbol -> asyncio.Task
+        self.latest = {}            # symbol -> last broadcast update
+
+    def subscribe(self, symbols):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        queue.symbols = set(symbols)
+        for symbol in queue.symbols:
+            self.subscribers.setdefault(symbol, set()).add(queue)
+            if symbol in self.latest:
+                self._offer(queue, self.latest[symbol])
+            if symbol not in self.pollers:
+                self.pollers[symbol] = asyncio.ensure_future(self._poll(symbol))
+        return queue
+
+    def unsubscribe(self, queue):
+        for symbol in queue.symbols:
+            subscribers = self.subscribers.get(symbol)
+            if subscribers is None:
+                continue
+            subscribers.discard(queue)
+            if not subscribers:
+                del self.subscribers[symbol]
+                self.latest.pop(symbol, None)
+                poller = self.pollers.pop(symbol, None)
+                if poller is not None:
+                    poller.cancel()
+
+    def _offer(self, queue, update):
+        # Slow clients lose their oldest update rather than holding memory for the poller
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(update)
+
+    async def _poll(self, symbol):
+        while True:
+            try:
+                price = await self.fetch(symbol)
+            except Exception as e:
+                logger.error(f"Streaming poll failed for {symbol}: {e}")
+                price = None
+
+            previous = self.latest.get(symbol)
+            if price is not None and (previous is None or previous['latest_price'] != price):
+                update = {'symbol': symbol, 'latest_price': price, 'timestamp': timezone.now().isoformat()}
+                self.latest[symbol] = update
+                for queue in list(self.subscribers.get(symbol, ())):
+                    self._offer(queue, update)
+
+            await asyncio.sleep(self.interval)
+
+
+hub = PriceHub()
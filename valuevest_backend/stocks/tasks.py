@@ -0,0 +1,117 @@
+import logging
+
+from celery import chord, shared_task
+from django.utils import timezone
+
+from .models import LatestPrice, Portfolio, Stock, StockRatios, Watchlist
+from .quotes import fetch_latest_prices, get_latest_prices, to_symbol
+from .ratios import COMPONENT_FIELDS, INFO_FIELDS, RATIO_FIELDS, ratios_row
+from .valuations import REVALUATION_UPDATE_FIELDS, apply_update, revalue, valuation_update
+from . import valuation_scripts  # noqa: F401
+from fundamentals_store import store as fundamentals_store
+
+logger = logging.getLogger(__name__)
+
+RATIOS_CHUNK_SIZE = 200
+LATEST_PRICE_BATCH_SIZE = 100
+REVALUATION_CHUNK_SIZE = 200
+RATIOS_UPDATE_FIELDS = COMPONENT_FIELDS + list(INFO_FIELDS) + [field for field in RATIO_FIELDS if field not in INFO_FIELDS] + ['price', 'as_of', 'updated_at']
+
+
+def refresh_stock_ratios(stocks):
+    # Recomputes and upserts the StockRatios rows for the given stocks, returns how many were written
+    prices = get_latest_prices([stock.exchange_ticker for stock in stocks])
+    rows = []
+    for stock in stocks:
+        symbol = to_symbol(stock.exchange_ticker)
+        try:
+            fundamentals = fundamentals_store.get(symbol)
+        except Exception as e:
+            logger.error(f"No fundamentals for {symbol}: {e}")
+            continue
+        rows.append(StockRatios(stock=stock, **ratios_row(fundamentals, prices.get(symbol))))
+
+    StockRatios.objects.bulk_create(rows, update_conflicts=True, unique_fields=['stock'], update_fields=RATIOS_UPDATE_FIELDS)
+    return len(rows)
+
+
+@shared_task
+def recompute_stock_ratios(chunk_size=RATIOS_CHUNK_SIZE):
+    written = 0
+    chunk = []
+    for stock in Stock.objects.order_by('id').iterator(chunk_size=chunk_size):
+        chunk.append(stock)
+        if len(chunk) == chunk_size:
+            written += refresh_stock_ratios(chunk)
+            chunk = []
+    if chunk:
+        written += refresh_stock_ratios(chunk)
+    logger.info(f"Recomputed ratios for {written} stocks")
+    return written
+
+
+def held_symbols():
+    # Distinct Yahoo symbols referenced by any portfolio or watchlist
+    tickers = set(Portfolio.objects.values_list('stock__exchange_ticker', flat=True).distinct())
+    tickers.update(Watchlist.objects.values_list('stock__exchange_ticker', flat=True).distinct())
+    return sorted({to_symbol(ticker) for ticker in tickers})
+
+
+@shared_task
+def refresh_latest_prices(batch_size=LATEST_PRICE_BATCH_SIZE):
+    symbols = held_symbols()
+    written = 0
+    for start in range(0, len(symbols), batch_size):
+        batch = symbols[start:start + batch_size]
+        try:
+            prices = fetch_latest_prices(batch)
+        except Exception as e:
+            logger.error(f"Price refresh failed for {len(batch)} symbols starting at {batch[0]}: {e}")
+            continue
+
+        # Only the LatestPrice table: this runs in a worker, whose in-memory quote cache no web process reads
+        fetched_at = timezone.now()
+        rows = [LatestPrice(symbol=symbol, price=price, fetched_at=fetched_at) for symbol, price in prices.items() if price is not None]
+        LatestPrice.objects.bulk_create(rows, update_conflicts=True, unique_fields=['symbol'], update_fields=['price', 'fetched_at'])
+        written += len(rows)
+
+    logger.info(f"Refreshed {written} of {len(symbols)} held symbols")
+    return written
+
+
+@shared_task
+def value_stock_chunk(stock_ids, force=False):
+    # One chunk of revalue_universe, run by whichever worker picks it up. Nothing is saved here: the changed
+    # fields go back through the result backend to store_valuations.
+    stocks = list(Stock.objects.filter(id__in=stock_ids).order_by('id'))
+    revalued, unchanged, failed = revalue(stocks, force)
+    return {'updates': [valuation_update(stock) for stock in revalued], 'unchanged': unchanged, 'failed': failed}
+
+
+@shared_task
+def store_valuations(chunk_results, batch_size=REVALUATION_CHUNK_SIZE):
+    # Chord callback of revalue_universe: bulk-writes every chunk's updates once all chunks are valued
+    updates = [update for chunk in chunk_results for update in chunk['updates']]
+    stocks = Stock.objects.in_bulk([update['id'] for update in updates])
+    for update in updates:
+        if update['id'] in stocks:          # Deleted while the chunks ran
+            apply_update(stocks[update['id']], update)
+    Stock.objects.bulk_update(list(stocks.values()), REVALUATION_UPDATE_FIELDS, batch_size=batch_size)
+
+    counts = {'revalued': len(stocks), 'unchanged': sum(chunk['unchanged'] for chunk in chunk_results),
+              'failed': sum(chunk['failed'] for chunk in chunk_results)}
+    logger.info(f"Revalued {counts['revalued']} stocks across {len(chunk_results)} chunks, "
+                f"{counts['unchanged']} unchanged, {counts['failed']} failed")
+    return counts
+
+
+@shared_task
+def revalue_universe(chunk_size=REVALUATION_CHUNK_SIZE, force=False):
+    # Nightly incremental revaluation, split across workers: a chord of value_stock_chunk tasks over id chunks, joined
+    # by store_valuations. Only stocks whose statements, rates or model parameters changed are recomputed.
+    # Needs a result backend for the chord; returns the number of chunks queued.
+    stock_ids = list(Stock.objects.order_by('id').values_list('id', flat=True))
+    chunks = [stock_ids[start:start + chunk_size] for start in range(0, len(stock_ids), chunk_size)]
+    if chunks:
+        chord(value_stock_chunk.s(chunk, force) for chunk in chunks)(store_valuations.s())
+    return len(chunks)
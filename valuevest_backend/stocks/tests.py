@@ -1,3 +1,475 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from celery import current_app
+from django.test import SimpleTestCase, TestCase
+from rest_framework.test import APIRequestFactory
+
+from .quotes import PRICE_FRESH, PRICE_MISSING, PRICE_STALE, QuoteCache, get_latest_prices_within, to_symbol
+from .streaming import PriceHub
+from .ratios import COMPONENT_FIELDS, INFO_FIELDS, compute_ratios
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from .models import LatestPrice, Portfolio, Stock, StockRatios, Watchlist
+from .tasks import refresh_latest_prices, revalue_universe, value_stock_chunk
+from .valuations import DCF, ERM_MATURE, apply_valuation, default_model, input_fingerprint, revalue, value_dcf
+from .views import StockViewSet
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class QuoteCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = []
+
+    def loader(self, symbol):
+        self.calls.append(symbol)
+        return 100.0
+
+    def test_to_symbol(self):
+        self.assertEqual(to_symbol('NasdaqGS:aapl '), 'AAPL')
+        self.assertEqual(to_symbol('MSFT'), 'MSFT')
+
+    def test_hit_within_ttl_and_refetch_after_expiry(self):
+        cache = QuoteCache(ttl=60, max_size=10, clock=self.clock)
+        self.assertEqual(cache.get('AAPL', self.loader), 100.0)
+        self.clock.now = 59
+        self.assertEqual(cache.get('AAPL', self.loader), 100.0)
+        self.assertEqual(self.calls, ['AAPL'])
+
+        self.clock.now = 61
+        cache.get('AAPL', self.loader)
+        self.assertEqual(self.calls, ['AAPL', 'AAPL'])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_lru_eviction(self):
+        cache = QuoteCache(ttl=60, max_size=2, clock=self.clock)
+        cache.get('A', self.loader)
+        cache.get('B', self.loader)
+        cache.get('A', self.loader)
+        cache.get('C', self.loader)
+        self.assertIsNone(cache.peek('B'))
+        self.assertEqual(cache.peek('A'), 100.0)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        cache = QuoteCache(ttl=60, max_size=10, clock=self.clock)
+        release = threading.Event()
+
+        def slow_loader(symbol):
+            release.wait(5)
+            return self.loader(symbol)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('AAPL', slow_loader))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while cache.stats()['coalesced'] < 4:
+            if time.monotonic() > deadline:
+                release.set()
+                self.fail(f"Only {cache.stats()['coalesced']} of 4 requests joined the fetch in flight")
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [100.0] * 5)
+        self.assertEqual(self.calls, ['AAPL'])
+
+    def test_waiting_on_a_hung_fetch_times_out(self):
+        cache = QuoteCache(ttl=60, max_size=10, clock=self.clock, wait_timeout=0.05)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        leader = threading.Thread(target=cache.get, args=('AAPL', lambda symbol: release.wait(5) and 100.0))
+        leader.start()
+        deadline = time.monotonic() + 5
+        while 'AAPL' not in cache._inflight and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        with self.assertRaises(TimeoutError):
+            cache.get('AAPL', self.loader)
+        self.assertEqual(cache.get_many(['AAPL', 'MSFT'], lambda symbols: {'MSFT': 200.0}), {'MSFT': 200.0, 'AAPL': None})
+        self.assertEqual(self.calls, [])
+        release.set()
+        leader.join()
+        self.assertEqual(cache.peek('AAPL'), 100.0)
+
+    def test_get_many_batches_only_missing_symbols(self):
+        cache = QuoteCache(ttl=60, max_size=10, clock=self.clock)
+        cache.get('AAPL', self.loader)
+        batches = []
+
+        def bulk_loader(symbols):
+            batches.append(symbols)
+            return {'MSFT': 200.0}
+
+        prices = cache.get_many(['AAPL', 'MSFT', 'XXXX', 'MSFT'], bulk_loader)
+        self.assertEqual(prices, {'AAPL': 100.0, 'MSFT': 200.0, 'XXXX': None})
+        self.assertEqual(batches, [['MSFT', 'XXXX']])
+
+        cache.get_many(['MSFT', 'XXXX'], bulk_loader)
+        self.assertEqual(len(batches), 1)
+
+    def test_peek_stale_returns_expired_price(self):
+        cache = QuoteCache(ttl=60, max_size=10, clock=self.clock)
+        cache.get('AAPL', self.loader)
+        self.clock.now = 120
+        self.assertIsNone(cache.peek('AAPL'))
+        self.assertEqual(cache.peek_stale('AAPL'), 100.0)
+
+
+class PricesWithinDeadlineTestCase(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = QuoteCache(ttl=60, max_size=10, clock=self.clock)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.fetched = []
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(self.pool.shutdown)
+        for target, value in (('stocks.quotes.quote_cache', self.cache), ('stocks.quotes._fetch_pool', self.pool),
+                              ('stocks.quotes.fetch_latest_price', self.fetch)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch(self, symbol):
+        self.fetched.append(symbol)
+        if symbol == 'SLOW':
+            self.release.wait(5)
+        if symbol == 'FAIL':
+            raise ConnectionError('Yahoo unavailable')
+        return 100.0
+
+    def test_fresh_failed_and_missing(self):
+        self.cache.set('CACHED', 50.0)
+        prices = get_latest_prices_within(['NYSE:CACHED', 'NYSE:NEW', 'NYSE:FAIL'], deadline=5)
+        self.assertEqual(prices, {'CACHED': (50.0, PRICE_FRESH), 'NEW': (100.0, PRICE_FRESH), 'FAIL': (None, PRICE_MISSING)})
+        self.assertEqual(self.fetched, ['NEW', 'FAIL'])                 # Cached prices are served without a lookup
+
+    def test_deadline_serves_stale_prices_and_cancels_queued_lookups(self):
+        self.cache.set('OLD', 50.0)
+        self.clock.now = 120                                            # OLD is past its TTL
+        start = time.monotonic()
+        prices = get_latest_prices_within(['NYSE:SLOW', 'NYSE:OLD', 'NYSE:NEW'], deadline=0.1)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(prices, {'SLOW': (None, PRICE_MISSING), 'OLD': (50.0, PRICE_STALE), 'NEW': (None, PRICE_MISSING)})
+
+        # The running lookup still fills the cache, the queued ones never reach upstream
+        self.release.set()
+        self.pool.shutdown(wait=True)
+        self.assertEqual(self.fetched, ['SLOW'])
+        self.assertEqual(self.cache.peek('SLOW'), 100.0)
+
+
+class RefreshLatestPricesTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='investor')
+        stocks = {ticker: Stock.objects.create(exchange_ticker=ticker, cost_of_capital=0.08, cost_of_equity=0.09, return_on_equity=0.12)
+                  for ticker in ('NYSE:AAA', 'NasdaqGS:BBB', 'NYSE:CCC', 'NYSE:DDD', 'NYSE:EEE')}      # EEE neither held nor watched
+        for ticker in ('NYSE:AAA', 'NasdaqGS:BBB'):
+            Portfolio.objects.create(user=user, stock=stocks[ticker], shares=1)
+        for ticker in ('NYSE:AAA', 'NYSE:CCC', 'NYSE:DDD'):
+            Watchlist.objects.create(user=user, stock=stocks[ticker])
+        LatestPrice.objects.create(symbol='AAA', price=1.0, fetched_at=timezone.now() - timezone.timedelta(hours=1))
+
+    def fetch_latest_prices(self, symbols):
+        if symbols[0] == 'DDD':
+            raise ConnectionError('Yahoo unavailable')
+        return {symbol: None if symbol == 'BBB' else 10.0 + len(symbol) for symbol in symbols}
+
+    def test_batches_and_upserts(self):
+        with mock.patch('stocks.tasks.fetch_latest_prices', side_effect=self.fetch_latest_prices) as fetch, \
+                mock.patch.object(LatestPrice.objects, 'bulk_create', wraps=LatestPrice.objects.bulk_create) as bulk_create:
+            self.assertEqual(refresh_latest_prices(batch_size=3), 2)
+
+        self.assertEqual([call.args[0] for call in fetch.call_args_list], [['AAA', 'BBB', 'CCC'], ['DDD']])
+        self.assertEqual(bulk_create.call_count, 1)                 # The failed batch writes nothing
+        self.assertEqual(bulk_create.call_args.kwargs, {'update_conflicts': True, 'unique_fields': ['symbol'],
+                                                        'update_fields': ['price', 'fetched_at']})
+        self.assertEqual(dict(LatestPrice.objects.values_list('symbol', 'price')), {'AAA': 13.0, 'CCC': 13.0})
+        self.assertGreater(LatestPrice.objects.get(symbol='AAA').fetched_at, timezone.now() - timezone.timedelta(minutes=1))
+
+
+class RatiosTestCase(SimpleTestCase):
+    def test_price_overlay_and_missing_inputs(self):
+        components = dict.fromkeys(COMPONENT_FIELDS + list(INFO_FIELDS))
+        components.update({'shares_outstanding': 10.0, 'revenue': 50.0, 'total_assets': 300.0, 'total_liabilities': 100.0,
+                           'current_assets': 80.0, 'current_liabilities': 40.0, 'inventory': 0.0})
+
+        ratios = compute_ratios(components, 20.0)
+        self.assertEqual(ratios['market_cap'], 200.0)
+        self.assertEqual(ratios['ps_ratio'], 4.0)
+        self.assertEqual(ratios['pb_ratio'], 1.0)
+        self.assertEqual(ratios['quick_ratio'], 2.0)
+        self.assertIsNone(ratios['ev_ebitda'])
+
+        self.assertEqual(compute_ratios(components, 40.0)['ps_ratio'], 8.0)
+        self.assertIsNone(compute_ratios(components, None)['market_cap'])
+
+
+class PriceHubTestCase(SimpleTestCase):
+    def test_one_poller_per_symbol_fans_out_to_every_subscriber(self):
+        polls = []
+
+        async def fetch(symbol):
+            polls.append(symbol)
+            return 100.0
+
+        async def scenario():
+            hub = PriceHub(fetch=fetch, interval=60)
+            queues = [hub.subscribe(['AAPL', 'MSFT']) for _ in range(50)]
+            updates = [await asyncio.wait_for(queue.get(), 1) for queue in queues]
+            self.assertEqual(len(hub.pollers), 2)
+
+            for queue in queues:
+                hub.unsubscribe(queue)
+            self.assertEqual(hub.pollers, {})
+            return updates
+
+        updates = asyncio.run(scenario())
+        self.assertEqual(sorted(polls), ['AAPL', 'MSFT'])
+        self.assertEqual(len(updates), 50)
+
+
+class InputFingerprintTestCase(SimpleTestCase):
+    def test_changes_only_with_valuation_inputs(self):
+        stock = Stock(exchange_ticker='NYSE:AAA', cost_of_equity=0.09, return_on_equity=0.12, model='DCF (Negative Revenues)')
+        self.assertEqual(default_model(stock), DCF)
+        fingerprint = input_fingerprint(stock, DCF, '2023-12-31')
+
+        stock.intrinsic_value = 100
+        self.assertEqual(input_fingerprint(stock, DCF, '2023-12-31'), fingerprint)
+        self.assertNotEqual(input_fingerprint(stock, DCF, '2024-12-31'), fingerprint)
+        self.assertNotEqual(input_fingerprint(stock, ERM_MATURE, '2023-12-31'), fingerprint)
+        stock.return_on_equity = 0.15                   # ERM only
+        self.assertEqual(input_fingerprint(stock, DCF, '2023-12-31'), fingerprint)
+        erm_fingerprint = input_fingerprint(stock, ERM_MATURE, '2023-12-31')
+        stock.return_on_equity = 0.12
+        self.assertNotEqual(input_fingerprint(stock, ERM_MATURE, '2023-12-31'), erm_fingerprint)
+        stock.cost_of_equity = 0.1
+        self.assertNotEqual(input_fingerprint(stock, DCF, '2023-12-31'), fingerprint)
+
+
+class FakeFundamentalsStore:
+    # Stored statements dated `as_of`; stale symbols are refreshed through get(), which may move as_of forward
+    def __init__(self, as_of='2023-12-31'):
+        self.as_of = as_of
+        self.stale = set()
+        self.refreshed = []
+
+    def statement_status(self, symbols):
+        return {symbol: (self.as_of, symbol in self.stale) for symbol in symbols}
+
+    def get(self, symbol):
+        self.refreshed.append(symbol)
+        return dcf_fundamentals(self.as_of)
+
+
+class RevalueTestCase(SimpleTestCase):
+    def setUp(self):
+        self.store = FakeFundamentalsStore()
+        self.stocks = [Stock(id=i, exchange_ticker=ticker, cost_of_equity=0.09, return_on_equity=0.12, model=DCF)
+                       for i, ticker in enumerate(('NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC'), start=1)]
+        self.prices = mock.Mock(return_value={'AAA': 50.0, 'BBB': 50.0, 'CCC': 50.0})
+        for target, value in (('stocks.valuations.fundamentals_store', self.store), ('stocks.valuations.get_latest_prices', self.prices)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def revalue(self, force=False):
+        revalued, unchanged, failed = revalue(self.stocks, force)
+        return [stock.exchange_ticker for stock in revalued], unchanged, failed
+
+    def test_only_changed_inputs_are_revalued(self):
+        self.assertEqual(self.revalue(), (['NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC'], 0, 0))     # Never valued
+        self.assertEqual(self.revalue(), ([], 3, 0))
+        self.assertEqual(self.store.refreshed, ['AAA', 'BBB', 'CCC'])       # Fresh statements: skipping a stock reads nothing
+
+        self.stocks[1].cost_of_equity = 0.1
+        self.stocks[2].return_on_equity = 0.2                                                   # Not a DCF input
+        self.prices.reset_mock()
+        self.assertEqual(self.revalue(), (['NYSE:BBB'], 2, 0))
+        self.prices.assert_called_once_with(['NYSE:BBB'])                                      # Prices of the changed stocks only
+
+        # Stale statements are refreshed first, a new as-of date revalues every stock
+        self.store.stale = {'AAA'}
+        self.assertEqual(self.revalue(), ([], 3, 0))
+        self.store.as_of = '2024-12-31'
+        self.assertEqual(self.revalue(), (['NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC'], 0, 0))
+        self.assertTrue(all(stock.valuation_fingerprint == input_fingerprint(stock, DCF, '2024-12-31') for stock in self.stocks))
+
+    def test_force_revalues_everything(self):
+        self.revalue()
+        self.prices.reset_mock()
+        self.assertEqual(self.revalue(force=True), (['NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC'], 0, 0))
+        self.prices.assert_called_once_with(['NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC'])             # One lookup for the chunk
+
+    def test_missing_fundamentals_count_as_failed(self):
+        self.store.stale = {'BBB'}
+        with mock.patch.object(self.store, 'get', side_effect=LookupError('delisted')):
+            self.assertEqual(self.revalue(), ([], 0, 3))
+
+
+class RevalueUniverseTestCase(TestCase):
+    # Runs the chord eagerly on the in-memory broker and result backend, as a worker-less stand-in
+    def setUp(self):
+        overrides = {'broker_url': 'memory://', 'result_backend': 'cache+memory://', 'task_always_eager': True}
+        self.addCleanup(current_app.conf.update, {key: current_app.conf[key] for key in overrides})     # mock.patch.dict cannot restore Celery's Settings
+        current_app.conf.update(overrides)
+        for ticker in ('NYSE:AAA', 'NYSE:BBB', 'NYSE:CCC', 'NYSE:DDD', 'NYSE:EEE'):
+            Stock.objects.create(exchange_ticker=ticker, cost_of_capital=0.08, cost_of_equity=0.09, return_on_equity=0.12)
+
+    def fake_revalue(self, stocks, force=False):
+        # Values every stock but NYSE:CCC at 10 per id, without fundamentals or quotes
+        revalued = [stock for stock in stocks if stock.exchange_ticker != 'NYSE:CCC']
+        for stock in revalued:
+            apply_valuation(stock, {'value': 10.0 * stock.id, 'wacc': 0.08, 'model': DCF, 'percentage_change': 0.5}, 'f' * 40)
+        return revalued, 0, len(stocks) - len(revalued)
+
+    def test_chunks_are_valued_then_written_once(self):
+        with mock.patch('stocks.tasks.revalue', side_effect=self.fake_revalue) as revalue, \
+                mock.patch.object(Stock.objects, 'bulk_update', wraps=Stock.objects.bulk_update) as bulk_update:
+            self.assertEqual(revalue_universe.delay(chunk_size=2).get(), 3)
+            chunk = value_stock_chunk(list(Stock.objects.values_list('id', flat=True)))
+        self.assertEqual(json.loads(json.dumps(chunk))['failed'], 1)       # Travels through the result backend as JSON
+
+        self.assertEqual(revalue.call_count, 4)
+        self.assertEqual(bulk_update.call_count, 1)
+        for stock in Stock.objects.all():
+            if stock.exchange_ticker == 'NYSE:CCC':
+                self.assertIsNone(stock.valued_at)
+            else:
+                self.assertEqual(float(stock.intrinsic_value), 10.0 * stock.id)
+                self.assertEqual(float(stock.growth), 0.5)
+                self.assertEqual(stock.valuation_fingerprint, 'f' * 40)
+                self.assertIsNotNone(stock.valued_at)
+
+
+
+YEARS = pd.to_datetime(['2023-12-31', '2022-12-31', '2021-12-31', '2020-12-31', '2019-12-31'])
+
+
+def yfinance_frame(rows):
+    # yfinance statements: one row per line item, newest period first, raw units; rows given oldest first in millions
+    return pd.DataFrame({name: np.asarray(values[::-1], dtype=float) * 1000000 for name, values in rows.items()}, index=YEARS).T
+
+
+def dcf_fundamentals(as_of='2023-12-31'):
+    # What fundamentals_store.get() returns for a stock DCF can value
+    last = [np.nan] * 4
+    return {
+        'balance_sheet': yfinance_frame({'Total Debt': last + [400], 'Cash Cash Equivalents And Short Term Investments': last + [150]}),
+        'income_stmt': yfinance_frame({'Total Revenue': [800, 900, 1000, 1150, 1250], 'Interest Expense': last + [20]}),
+        'cashflow': yfinance_frame({'Operating Cash Flow': [120, 140, 150, 180, 200], 'Capital Expenditure': [-40, -45, -50, -60, -65]}),
+        'financials': pd.DataFrame({'Tax Rate For Calcs': [0.21] * 5}, index=YEARS).T,
+        'info': {'sharesOutstanding': 100000000},
+        'as_of': as_of,
+    }
+
+
+class GetValuationTestCase(TestCase):
+    def setUp(self):
+        self.stock = Stock.objects.create(exchange_ticker='NYSE:AAA', cost_of_capital=0.08, cost_of_equity=0.09, return_on_equity=0.12)
+        self.view = StockViewSet.as_view({'get': 'get_valuation'})
+        self.factory = APIRequestFactory()
+        self.store = mock.Mock()
+        self.store.get.return_value = dcf_fundamentals()
+        for target, value in (('stocks.valuations.fundamentals_store', self.store),
+                              ('stocks.valuations.get_latest_prices', mock.Mock(return_value={'AAA': 50.0})),
+                              ('stocks.valuations.valuation_cache', QuoteCache(ttl=60, max_size=10))):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, **params):
+        return self.view(self.factory.get('/stocks/get_valuation/', params))
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.get().status_code, 400)
+        self.assertEqual(self.get(ticker='NYSE:AAA', model='Graham').status_code, 400)
+        self.assertEqual(self.get(ticker='NYSE:ZZZ').status_code, 404)
+        self.store.get.side_effect = LookupError('no fundamentals')
+        response = self.get(ticker='NYSE:AAA')
+        self.assertEqual(response.status_code, 422)
+        self.assertIn('no fundamentals', response.data['error'])
+
+    def test_valuations_are_cached_per_fingerprint(self):
+        with mock.patch('stocks.valuations.value_dcf', wraps=value_dcf) as compute:
+            first = self.get(ticker='NYSE:AAA')
+            second = self.get(ticker='NYSE:AAA', model=DCF)
+            self.assertEqual(compute.call_count, 1)
+
+            self.stock.cost_of_equity = 0.1
+            self.stock.save()
+            third = self.get(ticker='NYSE:AAA')
+            self.assertEqual(compute.call_count, 2)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.data['exchange_ticker'], 'NYSE:AAA')
+        self.assertEqual(first.data['model'], DCF)
+        self.assertAlmostEqual(first.data['percentage_change'], (first.data['value'] - 50.0) / 50.0)
+        self.assertEqual(second.data, first.data)
+        self.assertNotEqual(third.data['fingerprint'], first.data['fingerprint'])
+
+
+class ScreenStocksTestCase(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        for ticker, pe_ratio, market_cap in (('NYSE:AAA', 12.0, 500.0), ('NYSE:BBB', 25.0, 900.0), ('NYSE:CCC', None, 700.0),
+                                             ('NYSE:DDD', 8.0, 100.0)):
+            stock = Stock.objects.create(exchange_ticker=ticker, company_name=ticker[5:], cost_of_capital=0.08, cost_of_equity=0.09, return_on_equity=0.12)
+            StockRatios.objects.create(stock=stock, pe_ratio=pe_ratio, market_cap=market_cap)
+
+    def screen(self, **params):
+        return StockViewSet.as_view({'get': 'screen_stocks'})(self.factory.get('/stocks/screen_stocks/', params))
+
+    def tickers(self, **params):
+        response = self.screen(**params)
+        self.assertEqual(response.status_code, 200)
+        return [row['exchange_ticker'] for row in response.data]
+
+    def test_filters_and_orders_in_sql(self):
+        self.assertEqual(self.tickers(order_by='-pe_ratio'), ['NYSE:BBB', 'NYSE:AAA', 'NYSE:DDD'])        # No P/E, not ranked
+        self.assertEqual(self.tickers(order_by='pe_ratio', pe_ratio__lte='15'), ['NYSE:DDD', 'NYSE:AAA'])
+        self.assertEqual(self.tickers(order_by='market_cap', market_cap__gte='600'), ['NYSE:CCC', 'NYSE:BBB'])
+        self.assertEqual(self.tickers(order_by='market_cap', company_name__lte='B', market_cap__lt='600'),            # Unknown filters ignored
+                         ['NYSE:DDD', 'NYSE:AAA', 'NYSE:CCC', 'NYSE:BBB'])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.screen(pe_ratio__lte='cheap').status_code, 400)
+        self.assertEqual(self.screen(order_by='-company_name').status_code, 400)
+
+    def test_stock_details_compute_missing_ratios_on_demand(self):
+        stock = Stock.objects.create(exchange_ticker='NYSE:EEE', company_name='EEE', cost_of_capital=0.08, cost_of_equity=0.09, return_on_equity=0.12)
+        store = mock.Mock()
+        store.get.return_value = dict(dcf_fundamentals(), info={'sharesOutstanding': 100000000, 'trailingPE': 14.0})
+        details = StockViewSet.as_view({'get': 'get_stock_details'})
+        with mock.patch('stocks.tasks.fundamentals_store', store), \
+                mock.patch('stocks.tasks.get_latest_prices', return_value={'EEE': 50.0}), \
+                mock.patch('stocks.views.get_latest_price', return_value=50.0):
+            response = details(self.factory.get('/stocks/get_stock_details/', {'ticker': 'NYSE:EEE'}))
+            self.assertEqual(details(self.factory.get('/stocks/get_stock_details/', {'ticker': 'NYSE:ZZZ'})).status_code, 404)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['pe_ratio'], 14.0)
+        self.assertEqual(response.data['market_cap'], 5000.0)
+        ratios = StockRatios.objects.get(stock=stock)
+        self.assertEqual((ratios.price, ratios.as_of.isoformat()), (50.0, '2023-12-31'))
+        store.get.assert_called_once_with('EEE')
@@ -0,0 +1,12 @@
+# Puts the standalone valuation_scripts folder on the import path so the app shares its
+# modules (market data client, valuation models) instead of keeping copies of them.
+import os
+import sys
+
+from django.conf import settings
+
+VALUATION_SCRIPTS_DIR = getattr(settings, 'VALUATION_SCRIPTS_DIR', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'valuation_scripts'))
+
+if VALUATION_SCRIPTS_DIR not in sys.path:
+    sys.path.append(VALUATION_SCRIPTS_DIR)
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+from decimal import Decimal
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .quotes import QuoteCache, get_latest_prices, to_symbol
+from . import valuation_scripts  # noqa: F401
+from fundamentals_store import store as fundamentals_store
+from dcf import dcf_inputs
+from erm import erm_inputs
+from valuation import (DCF, DCF_GROWTH_RATE, ERM_HIGH_GROWTH, ERM_MATURE, ERM_PERIODS, FORECAST_YEARS, NUMBER_OF_YEARS,
+                       STABLE_GROWTH_RATE, as_dict, fingerprint, value_dcf, value_erm)
+
+logger = logging.getLogger(__name__)
+
+VALUATION_CACHE_TTL = getattr(settings, 'VALUATION_CACHE_TTL', 3600)            # Seconds a computed valuation is reused
+VALUATION_CACHE_MAX_SIZE = getattr(settings, 'VALUATION_CACHE_MAX_SIZE', 2048)  # Fingerprints kept before LRU eviction
+VALUATION_MODELS = (DCF, ERM_HIGH_GROWTH, ERM_MATURE)
+
+# Input fingerprint -> valuation. Same inputs give the same answer, so a hit is always correct;
+# the TTL only bounds memory for fingerprints that will not come back.
+valuation_cache = QuoteCache(ttl=VALUATION_CACHE_TTL, max_size=VALUATION_CACHE_MAX_SIZE)
+
+
+def default_model(stock):
+    # The model the batch run chose for this stock, DCF when it has not been valued yet
+    return stock.model if stock.model in (ERM_HIGH_GROWTH, ERM_MATURE) else DCF
+
+
+def valuation_inputs(stock, model, fundamentals, latest_price):
+    # DCFInputs / ERMInputs from the stored yfinance statements; no local stockanalysis workbook on the server
+    symbol = to_symbol(stock.exchange_ticker)
+    cost_of_equity = float(stock.cost_of_equity)
+    if not cost_of_equity:
+        raise Exception("Missing cost of equity")
+    info = fundamentals.get('info', {})
+    balance_sheet = fundamentals.get('balance_sheet')
+    income_stmt = fundamentals.get('income_stmt')
+
+    if model == DCF:
+        financials_sorted = fundamentals['financials'].transpose().sort_index(ascending=False)
+        return dcf_inputs(symbol, latest_price, balance_sheet, income_stmt, fundamentals.get('cashflow'), financials_sorted, None,
+                          cost_of_equity, DCF_GROWTH_RATE, NUMBER_OF_YEARS, info, '')
+    high_growth_period, stable_growth_period = ERM_PERIODS[model]
+    return erm_inputs(symbol, balance_sheet, income_stmt, None, cost_of_equity, float(stock.return_on_equity), high_growth_period,
+                      stable_growth_period, NUMBER_OF_YEARS, '', info, STABLE_GROWTH_RATE)
+
+
+def value_stock(stock, model=None, prices=None):
+    # Values one stock in-process from its stored fundamentals and the latest price.
+    # prices: {symbol: price} already resolved for a batch of stocks, looked up here when not given
+    model = model or default_model(stock)
+    symbol = to_symbol(stock.exchange_ticker)
+    fundamentals = fundamentals_store.get(symbol)
+    if prices is None:
+        prices = get_latest_prices([stock.exchange_ticker])
+    latest_price = prices.get(symbol)
+
+    inputs = valuation_inputs(stock, model, fundamentals, latest_price)
+    key = fingerprint(inputs)
+    compute = value_dcf if model == DCF else value_erm
+    valuation = valuation_cache.get(key, lambda _: as_dict(compute(inputs)))
+
+    valuation = dict(valuation, fingerprint=key, fundamentals_as_of=fundamentals.get('as_of'), latest_price=latest_price)
+    if latest_price and valuation['value'] is not None:
+        valuation['percentage_change'] = (valuation['value'] - latest_price) / latest_price
+    return valuation
+
+
+# Stock field -> valuation key, for the fields a revaluation overwrites
+STOCK_VALUATION_FIELDS = {
+    'intrinsic_value': 'value',
+    'weighted_average_cost_of_capital': 'wacc',
+    'enterprise_value': 'enterprise_value',
+    'equity_value': 'equity_value',
+    'terminal_value': 'terminal_value',
+    'discounted_tv': 'discounted_terminal_value',
+    'book_value_of_equity_per_share': 'book_value_equity_per_share',
+    'discounted_excess_returns': 'discounted_excess_return_terminal_stage',
+}
+REVALUATION_UPDATE_FIELDS = list(STOCK_VALUATION_FIELDS) + ['model', 'growth', 'valuation_fingerprint', 'valued_at']
+
+
+def input_fingerprint(stock, model, as_of):
+    # Hash of what a stored valuation depends on apart from the price: statements date, the stock's rates and the
+    # model parameters. Unlike fingerprint(inputs) it needs neither the statements nor a quote to compute.
+    # Return on equity only feeds ERM, so a new ROE leaves DCF valuations alone.
+    parameters = [model, as_of, float(stock.cost_of_equity), NUMBER_OF_YEARS, FORECAST_YEARS]
+    parameters += [DCF_GROWTH_RATE] if model == DCF else [float(stock.return_on_equity), ERM_PERIODS[model], STABLE_GROWTH_RATE]
+    return hashlib.sha1(repr(parameters).encode()).hexdigest()
+
+
+def apply_valuation(stock, valuation, input_hash):
+    for field, key in STOCK_VALUATION_FIELDS.items():
+        if valuation.get(key) is not None:
+            setattr(stock, field, valuation[key])
+    stock.model = valuation['model']
+    if valuation.get('percentage_change') is not None:
+        stock.growth = valuation['percentage_change']        # A fraction, like the imported Growth column the rankings filter on
+    stock.valuation_fingerprint = input_hash
+    stock.valued_at = timezone.now()
+
+
+def valuation_update(stock):
+    # The fields apply_valuation() set, JSON serializable so a Celery worker can hand them to the task writing them
+    update = {field: float(value) if isinstance(value, Decimal) else value
+              for field, value in ((field, getattr(stock, field)) for field in REVALUATION_UPDATE_FIELDS)}
+    update['valued_at'] = stock.valued_at.isoformat() if stock.valued_at else None
+    update['id'] = stock.id
+    return update
+
+
+def apply_update(stock, update):
+    for field in REVALUATION_UPDATE_FIELDS:
+        setattr(stock, field, update[field])
+    stock.valued_at = parse_datetime(update['valued_at']) if update['valued_at'] else None
+
+
+def revalue(stocks, force=False):
+    # Revalues the stocks whose input fingerprint changed since their last valuation.
+    # Returns (revalued stocks, unchanged count, failed count); saving the revalued ones is up to the caller.
+    status = fundamentals_store.statement_status([to_symbol(stock.exchange_ticker) for stock in stocks])
+    changed, revalued, unchanged, failed = [], [], 0, 0
+    for stock in stocks:
+        symbol = to_symbol(stock.exchange_ticker)
+        model = default_model(stock)
+        as_of, stale = status.get(symbol, (None, True))
+        if stale:
+            # New statements may be out: let the store refresh them before comparing
+            try:
+                as_of = fundamentals_store.get(symbol)['as_of']
+            except Exception as e:
+                logger.error(f"No fundamentals for {symbol}: {e}")
+                failed += 1
+                continue
+
+        if not force and input_fingerprint(stock, model, as_of) == stock.valuation_fingerprint:
+            unchanged += 1
+            continue
+        changed.append((stock, model))
+
+    # One price lookup for every stock that needs valuing instead of one per stock
+    prices = get_latest_prices([stock.exchange_ticker for stock, _ in changed]) if changed else {}
+    for stock, model in changed:
+        try:
+            valuation = value_stock(stock, model, prices)
+        except Exception as e:
+            logger.error(f"Revaluation of {stock.exchange_ticker} failed: {e}")
+            failed += 1
+            continue
+        if valuation['value'] is None:
+            failed += 1
+            continue
+        apply_valuation(stock, valuation, input_fingerprint(stock, model, valuation['fundamentals_as_of']))
+        revalued.append(stock)
+    return revalued, unchanged, failed
@@ -1,17 +1,24 @@
+import asyncio
+import json
 import logging
+from asgiref.sync import sync_to_async
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import Stock, Watchlist, Portfolio
+from .models import Stock, StockRatios, Watchlist, Portfolio
 from .serializers import StockSerializer
+from .quotes import get_latest_price, get_latest_prices, get_latest_prices_within, to_symbol, quote_cache
+from .ratios import RATIO_FIELDS, compute_ratios, stored_components
+from .tasks import refresh_stock_ratios
+from .streaming import STREAM_KEEPALIVE_SECONDS, hub
+from .valuations import VALUATION_MODELS, value_stock
 from django.contrib.auth.models import User
 from django.db.models import Q
 from django.core.paginator import Paginator
 from django.shortcuts import get_object_or_404
 from django.db.models import Count
 from django.db import transaction
-import yfinance as yf
-import math, time
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 
 logger = logging.getLogger(__name__)
 
@@ -131,20 +138,16 @@ class StockViewSet(viewsets.ModelViewSet):
         try:
             user_id = request.query_params.get('user_id')
             user = User.objects.get(id=user_id)
-            watchlist = Watchlist.objects.filter(user=user)
+            watchlist = Watchlist.objects.filter(user=user).select_related('stock')
             watchlist_data = []
+            prices = get_latest_prices([item.stock.exchange_ticker for item in watchlist])
             
             for item in watchlist:
-                ticker = item.stock.exchange_ticker.split(':', 1)[1]  # Split to get symbol
-                print(ticker)
+                ticker = to_symbol(item.stock.exchange_ticker)
                 try:
-                    # Call yfinance for each ticker
-                    stock = yf.Ticker(ticker)  
-                    hist = stock.history(period="1d")
+                    latest_price = prices.get(ticker)
 
-                    if not hist.empty and 'Close' in hist.columns:
-                        latest_price = float(hist['Close'].iloc[0])
-                        
+                    if latest_price is not None:
                         watchlist_data.append({
                         'company_name': item.stock.company_name,
                         'latest_price': latest_price,
@@ -209,17 +212,16 @@ class StockViewSet(viewsets.ModelViewSet):
         user_id = request.query_params.get('user_id')
         user = User.objects.get(id=user_id)
 
-        portfolio_items = Portfolio.objects.filter(user=user)
+        portfolio_items = Portfolio.objects.filter(user=user).select_related('stock')
         portfolio_data = []
+        prices = get_latest_prices([item.stock.exchange_ticker for item in portfolio_items])
 
         for item in portfolio_items:
-            symbol = item.stock.exchange_ticker.split(':', 1)[1]
+            symbol = to_symbol(item.stock.exchange_ticker)
             try:
-                stock = yf.Ticker(symbol)  
-                hist = stock.history(period="1d")
+                latest_price = prices.get(symbol)
 
-                if not hist.empty and 'Close' in hist.columns:
-                    latest_price = float(hist['Close'].iloc[0])
+                if latest_price is not None:
                     price_change = ((latest_price - float(item.purchase_price)) / float(item.purchase_price)) * 100
                     
                     portfolio_data.append({
@@ -261,9 +263,7 @@ class StockViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Stock already exists in the portfolio'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            symbol = ticker.split(':')[1].strip().upper()
-            stock_info = yf.Ticker(symbol).history(period="1d")
-            latest_price = float(stock_info['Close'].iloc[0])
+            latest_price = float(get_latest_price(ticker))
         except Exception as e:
             return Response({'error': 'Failed to fetch stock price'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -298,7 +298,8 @@ class StockViewSet(viewsets.ModelViewSet):
     def get_portfolio_status(self, request):
         user_id = request.query_params.get('user_id')
         user = User.objects.get(id=user_id)
-        portfolio_items = Portfolio.objects.filter(user=user)
+        portfolio_items = Portfolio.objects.filter(user=user).select_related('stock')
+        prices = get_latest_prices([item.stock.exchange_ticker for item in portfolio_items])
         
         portfolio_value = 0
         total_pnl = 0
@@ -306,23 +307,20 @@ class StockViewSet(viewsets.ModelViewSet):
         total_market_value = 0
         
         for item in portfolio_items:
-            symbol = item.stock.exchange_ticker.split(':', 1)[1]
+            symbol = to_symbol(item.stock.exchange_ticker)
             try:
-                stock_info = yf.Ticker(symbol)
-                hist = stock_info.history(period="1d")
-                if not hist.empty:
-                    if 'Close' in hist.columns:
-                        current_price = float(hist['Close'].iloc[0])
-                        purchase_price = float(item.purchase_price)
-                        market_value = item.shares * current_price
-                        cost_basis = item.shares * item.purchase_price
-                        
-                        portfolio_value += market_value
-                        total_market_value += market_value
-                        total_cost_basis += float(cost_basis)
-                        
-                        pnl = (current_price - purchase_price) * item.shares
-                        total_pnl += pnl
+                current_price = prices.get(symbol)
+                if current_price is not None:
+                    purchase_price = float(item.purchase_price)
+                    market_value = item.shares * current_price
+                    cost_basis = item.shares * item.purchase_price
+                    
+                    portfolio_value += market_value
+                    total_market_value += market_value
+                    total_cost_basis += float(cost_basis)
+                    
+                    pnl = (current_price - purchase_price) * item.shares
+                    total_pnl += pnl
             except Exception as e:
                 print(f"Error fetching {symbol}: {e}")
         
@@ -351,6 +349,13 @@ class StockViewSet(viewsets.ModelViewSet):
 
 
 
+    ### Market Data Actions ###
+    @action(detail=False, methods=['get'])
+    def get_quote_cache_stats(self, request):
+        return Response(quote_cache.stats())
+
+
+
     ### Intrinsic Valuation Actions ###
     @action(detail=False, methods=['get'])
     def get_intrinsic(self, request):
@@ -359,8 +364,7 @@ class StockViewSet(viewsets.ModelViewSet):
         intrinsic_value = None
         latest_price = None
         try:
-            stock = yf.Ticker(symbol)
-            latest_price = stock.info['previousClose']
+            latest_price = get_latest_price(symbol)
             stock_model = get_object_or_404(Stock, exchange_ticker=ticker)
             intrinsic_value = float(stock_model.intrinsic_value)
 
@@ -369,23 +373,47 @@ class StockViewSet(viewsets.ModelViewSet):
 
         return Response({'Intrinsic_Value': intrinsic_value, 'Latest_Price': latest_price})
 
+    @action(detail=False, methods=['get'])
+    def get_valuation(self, request):
+        # Values the stock now instead of reading the last batch result, e.g. ?ticker=NasdaqGS:AAPL&model=DCF.
+        # model defaults to the one the batch run chose; results are cached per input fingerprint.
+        ticker = request.query_params.get('ticker', None)
+        model = request.query_params.get('model', None)
+
+        if ticker is None:
+            return Response({'error': 'Ticker parameter missing.'}, status=status.HTTP_400_BAD_REQUEST)
+        if model is not None and model not in VALUATION_MODELS:
+            return Response({'error': f'Unknown model, expected one of {", ".join(VALUATION_MODELS)}.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        stock = Stock.objects.filter(exchange_ticker=ticker).first()
+        if stock is None:
+            raise Http404
+
+        try:
+            valuation = value_stock(stock, model)
+        except Exception as e:
+            print(f"Valuation of {ticker} not possible: {e}")
+            return Response({'error': f'Valuation not possible: {e}'}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        valuation['exchange_ticker'] = ticker
+        return Response(valuation)
+
 
     @action(detail=False, methods=['get'])
     def get_ranking(self, request):
         stocks = Stock.objects.filter(growth__gt=0, growth__lte=25)
 
-        top_stocks = stocks.order_by('-growth')[:50]
+        top_stocks = list(stocks.order_by('-growth')[:50])
+        prices = get_latest_prices_within([stock.exchange_ticker for stock in top_stocks])
 
         over_under_valued_stocks = []
         counter = 0
         for stock in top_stocks:
             try:
                 company_name = stock.company_name
-                symbol = stock.exchange_ticker.split(':')[1].strip().upper()
-                yf_stock = yf.Ticker(symbol)
-                latest_price = float(yf_stock.info['previousClose'])
+                latest_price, price_status = prices[to_symbol(stock.exchange_ticker)]
                 intrinsic_value = float(stock.intrinsic_value)
-                price_change = ((intrinsic_value - latest_price) / latest_price) * 100
+                price_change = ((intrinsic_value - latest_price) / latest_price) * 100 if latest_price else None
                 original_growth = stock.growth * 100
                 counter += 1
 
@@ -393,7 +421,8 @@ class StockViewSet(viewsets.ModelViewSet):
                     'company_name': company_name,
                     'price_change': price_change,
                     'growth': original_growth,
-                    'count': counter
+                    'count': counter,
+                    'price_status': price_status,
                 })
 
             except Exception as e:
@@ -424,19 +453,17 @@ class StockViewSet(viewsets.ModelViewSet):
         stocks = stocks.filter(growth__gt=0, growth__lte=25)
 
         # Top 50 in Desc (Growth)
-        top_stocks = stocks.order_by('-growth')[:50]
+        top_stocks = list(stocks.order_by('-growth')[:50])
+        prices = get_latest_prices_within([stock.exchange_ticker for stock in top_stocks])
 
         over_under_valued_stocks = []
         counter = 0
         for stock in top_stocks:
             try:
                 company_name = stock.company_name
-                symbol = stock.exchange_ticker.split(':')[1].strip().upper()
-                yf_stock = yf.Ticker(symbol)
-                latest_price = float(yf_stock.info['previousClose'])
+                latest_price, price_status = prices[to_symbol(stock.exchange_ticker)]
                 intrinsic_value = float(stock.intrinsic_value)
-                price_change = ((intrinsic_value - latest_price) / latest_price) * 100
-                price_change = round(price_change, 0)
+                price_change = round(((intrinsic_value - latest_price) / latest_price) * 100, 0) if latest_price else None
                 intrinsic_value = round(intrinsic_value, 2)
                 growth = stock.growth * 100
                 counter += 1
@@ -452,6 +479,7 @@ class StockViewSet(viewsets.ModelViewSet):
                     'industry_group': stock.industry_group,
                     'growth': growth,
                     'exchange_ticker': stock.exchange_ticker,
+                    'price_status': price_status,   # fresh, stale or missing
                 })
 
             except Exception as e:
@@ -470,143 +498,20 @@ class StockViewSet(viewsets.ModelViewSet):
         symbol = ticker.split(':')[1].strip().upper()
 
         try:
-            stock_model = get_object_or_404(Stock, exchange_ticker=ticker)
-            yf_stock = yf.Ticker(symbol)
-
-            income_stmt = yf_stock.financials
-            balance_sheet = yf_stock.balance_sheet
-            cashflow_stmt = yf_stock.cashflow
-
             try:
-                net_income = income_stmt.at['Net Income', income_stmt.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                net_income = "Not found"
+                stock_ratios = StockRatios.objects.select_related('stock').get(stock__exchange_ticker=ticker)
+            except StockRatios.DoesNotExist:
+                # Not materialized yet, compute this one now instead of waiting for the next recompute_stock_ratios run
+                refresh_stock_ratios([get_object_or_404(Stock, exchange_ticker=ticker)])
+                stock_ratios = StockRatios.objects.select_related('stock').get(stock__exchange_ticker=ticker)
+            stock_model = stock_ratios.stock
 
             try:
-                shareholders_equity = balance_sheet.at['Stockholders Equity', balance_sheet.columns[0]] / 1000000
-                time.sleep(0.05)
+                latest_price = float(get_latest_price(symbol))
             except:
-                shareholders_equity = "Not found"
-
-            roe = net_income / shareholders_equity if (net_income != "Not found") and (shareholders_equity != "Not found") else "Not found"
+                latest_price = stock_ratios.price
 
-            try:
-                total_assets = balance_sheet.at['Total Assets', balance_sheet.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                total_assets = "Not found"
-
-            try:
-                total_liabilities = balance_sheet.at['Total Liabilities Net Minority Interest', balance_sheet.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                total_liabilities = "Not found"
-
-            total_book_value_equity = total_assets - total_liabilities if (total_assets != "Not found") and (total_liabilities != "Not found") else "Not found"
-
-            try:
-                shares_outstanding = yf_stock.info['sharesOutstanding'] / 1000000
-                time.sleep(0.05)
-            except:
-                shares_outstanding = "Not found"
-
-            try:
-                stock_info = yf_stock.history(period="1d")
-                latest_price = float(stock_info['Close'].iloc[0])
-            except:
-                latest_price = "Not found"
-
-            market_cap = latest_price * shares_outstanding if (latest_price != "Not found") and (shares_outstanding != "Not found") and not math.isnan(shares_outstanding) and shares_outstanding != 0 else "Not found"
-
-            try:
-                total_debt = balance_sheet.at['Total Debt', balance_sheet.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                total_debt = "Not found"
-
-            try:
-                enterprise_value = yf_stock.info['enterpriseValue'] / 1000000
-                time.sleep(0.05)
-            except:
-                enterprise_value = "Not found"
-
-            try:
-                revenue = income_stmt.at['Total Revenue', income_stmt.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                revenue = "Not found"
-
-            try:
-                ebitda = yf_stock.info['ebitda'] / 1000000
-                time.sleep(0.05)
-            except:
-                ebitda = "Not found"
-
-            try:
-                ebit = income_stmt.at['Ebit', income_stmt.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                ebit = "Not found"
-
-            try:
-                free_cash_flow = cashflow_stmt.at['Free Cash Flow', cashflow_stmt.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                free_cash_flow = "Not found"
-
-            try:
-                operating_cash_flow = cashflow_stmt.at['Total Cash From Operating Activities', cashflow_stmt.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                operating_cash_flow = "Not found"
-
-            try:
-                current_assets = balance_sheet.at['Total Current Assets', balance_sheet.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                current_assets = "Not found"
-
-            try:
-                current_liabilities = balance_sheet.at['Total Current Liabilities', balance_sheet.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                current_liabilities = "Not found"
-
-            try:
-                inventory = balance_sheet.at['Inventory', balance_sheet.columns[0]] / 1000000
-                time.sleep(0.05)
-            except:
-                inventory = "Not found"
-
-            try:
-                invested_capital = total_assets - current_liabilities if (total_assets != "Not found") and (current_liabilities != "Not found") else "Not found"
-            except:
-                invested_capital = "Not found"
-
-            try:
-                earnings_yield = yf_stock.info['earningsYield']
-                time.sleep(0.05)
-            except:
-                earnings_yield = "Not found"
-
-            try:
-                dividend_yield = yf_stock.info['dividendYield']
-                time.sleep(0.05)
-            except:
-                dividend_yield = "Not found"
-
-            try:
-                payout_ratio = yf_stock.info['payoutRatio']
-                time.sleep(0.05)
-            except:
-                payout_ratio = "Not found"
-
-            try:
-                buyback_yield = yf_stock.info['buybackYield']
-                time.sleep(0.05)
-            except:
-                buyback_yield = "Not found"
+            ratios = compute_ratios(stored_components(stock_ratios), latest_price)
 
             stock_details = {
                 'company_name': stock_model.company_name,
@@ -614,36 +519,9 @@ class StockViewSet(viewsets.ModelViewSet):
                 'sector': stock_model.primary_sector,
                 'industry_group': stock_model.industry_group,
                 'country': stock_model.country,
-                'current_price': latest_price,
-                'high_price': yf_stock.info.get('dayHigh', "Not found"),
-                'low_price': yf_stock.info.get('dayLow', "Not found"),
-                'market_cap': market_cap,
-                'pe_ratio': yf_stock.info.get('trailingPE', "Not found"),
-                'ps_ratio': market_cap / revenue if (market_cap != "Not found") and (revenue != "Not found") else "Not found",
-                'pb_ratio': market_cap / total_book_value_equity if (market_cap != "Not found") and (total_book_value_equity != "Not found") else "Not found",
-                'p_fcf_ratio': market_cap / free_cash_flow if (market_cap != "Not found") and (free_cash_flow != "Not found") else "Not found",
-                'p_ocf_ratio': market_cap / operating_cash_flow if (market_cap != "Not found") and (operating_cash_flow != "Not found") else "Not found",
-                'ev_revenue': enterprise_value / revenue if (enterprise_value != "Not found") and (revenue != "Not found") else "Not found",
-                'ev_ebitda': enterprise_value / ebitda if (enterprise_value != "Not found") and (ebitda != "Not found") else "Not found",
-                'ev_ebit': enterprise_value / ebit if (enterprise_value != "Not found") and (ebit != "Not found") else "Not found",
-                'ev_fcf': enterprise_value / free_cash_flow if (enterprise_value != "Not found") and (free_cash_flow != "Not found") else "Not found",
-                'debt_equity': total_debt / shareholders_equity if (total_debt != "Not found") and (shareholders_equity != "Not found") else "Not found",
-                'debt_ebitda': total_debt / ebitda if (total_debt != "Not found") and (ebitda != "Not found") else "Not found",
-                'debt_fcf': total_debt / free_cash_flow if (total_debt != "Not found") and (free_cash_flow != "Not found") else "Not found",
-                'quick_ratio': (current_assets - inventory) / current_liabilities if (current_assets != "Not found") and (inventory != "Not found") and \
-                                (current_liabilities != "Not found") else "Not found",
-                'current_ratio': current_assets / current_liabilities if (current_assets != "Not found") and (current_liabilities != "Not found") else "Not found",
-                'asset_turnover': revenue / total_assets if (revenue != "Not found") and (total_assets != "Not found") else "Not found",
-                'return_on_equity': roe,
-                'return_on_assets': net_income / total_assets if (net_income != "Not found") and (total_assets != "Not found") else "Not found",
-                'return_on_invested_capital': net_income / invested_capital if (net_income != "Not found") and (invested_capital != "Not found") else "Not found",
-                'earnings_yield': earnings_yield,
-                'free_cash_flow_yield': free_cash_flow / market_cap if (free_cash_flow != "Not found") and (market_cap != "Not found") else "Not found",
-                'dividend_yield': dividend_yield,
-                'payout_ratio': payout_ratio,
-                'buyback_yield': buyback_yield,
-                'total_return': (latest_price + dividend_yield) / latest_price - 1 if (latest_price != "Not found") and (dividend_yield != "Not found") else "Not found",
             }
+            stock_details.update({field: "Not found" if value is None else value for field, value in ratios.items()})
+            stock_details['fundamentals_as_of'] = stock_ratios.as_of
 
             if user_id is not None:
                 try:
@@ -662,6 +540,70 @@ class StockViewSet(viewsets.ModelViewSet):
 
             return Response(stock_details)
 
+        except Http404:
+            raise
         except Exception as e:
             print(f"Error fetching {ticker} details: {e}")
-            return Response({'error': 'Failed to fetch stock details.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            return Response({'error': 'Failed to fetch stock details.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=False, methods=['get'])
+    def screen_stocks(self, request):
+        # Filter and sort the materialized ratios in SQL, e.g. ?order_by=-free_cash_flow_yield&pe_ratio__lte=15
+        queryset = StockRatios.objects.select_related('stock')
+        for param, value in request.query_params.items():
+            field, _, lookup = param.partition('__')
+            if field in RATIO_FIELDS and lookup in ('gte', 'lte'):
+                try:
+                    queryset = queryset.filter(**{f'{field}__{lookup}': float(value)})
+                except ValueError:
+                    return Response({'error': f'Invalid value for {param}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        order_by = request.query_params.get('order_by', None)
+        if order_by is not None:
+            if order_by.lstrip('-') not in RATIO_FIELDS:
+                return Response({'error': f'Cannot order by {order_by}'}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(**{f"{order_by.lstrip('-')}__isnull": False}).order_by(order_by)
+
+        page = Paginator(queryset, 30).get_page(request.query_params.get('page', 1))
+        results = []
+        for stock_ratios in page:
+            row = {
+                'company_name': stock_ratios.stock.company_name,
+                'exchange_ticker': stock_ratios.stock.exchange_ticker,
+                'as_of': stock_ratios.as_of,
+            }
+            row.update({field: getattr(stock_ratios, field) for field in RATIO_FIELDS})
+            results.append(row)
+        return Response(results)
+
+
+
+### Streaming ###
+async def stream_watchlist(request):
+    # Server-sent events with a price update whenever a watched symbol moves. Needs an ASGI server.
+    user_id = request.GET.get('user_id')
+    if user_id is None:
+        return JsonResponse({'error': 'No user_id provided'}, status=400)
+
+    exchange_tickers = await sync_to_async(list)(
+        Watchlist.objects.filter(user_id=user_id).values_list('stock__exchange_ticker', flat=True))
+    tickers_by_symbol = {to_symbol(ticker): ticker for ticker in exchange_tickers}
+
+    async def events():
+        queue = hub.subscribe(tickers_by_symbol)
+        try:
+            while True:
+                try:
+                    update = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                update = dict(update, exchange_ticker=tickers_by_symbol[update['symbol']])
+                yield f'data: {json.dumps(update)}\n\n'
+        finally:
+            hub.unsubscribe(queue)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -3,6 +3,9 @@ ASGI config for valuevest_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve through an ASGI server (uvicorn/daphne) for the stocks/stream_watchlist/
+price stream; under WSGI each open stream would hold a worker thread.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
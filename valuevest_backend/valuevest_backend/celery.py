@@ -1,12 +1,14 @@
 from __future__ import absolute_import, unicode_literals
 from celery import Celery
-from django.conf import settings
+from celery.schedules import crontab
 import os
 
 # set the default Django settings module for the 'celery' program.
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'your_project.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'valuevest_backend.settings')
 
-app = Celery('your_project')
+from stocks.schedule import LATEST_PRICE_REFRESH_SECONDS, RATIOS_HOUR, REVALUATION_HOUR     # Reads settings, so after the line above
+
+app = Celery('valuevest_backend')
 
 # Using a string here means the worker doesn't have to serialize
 # the configuration object to child processes.
@@ -14,3 +16,19 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
+
+# Periodic tasks run by `celery -A valuevest_backend beat`
+app.conf.beat_schedule = {
+    'refresh-latest-prices': {
+        'task': 'stocks.tasks.refresh_latest_prices',
+        'schedule': LATEST_PRICE_REFRESH_SECONDS,
+    },
+    'revalue-stocks': {
+        'task': 'stocks.tasks.revalue_universe',
+        'schedule': crontab(hour=REVALUATION_HOUR, minute=0),
+    },
+    'recompute-stock-ratios': {
+        'task': 'stocks.tasks.recompute_stock_ratios',
+        'schedule': crontab(hour=RATIOS_HOUR, minute=0),
+    },
+}
@@ -3,7 +3,7 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from users.views import UserViewSet
-from stocks.views import StockViewSet
+from stocks.views import StockViewSet, stream_watchlist
 from rest_framework_simplejwt.views import (TokenObtainPairView, TokenRefreshView, TokenBlacklistView)
 
 router = DefaultRouter()
@@ -12,6 +12,7 @@ router.register(r'stocks', StockViewSet, basename='stocks')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('stocks/stream_watchlist/', stream_watchlist, name='stream_watchlist'),
     path('', include(router.urls)),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),